@@ -1,10 +1,14 @@
+import base64
+import binascii
 from pathlib import Path
-from typing import Any, List, Optional
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
 
 from restapi.config import DATA_PATH
+from restapi.connectors import neo4j
 from restapi.exceptions import BadRequest, NotFound
-from restapi.rest.definition import EndpointResource
-from restapi.services.authentication import User
+from restapi.models import PartialSchema, fields, validate
+from restapi.rest.definition import EndpointResource, Response
+from restapi.services.authentication import Role, User
 from restapi.utilities.logs import log
 
 INPUT_ROOT = DATA_PATH.joinpath("input")
@@ -25,6 +29,219 @@
 Dataset = Any
 File = Any
 
+# labels of the nodes whose access is ruled by the IS_OWNED_BY relationship
+OWNED_LABELS = ["Study", "Dataset"]
+
+# Cypher fragment to be used after a MATCH binding the user to u and a set of
+# Study or Dataset nodes to n. For each node it binds:
+#   - has_owner: the node has at least an owner
+#   - is_owner: the user is one of the owners
+#   - shared: the user shares a group with one of the owners
+#   - is_admin: the user is an admin
+ACCESS_FLAGS = """
+OPTIONAL MATCH (u)-[:HAS_ROLE]->(r:Role {name: $admin_role})
+WITH u, n, count(r) > 0 AS is_admin
+OPTIONAL MATCH (n)-[:IS_OWNED_BY]->(owner:User)
+OPTIONAL MATCH (owner)-[:BELONGS_TO]->(g:Group)<-[:BELONGS_TO]-(u)
+WITH u, n, is_admin,
+    count(owner) > 0 AS has_owner,
+    sum(CASE WHEN owner = u THEN 1 ELSE 0 END) > 0 AS is_owner,
+    count(g) > 0 AS shared
+"""
+
+# The access flags of each requested uuid, in a single round trip
+ACCESS_MATCH = """
+MATCH (u:User {{uuid: $user_uuid}})
+UNWIND $uuids AS node_uuid
+MATCH (n:{label} {{uuid: node_uuid}})
+"""
+ACCESS_RETURN = """
+RETURN n.uuid, has_owner, is_owner, shared, is_admin
+"""
+
+# Only keeps the nodes readable by the user, with the same rules of
+# Access.allows(read=True), and binds the readonly flag, that is true when
+# the user is not an owner of the node and does not belong to a group of its
+# owners (i.e. is an admin)
+READ_ACCESS_FILTER = ACCESS_FLAGS + """
+WHERE has_owner AND (is_owner OR shared OR is_admin)
+WITH u, n, NOT (is_owner OR shared) AS readonly
+"""
+
+# Only the studies accessible by the user are visited, by walking from the user
+# to the studies owned by the members of its groups (the user included)
+STUDY_LIST_MATCH = """
+MATCH (u:User {uuid: $user_uuid})
+CALL {
+    WITH u
+    MATCH (u)-[:BELONGS_TO]->(:Group)<-[:BELONGS_TO]-(:User)<-[:IS_OWNED_BY]-(n:Study)
+    RETURN n
+    UNION
+    WITH u
+    MATCH (u)<-[:IS_OWNED_BY]-(n:Study)
+    RETURN n
+}
+WITH u, n, false AS readonly
+"""
+# Admins can read all the studies, i.e. a direct scan is the cheapest path.
+# Studies are readonly if not owned by the admin or by a member of its groups
+ADMIN_STUDY_LIST_MATCH = """
+MATCH (u:User {uuid: $user_uuid})
+MATCH (n:Study)
+WHERE (n)-[:IS_OWNED_BY]->(:User)
+WITH u, n, size([
+    (n)-[:IS_OWNED_BY]->(o:User)
+    WHERE o = u OR (o)-[:BELONGS_TO]->(:Group)<-[:BELONGS_TO]-(u) | o
+]) = 0 AS readonly
+"""
+
+
+MAX_PAGE_SIZE = 1000
+# the lists are always bounded, the clients not sending a size receive the
+# largest page and can follow X-Next-Cursor to retrieve the others
+DEFAULT_PAGE_SIZE = MAX_PAGE_SIZE
+
+
+class ListQuery(PartialSchema):
+    size = fields.Int(
+        required=False,
+        load_default=DEFAULT_PAGE_SIZE,
+        validate=validate.Range(min=1, max=MAX_PAGE_SIZE),
+        metadata={"description": "Number of elements to retrieve"},
+    )
+    cursor = fields.Str(
+        required=False,
+        metadata={"description": "Cursor of the page, as returned in X-Next-Cursor"},
+    )
+    sort_by = fields.Str(required=False, load_default=None)
+    sort_order = fields.Str(
+        validate=validate.OneOf(["asc", "desc"]), required=False, load_default="asc"
+    )
+    name = fields.Str(required=False, metadata={"description": "Filter by name prefix"})
+
+
+def encode_cursor(offset: int) -> str:
+    return base64.urlsafe_b64encode(str(offset).encode()).decode()
+
+
+def decode_cursor(cursor: Optional[str]) -> int:
+    if not cursor:
+        return 0
+    try:
+        offset = int(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise BadRequest("Invalid cursor")
+    if offset < 0:
+        raise BadRequest("Invalid cursor")
+    return offset
+
+
+def get_page(
+    match: str,
+    projection: str,
+    sort_keys: Dict[str, str],
+    filters: List[str],
+    params: Dict[str, Any],
+    size: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
+    sort_by: Optional[str] = None,
+    sort_order: str = "asc",
+) -> Tuple[List[Any], int, Optional[str]]:
+    """
+    Retrieve a page of the nodes bound to n by the match clause. Filters,
+    sorting and pagination are all pushed down into the Cypher query.
+    Returns the projected rows, the total number of matching nodes
+    and the cursor of the next page, if any
+    """
+
+    graph = neo4j.get_instance()
+
+    query = match
+    if filters:
+        query += "\nWITH * WHERE " + " AND ".join(filters)
+
+    if sort_by is None:
+        sort_by = next(iter(sort_keys))
+    if sort_by not in sort_keys:  # pragma: no cover
+        raise BadRequest(f"Invalid sort key: {sort_by}")
+    order = "DESC" if sort_order == "desc" else "ASC"
+
+    page_query = f"{query}\nRETURN {projection}"
+    page_query += f"\nORDER BY {sort_keys[sort_by]} {order}, n.uuid {order}"
+
+    params = params.copy()
+    offset = decode_cursor(cursor)
+    page_query += "\nSKIP $skip LIMIT $limit"
+    params["skip"] = offset
+    params["limit"] = size
+
+    rows = [row[0] for row in graph.cypher(page_query, **params)]
+
+    total = 0
+    for row in graph.cypher(f"{query}\nRETURN count(n)", **params):
+        total = int(row[0])
+
+    next_cursor = None
+    if offset + size < total:
+        next_cursor = encode_cursor(offset + size)
+
+    return rows, total, next_cursor
+
+
+class Access(NamedTuple):
+    # the node has at least an owner
+    has_owner: bool
+    # the user is an owner of the node
+    owner: bool
+    # the user belongs to a group of an owner of the node
+    shared: bool
+    # the user is an admin
+    admin: bool
+
+    @property
+    def readonly(self) -> bool:
+        return not (self.owner or self.shared)
+
+    def allows(self, read: bool = False, update_status: bool = False) -> bool:
+        if not self.has_owner:
+            return False
+
+        # The owner and the members of the owner groups have always access
+        if self.owner or self.shared:
+            return True
+
+        # An admin has always access for readonly or to update dataset status
+        return self.admin and (read or update_status)
+
+
+def get_access_map(label: str, uuids: List[str], user: User) -> Dict[str, Access]:
+    """
+    Resolve the access of the user on a list of Study or Dataset nodes
+    with a single query. Not existing nodes are not included in the result
+    """
+
+    if label not in OWNED_LABELS:  # pragma: no cover
+        raise BadRequest(f"Can't verify the access on {label} nodes")
+
+    if not uuids:
+        return {}
+
+    graph = neo4j.get_instance()
+    params: Dict[str, Any] = {
+        "user_uuid": user.uuid,
+        "admin_role": Role.ADMIN.value,
+        "uuids": uuids,
+    }
+    query = ACCESS_MATCH.format(label=label) + ACCESS_FLAGS + ACCESS_RETURN
+    result = graph.cypher(query, **params)
+
+    access_map: Dict[str, Access] = {}
+    for row in result:
+        access_map[row[0]] = Access(
+            has_owner=row[1], owner=row[2], shared=row[3], admin=row[4]
+        )
+    return access_map
+
 
 class NIGEndpoint(EndpointResource):
     # group used for test or, in general, groups we don't want to be counted in stats
@@ -90,6 +307,21 @@ def getError(error_type: str) -> str:
             return TECHMETA_NOT_FOUND
         return "Resource not found"  # pragma: no cover
 
+    def paginated_response(
+        self, data: List[Any], total: int, next_cursor: Optional[str]
+    ) -> Response:
+        headers = {
+            "Access-Control-Expose-Headers": "X-Total-Count, X-Next-Cursor",
+            "X-Total-Count": str(total),
+        }
+        if next_cursor:
+            headers["X-Next-Cursor"] = next_cursor
+        return self.response(data, headers=headers)
+
+    @staticmethod
+    def getAccessMap(label: str, uuids: List[str], user: User) -> Dict[str, Access]:
+        return get_access_map(label, uuids, user)
+
     # returns 2 values:
     #   - user has access True/False
     #   - a human readable motivation
@@ -111,26 +343,17 @@ def verifyStudyAccess(
             else:
                 return False
 
-        owner = study.ownership.single()
+        access = self.getAccessMap("Study", [study.uuid], user).get(study.uuid)
 
-        if owner is None:  # pragma: no cover
+        if access is not None and not access.has_owner:  # pragma: no cover
             log.warning("Study with null owner: %s" % study.uuid)
             return False
 
-        # The owner has always access
-        if owner == user:
+        if access is not None and access.allows(
+            read=read, update_status=update_dataset_status
+        ):
             return True
 
-        # A member of the some group of the owner, has always access
-        for group in owner.belongs_to.all():
-            if group.members.is_connected(user):
-                return True
-
-        # An admin has always access for readonly or to update dataset status
-        if self.auth.is_admin(user):
-            if read or update_dataset_status:
-                return True
-
         if raiseError:
             raise NotFound(not_found)
         else:
@@ -154,27 +377,15 @@ def verifyDatasetAccess(
             else:
                 return False
 
-        # The owner has always access
-        owner = dataset.ownership.single()
+        access = self.getAccessMap("Dataset", [dataset.uuid], user).get(dataset.uuid)
 
-        if owner is None:
+        if access is not None and not access.has_owner:
             log.warning("Dataset with null owner: %s" % dataset.uuid)
             return False
 
-        # The owner has always access
-        if owner == user:
+        if access is not None and access.allows(read=read, update_status=update_status):
             return True
 
-        # A member of the some group of the owner, has always access
-        for group in owner.belongs_to.all():
-            if group.members.is_connected(user):
-                return True
-
-        # An admin has always access for readonly or to modify dataset status
-        if self.auth.is_admin(user):
-            if read or update_status:
-                return True
-
         if raiseError:
             raise NotFound(not_found)
         else:
@@ -0,0 +1,144 @@
+"""
+Archives of the analysis results streamed while they are generated.
+
+Entries are stored without compression (BAM and bgzipped files are already
+compressed) and read in blocks of DOWNLOAD_BLOCK_SIZE, written to the
+response and then dropped, so that the memory used does not depend on the
+number or on the size of the files and nothing is written on disk. ZIP
+archives use ZIP64 entries with data descriptors, so that the headers do not
+need to be rewritten once an entry is completed. The MD5 of each entry is
+computed while it is streamed and a MD5SUMS manifest, in the md5sum format,
+is appended as the last entry.
+"""
+
+import hashlib
+import os
+import tarfile
+import time
+import zipfile
+from pathlib import Path
+from typing import IO, Iterator, List, NamedTuple, Tuple
+
+from nig.endpoints._download import DOWNLOAD_BLOCK_SIZE
+
+ARCHIVE_FORMATS = {"zip": "application/zip", "tar": "application/x-tar"}
+MANIFEST_NAME = "MD5SUMS"
+
+
+class ArchiveEntry(NamedTuple):
+    # path of the entry in the archive
+    name: str
+    path: Path
+
+
+class StreamBuffer:
+    """
+    Write-only file object, the written bytes are kept until drained
+    """
+
+    def __init__(self) -> None:
+        self.chunks: List[bytes] = []
+
+    def write(self, data: bytes) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def read_file(f: IO[bytes], size: int) -> Iterator[bytes]:
+    """
+    Read the given number of bytes, the size is already written in the
+    entry header so a file truncated while read aborts the archive
+    """
+    remaining = size
+    while remaining > 0:
+        data = f.read(min(DOWNLOAD_BLOCK_SIZE, remaining))
+        if not data:
+            raise OSError(f"{f.name} has been truncated while archived")
+        remaining -= len(data)
+        yield data
+
+
+def manifest_line(md5: str, name: str) -> bytes:
+    return f"{md5}  {name}\n".encode()
+
+
+def tar_stream(entries: List[ArchiveEntry]) -> Iterator[bytes]:
+    manifest: List[bytes] = []
+    for entry in entries:
+        with open(entry.path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            info = tarfile.TarInfo(entry.name)
+            info.size = stat.st_size
+            info.mtime = int(stat.st_mtime)
+            info.mode = 0o644
+            yield info.tobuf(format=tarfile.PAX_FORMAT)
+
+            md5 = hashlib.md5()
+            for data in read_file(f, stat.st_size):
+                md5.update(data)
+                yield data
+        # the content is padded to the tar block size
+        yield tar_padding(stat.st_size)
+        manifest.append(manifest_line(md5.hexdigest(), entry.name))
+
+    content = b"".join(manifest)
+    info = tarfile.TarInfo(MANIFEST_NAME)
+    info.size = len(content)
+    info.mtime = int(time.time())
+    info.mode = 0o644
+    yield info.tobuf(format=tarfile.PAX_FORMAT)
+    yield content
+    yield tar_padding(len(content))
+    # end of archive marker
+    yield tarfile.NUL * tarfile.BLOCKSIZE * 2
+
+
+def tar_padding(size: int) -> bytes:
+    return tarfile.NUL * (-size % tarfile.BLOCKSIZE)
+
+
+def zip_datetime(timestamp: float) -> Tuple[int, int, int, int, int, int]:
+    # the zip format can't store dates before 1980
+    return max(time.localtime(timestamp)[:6], (1980, 1, 1, 0, 0, 0))
+
+
+def zip_stream(entries: List[ArchiveEntry]) -> Iterator[bytes]:
+    buffer = StreamBuffer()
+    manifest: List[bytes] = []
+    # the buffer is not seekable, the entries are written with data descriptors
+    with zipfile.ZipFile(buffer, mode="w", allowZip64=True) as archive:  # type: ignore
+        for entry in entries:
+            with open(entry.path, "rb") as f:
+                stat = os.fstat(f.fileno())
+                info = zipfile.ZipInfo(entry.name, zip_datetime(stat.st_mtime))
+                info.compress_type = zipfile.ZIP_STORED
+                info.file_size = stat.st_size
+                info.external_attr = 0o644 << 16
+
+                md5 = hashlib.md5()
+                with archive.open(info, mode="w", force_zip64=True) as dest:
+                    for data in read_file(f, stat.st_size):
+                        md5.update(data)
+                        dest.write(data)
+                        yield buffer.drain()
+            yield buffer.drain()
+            manifest.append(manifest_line(md5.hexdigest(), entry.name))
+
+        info = zipfile.ZipInfo(MANIFEST_NAME, zip_datetime(time.time()))
+        archive.writestr(info, b"".join(manifest))
+    # the central directory is written when the archive is closed
+    yield buffer.drain()
+
+
+def archive_stream(entries: List[ArchiveEntry], archive_format: str) -> Iterator[bytes]:
+    if archive_format == "tar":
+        return tar_stream(entries)
+    return zip_stream(entries)
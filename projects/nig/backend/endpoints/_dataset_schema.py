@@ -0,0 +1,68 @@
+"""
+Process-level cache of the dataset input schemas.
+
+The dataset input schema depends on the phenotypes and technicals defined in
+the study, so the generated class is memoized per (study uuid, is_post).
+A per-study version counter is kept on redis and incremented by the
+phenotype and technical endpoints, so that every worker drops its copy when
+the choices change. Entries also expire after DATASET_SCHEMA_CACHE_TTL
+seconds to cover a write invalidated before its transaction is committed.
+"""
+
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Callable, Optional, Tuple, Type
+
+from restapi.connectors import redis
+from restapi.models import Schema
+
+DATASET_SCHEMA_CACHE_TTL = 300
+DATASET_SCHEMA_CACHE_SIZE = 256
+
+VERSION_KEY = "nig:dataset_schema:{}"
+
+CacheKey = Tuple[str, bool]
+# expiration, study version, schema
+CacheEntry = Tuple[float, Optional[bytes], Type[Schema]]
+
+_lock = Lock()
+_schemas: "OrderedDict[CacheKey, CacheEntry]" = OrderedDict()
+
+
+def get_study_version(study_uuid: str) -> Optional[bytes]:
+    r = redis.get_instance().r
+    version: Optional[bytes] = r.get(VERSION_KEY.format(study_uuid))
+    return version
+
+
+def get_dataset_schema(
+    study_uuid: str, is_post: bool, build: Callable[[], Type[Schema]]
+) -> Type[Schema]:
+    key = (study_uuid, is_post)
+    version = get_study_version(study_uuid)
+
+    with _lock:
+        entry = _schemas.get(key)
+        if entry and entry[0] > time.monotonic() and entry[1] == version:
+            _schemas.move_to_end(key)
+            return entry[2]
+
+    schema = build()
+
+    with _lock:
+        _schemas[key] = (time.monotonic() + DATASET_SCHEMA_CACHE_TTL, version, schema)
+        _schemas.move_to_end(key)
+        while len(_schemas) > DATASET_SCHEMA_CACHE_SIZE:
+            _schemas.popitem(last=False)
+
+    return schema
+
+
+def invalidate_dataset_schema(study_uuid: str) -> None:
+    r = redis.get_instance().r
+    r.incr(VERSION_KEY.format(study_uuid))
+
+    with _lock:
+        _schemas.pop((study_uuid, True), None)
+        _schemas.pop((study_uuid, False), None)
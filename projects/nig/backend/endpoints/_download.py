@@ -0,0 +1,214 @@
+"""
+Download of large files with HTTP range requests.
+
+Downloads can be resumed and remote viewers (e.g. IGV) can fetch only the byte
+ranges they need. The whole file and single ranges are returned through the
+wsgi.file_wrapper of the server, that (e.g. with gunicorn) sends the bytes
+from the current position of the file descriptor with os.sendfile, without
+copying them in user space. Multiple ranges are streamed in a
+multipart/byteranges response.
+
+Regions of the indexed results are extracted by samtools and tabix, that use
+the BAI/TBI indexes to read only the BGZF blocks overlapping the region.
+"""
+
+import os
+import subprocess
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import IO, Iterator, List, Optional, Tuple
+from uuid import uuid4
+
+from flask import Response, request, stream_with_context
+from restapi.exceptions import BadRequest
+from werkzeug.wsgi import wrap_file
+
+DOWNLOAD_BLOCK_SIZE = 1048576
+DEFAULT_MIMETYPE = "application/octet-stream"
+
+# start included, stop excluded
+ByteRange = Tuple[int, int]
+
+
+class FileRange:
+    """
+    File object limited to a byte range. The file descriptor is positioned
+    at the beginning of the range, so that it can be sent with os.sendfile
+    """
+
+    def __init__(self, path: Path, start: int, stop: int) -> None:
+        self.file: IO[bytes] = open(path, "rb")
+        self.file.seek(start)
+        self.remaining = stop - start
+
+    def fileno(self) -> int:
+        return self.file.fileno()
+
+    def read(self, size: int = -1) -> bytes:
+        if self.remaining <= 0:
+            return b""
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self) -> None:
+        self.file.close()
+
+
+def get_etag(stat: os.stat_result) -> str:
+    return f"{stat.st_size:x}-{stat.st_mtime_ns:x}"
+
+
+def requested_ranges(
+    size: int, etag: str, last_modified: datetime
+) -> Optional[List[ByteRange]]:
+    """
+    Return the satisfiable ranges of the request, None if the whole file has
+    to be sent (no Range header or an If-Range not matching the current file).
+    An empty list means that none of the ranges can be satisfied
+    """
+    if request.range is None or request.range.units != "bytes":
+        return None
+
+    if_range = request.if_range
+    if if_range.etag is not None and if_range.etag != etag:
+        return None
+    # a date matches only if it is exactly the last modification, the file
+    # could have been changed more than once in the same second otherwise
+    if if_range.date is not None and if_range.date != last_modified:
+        return None
+
+    ranges: List[ByteRange] = []
+    for start, stop in request.range.ranges:
+        if start < 0:
+            # suffix range: the last -start bytes
+            start, stop = max(size + start, 0), size
+        else:
+            stop = size if stop is None else min(stop, size)
+        if start < stop:
+            ranges.append((start, stop))
+    return ranges
+
+
+def multipart_ranges(
+    path: Path, ranges: List[ByteRange], boundary: str, mimetype: str, size: int
+) -> Iterator[bytes]:
+    with open(path, "rb") as f:
+        for start, stop in ranges:
+            yield (
+                f"\r\n--{boundary}\r\n"
+                f"Content-Type: {mimetype}\r\n"
+                f"Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n"
+            ).encode()
+            f.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                data = f.read(min(DOWNLOAD_BLOCK_SIZE, remaining))
+                if not data:  # pragma: no cover
+                    break
+                remaining -= len(data)
+                yield data
+        yield f"\r\n--{boundary}--\r\n".encode()
+
+
+def send_file_ranges(
+    path: Path, mimetype: str = DEFAULT_MIMETYPE, download_name: Optional[str] = None
+) -> Response:
+    """
+    Send the file, or the byte ranges requested with the Range header
+    """
+    stat = path.stat()
+    size = stat.st_size
+    etag = get_etag(stat)
+    last_modified = datetime.fromtimestamp(int(stat.st_mtime), tz=timezone.utc)
+
+    ranges = requested_ranges(size, etag, last_modified)
+
+    if ranges is None or len(ranges) == 1:
+        start, stop = ranges[0] if ranges else (0, size)
+        body = wrap_file(request.environ, FileRange(path, start, stop))
+        response = Response(body, mimetype=mimetype, direct_passthrough=True)
+        response.content_length = stop - start
+        if ranges:
+            response.status_code = 206
+            response.headers["Content-Range"] = f"bytes {start}-{stop - 1}/{size}"
+    elif ranges:
+        boundary = uuid4().hex
+        response = Response(
+            stream_with_context(
+                multipart_ranges(path, ranges, boundary, mimetype, size)
+            ),
+            status=206,
+            mimetype=f"multipart/byteranges; boundary={boundary}",
+        )
+    else:
+        response = Response(status=416)
+        response.headers["Content-Range"] = f"bytes */{size}"
+
+    response.headers["Accept-Ranges"] = "bytes"
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.headers["Content-Disposition"] = (
+        f"attachment; filename={download_name or path.name}"
+    )
+    return response
+
+
+def region_commands(kind: str, path: Path, index: Path, region: str) -> List[List[str]]:
+    """
+    Return the pipeline of commands extracting a region from an indexed result.
+    The arguments follow "--", so that they are never parsed as options
+    """
+    if kind == "bam":
+        # the pipeline writes the index as .bai instead of .bam.bai
+        return [["samtools", "view", "-b", "-X", "--", str(path), str(index), region]]
+    # tabix outputs plain text, compressed again in BGZF blocks
+    return [["tabix", "-h", "--", str(path), region], ["bgzip", "-c"]]
+
+
+def stream_region(commands: List[List[str]]) -> Iterator[bytes]:
+    """
+    Start the commands and stream the output of the last one.
+    The first block is read before returning, to report the errors of commands
+    failing before producing any output
+    """
+    processes: List[subprocess.Popen] = []  # type: ignore
+    stdin: Optional[IO[bytes]] = None
+    for command in commands:
+        process = subprocess.Popen(
+            command, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        if stdin:
+            # only the next command reads it
+            stdin.close()
+        stdin = process.stdout
+        processes.append(process)
+
+    output = processes[-1].stdout
+    assert output is not None
+    first = output.read1(DOWNLOAD_BLOCK_SIZE)  # type: ignore
+    if not first:
+        errors = [
+            p.stderr.read().decode().strip()
+            for p in processes
+            if p.wait() != 0 and p.stderr
+        ]
+        if errors:
+            raise BadRequest(f"Cannot extract the region: {errors[0]}")
+
+    def generate() -> Iterator[bytes]:
+        try:
+            data = first
+            while data:
+                yield data
+                data = output.read1(DOWNLOAD_BLOCK_SIZE)  # type: ignore
+        finally:
+            # the client could have closed the connection
+            for p in processes:
+                if p.poll() is None:
+                    p.kill()
+                p.wait()
+
+    return generate()
@@ -0,0 +1,140 @@
+"""
+Classification of the files by kind and registration of the analysis results.
+
+The kind is stored in the indexed File.kind property, so that files can be
+looked up by equality instead of matching their names. The outputs of the
+pipeline are registered as File nodes linked to the dataset with HAS_RESULT,
+not to be confused with the uploaded files linked with CONTAINS, and are
+resolved through the cache in _results.
+
+The status of the uploaded files is reconciled against a single listing of
+the dataset directory by the check_consistency task.
+"""
+
+import os
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from nig.endpoints._results import invalidate_results
+from restapi.connectors import neo4j
+from restapi.utilities.uuid import getUUID
+
+# suffixes checked in order, the first match wins
+FILE_KINDS = [
+    (".fastq.gz", "fastq"),
+    (".fastq", "fastq"),
+    (".bam.bai", "bai"),
+    (".bai", "bai"),
+    (".bam", "bam"),
+    (".tbi", "tbi"),
+    (".g.vcf.gz", "gvcf"),
+    (".g.vcf", "gvcf"),
+    (".vcf.gz", "vcf"),
+    (".vcf", "vcf"),
+]
+OTHER_KIND = "other"
+
+# output subfolders of the pipeline and the kinds of results they contain
+RESULT_FOLDERS = {"bwa": ["bam", "bai"], "gatk_gvcf": ["gvcf", "tbi"]}
+
+REGISTER_RESULTS_QUERY = """
+MATCH (d:Dataset {uuid: $dataset_uuid})
+OPTIONAL MATCH (d)-[:HAS_RESULT]->(old:File)
+WHERE NOT old.path IN [r IN $results | r.path]
+DETACH DELETE old
+WITH DISTINCT d
+UNWIND $results AS r
+MERGE (d)-[:HAS_RESULT]->(f:File {path: r.path})
+ON CREATE SET f.uuid = r.uuid
+SET f.name = r.name, f.size = r.size, f.mtime = r.mtime, f.kind = r.kind,
+    f.type = r.kind, f.status = "uploaded"
+"""
+
+UPDATE_FILE_STATUS_QUERY = """
+UNWIND $changes AS c
+MATCH (f:File {uuid: c.uuid})
+SET f.status = c.status
+"""
+
+
+def get_file_kind(filename: str) -> str:
+    for suffix, kind in FILE_KINDS:
+        if filename.endswith(suffix):
+            return kind
+    return OTHER_KIND
+
+
+def scan_results(output_path: Path) -> List[Dict[str, Any]]:
+    """
+    Return the results found in the output folder of a dataset
+    """
+    results: List[Dict[str, Any]] = []
+    for folder, kinds in RESULT_FOLDERS.items():
+        resource_dir = output_path.joinpath(folder)
+        if not resource_dir.is_dir():
+            continue
+        for f in resource_dir.iterdir():
+            kind = get_file_kind(f.name)
+            if kind in kinds and f.is_file():
+                stat = f.stat()
+                results.append(
+                    {
+                        "path": str(f),
+                        "name": f.name,
+                        "size": stat.st_size,
+                        "mtime": stat.st_mtime,
+                        "kind": kind,
+                    }
+                )
+    return results
+
+
+def register_results(
+    dataset_uuid: str,
+    output_path: Path,
+    results: Optional[List[Dict[str, Any]]] = None,
+) -> int:
+    """
+    Register the results found in the output folder of a dataset (or the
+    already scanned ones), replacing the ones previously registered.
+    Returns the number of results
+    """
+    if results is None:
+        results = scan_results(output_path)
+
+    graph = neo4j.get_instance()
+    params: Dict[str, Any] = {
+        "dataset_uuid": dataset_uuid,
+        # generated as the uuids of the other nodes, only used on creation
+        "results": [{**r, "uuid": getUUID()} for r in results],
+    }
+    graph.cypher(REGISTER_RESULTS_QUERY, **params)
+    invalidate_results(dataset_uuid)
+    return len(results)
+
+
+def scan_file_sizes(path: Path) -> Dict[str, int]:
+    """
+    Return the sizes of the regular files in a directory, read with
+    a single listing. A missing directory is considered empty
+    """
+    sizes: Dict[str, int] = {}
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    sizes[entry.name] = entry.stat().st_size
+    except FileNotFoundError:
+        pass
+    return sizes
+
+
+def get_file_status(status: str, size: int, disk_size: Optional[int]) -> str:
+    """
+    Return the status of a file given its size on disk, None if missing
+    """
+    if disk_size is None:
+        return "unknown"
+    if status == "unknown":
+        return "uploaded" if disk_size == size else "importing"
+    return status
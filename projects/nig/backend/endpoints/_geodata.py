@@ -0,0 +1,78 @@
+"""
+Process-level cache of the GeoData reference nodes.
+
+GeoData nodes are static reference data loaded by the Initializer from
+geodata.tsv, so keys and labels are kept in memory and only reloaded after
+GEODATA_CACHE_TTL seconds or when invalidated. A version counter is kept on
+redis and incremented on invalidation, so that every worker drops its copy
+when the nodes are reloaded by another process.
+"""
+
+import time
+from threading import Lock
+from typing import FrozenSet, List, NamedTuple, Optional
+
+from restapi.connectors import neo4j, redis
+
+GEODATA_CACHE_TTL = 3600
+
+VERSION_KEY = "nig:geodata:version"
+
+GEODATA_QUERY = """
+MATCH (g:GeoData)
+RETURN g.uuid, g.province
+ORDER BY g.province
+"""
+
+
+class GeoDataChoices(NamedTuple):
+    keys: List[str]
+    labels: List[str]
+
+
+_lock = Lock()
+_choices: Optional[GeoDataChoices] = None
+# the same keys, for the membership tests
+_key_set: FrozenSet[str] = frozenset()
+_version: Optional[bytes] = None
+_expiration: float = 0.0
+
+
+def get_geodata_version() -> Optional[bytes]:
+    r = redis.get_instance().r
+    version: Optional[bytes] = r.get(VERSION_KEY)
+    return version
+
+
+def get_geodata_choices() -> GeoDataChoices:
+    global _choices, _key_set, _version, _expiration
+
+    version = get_geodata_version()
+    with _lock:
+        if _choices is None or _version != version or time.monotonic() >= _expiration:
+            graph = neo4j.get_instance()
+            keys = []
+            labels = []
+            for uuid, province in graph.cypher(GEODATA_QUERY):
+                keys.append(uuid)
+                labels.append(province)
+            _choices = GeoDataChoices(keys, labels)
+            _key_set = frozenset(keys)
+            _version = version
+            _expiration = time.monotonic() + GEODATA_CACHE_TTL
+        return _choices
+
+
+def is_valid_geodata(uuid: str) -> bool:
+    get_geodata_choices()
+    return uuid in _key_set
+
+
+def invalidate_geodata_cache() -> None:
+    global _choices
+
+    r = redis.get_instance().r
+    r.incr(VERSION_KEY)
+
+    with _lock:
+        _choices = None
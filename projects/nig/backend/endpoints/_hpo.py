@@ -0,0 +1,334 @@
+"""
+Process-level index of the HPO ontology.
+
+HPO terms are loaded once by scripts/parsing_hpo.py, so the whole ontology is
+kept in memory and only reloaded after HPO_CACHE_TTL seconds or when
+explicitly invalidated. Labels and synonyms are indexed by trigrams to
+answer the autocomplete substring queries without scanning every term.
+
+Terms are also numbered by position and the IS_CHILD_OF hierarchy is stored
+as CSR adjacency arrays (an offsets array and a flat array of neighbours,
+in both directions) to walk the ontology without querying the database.
+The transitive closure of the hierarchy is stored in the same format and
+used to compute the intrinsic information content of every term and the
+Resnik similarities of the phenotype profiles.
+"""
+
+import heapq
+import time
+from collections import deque
+from threading import Lock
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+from restapi.connectors import neo4j
+
+HPO_CACHE_TTL = 3600
+HPO_SEARCH_LIMIT = 50
+
+HPO_TERMS_QUERY = """
+MATCH (hpo:HPO)
+RETURN hpo.hpo_id, hpo.label, hpo.synonyms
+ORDER BY hpo.hpo_id
+"""
+# parsing_hpo.py stores the edges as (parent)-[:IS_CHILD_OF]->(child)
+HPO_EDGES_QUERY = """
+MATCH (parent:HPO)-[:IS_CHILD_OF]->(child:HPO)
+RETURN parent.hpo_id, child.hpo_id
+"""
+
+# search ranks
+LABEL_PREFIX = 0
+WORD_PREFIX = 1
+SUBSTRING = 2
+SYNONYM = 3
+
+
+def trigrams(text: str) -> Set[str]:
+    return {text[i : i + 3] for i in range(len(text) - 2)}
+
+
+def csr(
+    sources: np.ndarray, targets: np.ndarray, size: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Build the CSR adjacency arrays of the given edges: the neighbours of the
+    node i are neighbours[offsets[i] : offsets[i + 1]]
+    """
+    order = np.argsort(sources, kind="stable")
+    neighbours = targets[order].astype(np.int32)
+    offsets = np.zeros(size + 1, dtype=np.int32)
+    np.cumsum(np.bincount(sources, minlength=size), out=offsets[1:])
+    return offsets, neighbours
+
+
+class HPOIndex:
+    def __init__(
+        self,
+        terms: Iterable[Tuple[str, str, Optional[str]]],
+        edges: Iterable[Tuple[str, str]] = (),
+    ) -> None:
+        self.ids: List[str] = []
+        self.labels: List[str] = []
+        self.id_position: Dict[str, int] = {}
+        # lowercase texts used for the matching
+        self.search_ids: List[str] = []
+        self.search_labels: List[str] = []
+        self.search_synonyms: List[str] = []
+        self.postings: Dict[str, Set[int]] = {}
+
+        for position, (hpo_id, label, synonyms) in enumerate(terms):
+            self.ids.append(hpo_id)
+            self.labels.append(label)
+            self.id_position[hpo_id] = position
+            self.search_ids.append(hpo_id.lower())
+            self.search_labels.append(label.lower())
+            self.search_synonyms.append((synonyms or "").lower())
+
+            text = f"{self.search_labels[-1]}\n{self.search_synonyms[-1]}"
+            for trigram in trigrams(text):
+                self.postings.setdefault(trigram, set()).add(position)
+
+        parents = []
+        children = []
+        for parent, child in edges:
+            if parent in self.id_position and child in self.id_position:
+                parents.append(self.id_position[parent])
+                children.append(self.id_position[child])
+        parents_array = np.array(parents, dtype=np.int32)
+        children_array = np.array(children, dtype=np.int32)
+        self.children_offsets, self.children = csr(
+            parents_array, children_array, len(self.ids)
+        )
+        self.parents_offsets, self.parents = csr(
+            children_array, parents_array, len(self.ids)
+        )
+
+        self.build_closure()
+
+    def build_closure(self) -> None:
+        """
+        Compute the ancestors of every term visiting the terms in topological
+        order, then derive the descendants and the intrinsic information
+        content IC(t) = 1 - log(descendants(t) + 1) / log(terms)
+        """
+        size = len(self.ids)
+        ancestors: List[Set[int]] = [set() for _ in range(size)]
+        remaining = np.diff(self.parents_offsets).tolist()
+        queue = deque(p for p in range(size) if remaining[p] == 0)
+        while queue:
+            current = queue.popleft()
+            start, end = self.children_offsets[current : current + 2]
+            for child in self.children[start:end].tolist():
+                ancestors[child].update(ancestors[current])
+                ancestors[child].add(current)
+                remaining[child] -= 1
+                if remaining[child] == 0:
+                    queue.append(child)
+
+        sizes = np.array([len(a) for a in ancestors], dtype=np.int32)
+        self.closure_offsets = np.zeros(size + 1, dtype=np.int32)
+        np.cumsum(sizes, out=self.closure_offsets[1:])
+        self.closure = np.fromiter(
+            (a for terms in ancestors for a in sorted(terms)),
+            dtype=np.int32,
+            count=int(self.closure_offsets[-1]),
+        )
+        owners = np.repeat(np.arange(size, dtype=np.int32), sizes)
+        self.descendants_offsets, self.all_descendants = csr(self.closure, owners, size)
+
+        descendants = np.diff(self.descendants_offsets).astype(np.float64)
+        if size > 1:
+            self.information_content = 1.0 - np.log(descendants + 1) / np.log(size)
+        else:
+            self.information_content = np.ones(size)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def candidates(self, query: str) -> Iterable[int]:
+        if len(query) < 3:
+            return range(len(self.ids))
+
+        postings = []
+        for trigram in trigrams(query):
+            if trigram not in self.postings:
+                return []
+            postings.append(self.postings[trigram])
+        postings.sort(key=len)
+        return set.intersection(*postings)
+
+    def label_rank(self, position: int, query: str) -> Optional[int]:
+        label = self.search_labels[position]
+        if label.startswith(query):
+            return LABEL_PREFIX
+        if f" {query}" in label:
+            return WORD_PREFIX
+        if query in label:
+            return SUBSTRING
+        if query in self.search_synonyms[position]:
+            return SYNONYM
+        return None
+
+    def search(self, query: str, limit: int = HPO_SEARCH_LIMIT) -> List[Dict[str, str]]:
+        """
+        Return the terms matching the query, prefix matches first.
+        Queries starting with HP: are matched against the term ids.
+        """
+        query = query.lower()
+        matches: List[Tuple[int, int, str, int]] = []
+        if query.startswith("hp:") and len(query) >= 4:
+            for position, hpo_id in enumerate(self.search_ids):
+                if hpo_id.startswith(query):
+                    matches.append((LABEL_PREFIX, 0, hpo_id, position))
+                elif query in hpo_id:
+                    matches.append((SUBSTRING, 0, hpo_id, position))
+        else:
+            for position in self.candidates(query):
+                rank = self.label_rank(position, query)
+                if rank is not None:
+                    label = self.search_labels[position]
+                    matches.append((rank, len(label), label, position))
+
+        return [
+            {"hpo_id": self.ids[m[3]], "label": self.labels[m[3]]}
+            for m in heapq.nsmallest(limit, matches)
+        ]
+
+    def position(self, hpo_id: str) -> Optional[int]:
+        return self.id_position.get(hpo_id)
+
+    def walk(
+        self,
+        position: int,
+        offsets: np.ndarray,
+        neighbours: np.ndarray,
+        max_depth: Optional[int] = None,
+    ) -> Dict[int, int]:
+        """
+        Breadth first visit of the ontology from the given term.
+        Returns the reached terms (the starting one excluded) with their
+        minimum distance from the starting term
+        """
+        distances: Dict[int, int] = {position: 0}
+        queue = deque([position])
+        while queue:
+            current = queue.popleft()
+            depth = distances[current] + 1
+            if max_depth is not None and depth > max_depth:
+                continue
+            start, end = offsets[current], offsets[current + 1]
+            for neighbour in neighbours[start:end].tolist():
+                if neighbour not in distances:
+                    distances[neighbour] = depth
+                    queue.append(neighbour)
+        del distances[position]
+        return distances
+
+    def ancestors(
+        self, position: int, max_depth: Optional[int] = None
+    ) -> Dict[int, int]:
+        return self.walk(position, self.parents_offsets, self.parents, max_depth)
+
+    def descendants(
+        self, position: int, max_depth: Optional[int] = None
+    ) -> Dict[int, int]:
+        return self.walk(position, self.children_offsets, self.children, max_depth)
+
+    def common_ancestors(self, first: int, second: int) -> List[int]:
+        """
+        Return the lowest common ancestors of two terms, i.e. the common
+        ancestors (the terms themselves included) that are not an ancestor
+        of another common ancestor. In a DAG they can be more than one.
+        """
+        common = (set(self.ancestors(first)) | {first}) & (
+            set(self.ancestors(second)) | {second}
+        )
+        not_lowest: Set[int] = set()
+        for position in common:
+            not_lowest.update(self.ancestors(position))
+        return sorted(common - not_lowest)
+
+    def similarities(self, query: List[int]) -> np.ndarray:
+        """
+        Return the matrix of the Resnik similarities between the query terms
+        (rows) and every term of the ontology (columns), i.e. the maximum
+        information content of their common ancestors
+        """
+        scores = np.zeros((len(query), len(self.ids)), dtype=np.float32)
+        for row, position in enumerate(query):
+            start, end = self.closure_offsets[position : position + 2]
+            subsumers = np.append(self.closure[start:end], position)
+            # less informative first, so that the most specific one prevails
+            subsumers = subsumers[np.argsort(self.information_content[subsumers])]
+            for subsumer in subsumers.tolist():
+                start, end = self.descendants_offsets[subsumer : subsumer + 2]
+                ic = self.information_content[subsumer]
+                scores[row, self.all_descendants[start:end]] = ic
+                scores[row, subsumer] = ic
+        return scores
+
+    def best_match_average(
+        self, query: List[int], profiles: List[List[int]]
+    ) -> np.ndarray:
+        """
+        Score each profile against the query with the best-match average of
+        the Resnik similarities. Query and profiles must not be empty.
+        """
+        scores = self.similarities(query)
+        terms = np.fromiter(
+            (t for profile in profiles for t in profile), dtype=np.int32
+        )
+        lengths = np.array([len(profile) for profile in profiles])
+        offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+
+        # best match of each query term in each profile, averaged on the query
+        query_best = np.maximum.reduceat(scores[:, terms], offsets, axis=1)
+        query_to_profile = query_best.mean(axis=0)
+        # best match of each profile term in the query, averaged on the profile
+        profile_best = scores.max(axis=0)[terms]
+        profile_to_query = np.add.reduceat(profile_best, offsets) / lengths
+
+        return (query_to_profile + profile_to_query) / 2
+
+    def term(self, position: int, distance: Optional[int] = None) -> Dict[str, Any]:
+        data: Dict[str, Any] = {
+            "hpo_id": self.ids[position],
+            "label": self.labels[position],
+        }
+        if distance is not None:
+            data["distance"] = distance
+        return data
+
+    def terms(self, distances: Dict[int, int]) -> List[Dict[str, Any]]:
+        return [
+            self.term(position, distance)
+            for position, distance in sorted(
+                distances.items(), key=lambda item: (item[1], self.ids[item[0]])
+            )
+        ]
+
+
+_lock = Lock()
+_index: Optional[HPOIndex] = None
+_expiration: float = 0.0
+
+
+def get_hpo_index() -> HPOIndex:
+    global _index, _expiration
+
+    with _lock:
+        if _index is None or time.monotonic() >= _expiration:
+            graph = neo4j.get_instance()
+            _index = HPOIndex(
+                graph.cypher(HPO_TERMS_QUERY), graph.cypher(HPO_EDGES_QUERY)
+            )
+            _expiration = time.monotonic() + HPO_CACHE_TTL
+        return _index
+
+
+def invalidate_hpo_index() -> None:
+    global _index
+
+    with _lock:
+        _index = None
@@ -0,0 +1,75 @@
+"""
+Process-level cache of the registered analysis results.
+
+Results are registered as File nodes (path, size, kind and mtime) when the
+pipeline completes a dataset, so downloads and size queries resolve them
+with an indexed lookup instead of listing the output directories on the
+shared filesystem. The results of the most recently used datasets are kept
+in memory for RESULTS_CACHE_TTL seconds, registrations of this process
+invalidate them immediately.
+"""
+
+import time
+from collections import OrderedDict
+from pathlib import Path
+from threading import Lock
+from typing import Any, Dict, NamedTuple, Optional, Tuple
+
+from restapi.connectors import neo4j
+
+RESULTS_CACHE_SIZE = 1024
+# results registered by other processes are seen at most after the TTL
+RESULTS_CACHE_TTL = 300
+
+RESULTS_QUERY = """
+MATCH (:Dataset {uuid: $dataset_uuid})-[:HAS_RESULT]->(f:File)
+RETURN f.kind, f.path, f.size, f.mtime
+"""
+
+
+class Result(NamedTuple):
+    path: Path
+    size: int
+    mtime: Optional[float]
+
+
+_lock = Lock()
+# dataset uuid => expiration and results by kind
+_results: "OrderedDict[str, Tuple[float, Dict[str, Result]]]" = OrderedDict()
+
+
+def get_results(dataset_uuid: str) -> Dict[str, Result]:
+    now = time.monotonic()
+    with _lock:
+        cached = _results.get(dataset_uuid)
+        if cached and now < cached[0]:
+            _results.move_to_end(dataset_uuid)
+            return cached[1]
+
+    graph = neo4j.get_instance()
+    params: Dict[str, Any] = {"dataset_uuid": dataset_uuid}
+    results: Dict[str, Result] = {}
+    for kind, path, size, mtime in graph.cypher(RESULTS_QUERY, **params):
+        # a single result of each kind is expected
+        results.setdefault(kind, Result(Path(path), size or 0, mtime))
+
+    # datasets without results could be registered at any time
+    if results:
+        with _lock:
+            _results[dataset_uuid] = (now + RESULTS_CACHE_TTL, results)
+            _results.move_to_end(dataset_uuid)
+            while len(_results) > RESULTS_CACHE_SIZE:
+                _results.popitem(last=False)
+    return results
+
+
+def get_result(dataset_uuid: str, kind: str) -> Optional[Result]:
+    return get_results(dataset_uuid).get(kind)
+
+
+def invalidate_results(dataset_uuid: Optional[str] = None) -> None:
+    with _lock:
+        if dataset_uuid is None:
+            _results.clear()
+        else:
+            _results.pop(dataset_uuid, None)
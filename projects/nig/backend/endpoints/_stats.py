@@ -0,0 +1,73 @@
+"""
+Materialized repository statistics.
+
+Counters are stored per group in Stats nodes, keyed by the group uuid, and
+are incremented in the same transaction of the endpoints creating or
+deleting studies, datasets and files. The full recount in
+nig.endpoints.stats.recount_stats corrects any drift and is run by the
+pipeline tasks and periodically by scripts/refresh_stats.py.
+"""
+
+from typing import Any, Dict, List
+
+from restapi.connectors import neo4j
+
+STATS_COUNTERS = [
+    "studies",
+    "datasets",
+    "files",
+    "datasets_with_vcf",
+    "datasets_with_gvcf",
+]
+
+UPDATE_STATS_QUERY = """
+MERGE (s:Stats {group_uuid: $group_uuid})
+SET """ + ", ".join(f"s.{c} = coalesce(s.{c}, 0) + ${c}" for c in STATS_COUNTERS)
+
+
+def dataset_counters(
+    files: List[Any], results: List[Any], has_phenotype: bool
+) -> Dict[str, int]:
+    """
+    Return the counters a dataset contributes to, given its uploaded files
+    and its analysis results
+    """
+    kinds = {f.kind for f in files} | {f.kind for f in results}
+    return {
+        "files": len(files),
+        "datasets_with_vcf": int(has_phenotype and "vcf" in kinds),
+        "datasets_with_gvcf": int("gvcf" in kinds),
+    }
+
+
+def update_stats(group_uuid: str, **deltas: int) -> None:
+    graph = neo4j.get_instance()
+    params: Dict[str, Any] = {c: deltas.get(c, 0) for c in STATS_COUNTERS}
+    if any(params.values()):
+        graph.cypher(UPDATE_STATS_QUERY, group_uuid=group_uuid, **params)
+
+
+def remove_dataset_stats(group_uuid: str, dataset: Any) -> None:
+    """
+    Decrement the counters of a dataset that is going to be deleted
+    """
+    counters = dataset_counters(
+        dataset.files.all(),
+        dataset.results.all(),
+        dataset.phenotype.single() is not None,
+    )
+    update_stats(group_uuid, datasets=-1, **{c: -v for c, v in counters.items()})
+
+
+def remove_file_stats(group_uuid: str, dataset: Any, file_uuid: str) -> None:
+    """
+    Decrement the counters of an uploaded file that is going to be deleted
+    """
+    has_phenotype = dataset.phenotype.single() is not None
+    files = dataset.files.all()
+    results = dataset.results.all()
+    before = dataset_counters(files, results, has_phenotype)
+    after = dataset_counters(
+        [f for f in files if f.uuid != file_uuid], results, has_phenotype
+    )
+    update_stats(group_uuid, **{c: after[c] - before[c] for c in before})
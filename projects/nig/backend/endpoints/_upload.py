@@ -0,0 +1,337 @@
+"""
+Chunked upload of the dataset files, with chunks accepted in any order and
+a running checksum.
+
+Each chunk is written at its offset and the received byte ranges are stored
+on redis, so that chunks can be sent on parallel connections and a client can
+ask which ranges are missing to resume an interrupted upload.
+
+The MD5 and SHA-256 of each upload are computed while the chunks are received.
+hashlib objects cannot be serialized, so all the hashing of an upload is done
+by a single hasher: a thread started by the first process receiving a chunk,
+that records itself on redis with a key refreshed while it is alive. Every
+process writing a chunk signals it to the hasher, that hashes the contiguous
+prefix of the received data as it grows, reading back the bytes just written
+(usually still in the page cache). When the end of the file is reached the
+checksums are stored on redis, where the process completing the upload waits
+for them, whatever process it is: the file is not read again at completion.
+
+The hashed bytes are read again only if the hasher is lost, i.e. when its
+process is restarted or the upload is idle for HASHER_IDLE_TIMEOUT seconds,
+or if a chunk already hashed is sent again: the next chunk, or the
+completion, starts a new hasher from the beginning of the file.
+"""
+
+import hashlib
+import os
+import time
+from pathlib import Path
+from threading import Thread
+from typing import IO, Any, Dict, Iterable, List, Optional, Tuple
+from uuid import uuid4
+
+from redis.exceptions import WatchError
+from restapi.connectors import redis
+from restapi.exceptions import BadRequest, ServiceUnavailable
+from restapi.utilities.logs import log
+
+UPLOAD_CHUNK_SIZE = 1048576
+# the received ranges of an interrupted upload are kept for 30 days
+UPLOAD_RANGES_TTL = 30 * 86400
+
+RANGES_KEY = "nig:upload:{}:ranges"
+COMPLETION_KEY = "nig:upload:{}:completion"
+# token of the running hasher, expiring if not refreshed
+HASHER_KEY = "nig:upload:{}:hasher"
+# set when bytes that could have been hashed are written again
+RESET_KEY = "nig:upload:{}:reset"
+# signals the chunks received to the hasher
+NOTIFY_KEY = "nig:upload:{}:notify"
+CHECKSUMS_KEY = "nig:upload:{}:checksums"
+
+HASHER_TTL = 30
+# seconds waited by the hasher for a new chunk before refreshing its key
+HASHER_POLL = 5
+# the hasher of an upload not receiving chunks is stopped
+HASHER_IDLE_TIMEOUT = 3600
+# seconds waited for the hasher at completion
+CHECKSUM_WAIT = 60
+
+CHECKSUM_ALGORITHMS = ("md5", "sha256")
+
+# start included, stop excluded
+ByteRange = Tuple[int, int]
+
+
+class Checksum:
+    def __init__(self) -> None:
+        self.offset = 0
+        self.hashes = {a: hashlib.new(a) for a in CHECKSUM_ALGORITHMS}
+
+    def update(self, data: bytes) -> None:
+        for h in self.hashes.values():
+            h.update(data)
+        self.offset += len(data)
+
+    def catch_up(self, path: Path, offset: int) -> None:
+        """
+        Hash the bytes already written from the current offset to the given one
+        """
+        with open(path, "rb") as f:
+            f.seek(self.offset)
+            while self.offset < offset:
+                data = f.read(min(UPLOAD_CHUNK_SIZE, offset - self.offset))
+                if not data:  # pragma: no cover
+                    break
+                self.update(data)
+
+    def hexdigests(self) -> Dict[str, str]:
+        return {a: h.hexdigest() for a, h in self.hashes.items()}
+
+
+def merge_ranges(ranges: Iterable[ByteRange]) -> List[ByteRange]:
+    merged: List[ByteRange] = []
+    for start, stop in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    return merged
+
+
+def missing_ranges(received: List[ByteRange], size: int) -> List[ByteRange]:
+    """
+    Return the ranges not yet received, given the merged received ranges
+    """
+    missing: List[ByteRange] = []
+    offset = 0
+    for start, stop in received:
+        if start > offset:
+            missing.append((offset, start))
+        offset = max(offset, stop)
+    if offset < size:
+        missing.append((offset, size))
+    return missing
+
+
+def read_received_ranges(r: Any, upload_id: str) -> List[ByteRange]:
+    ranges = []
+    for member in r.smembers(RANGES_KEY.format(upload_id)):
+        start, stop = member.decode().split("-")
+        ranges.append((int(start), int(stop)))
+    return merge_ranges(ranges)
+
+
+def get_received_ranges(upload_id: str) -> List[ByteRange]:
+    return read_received_ranges(redis.get_instance().r, upload_id)
+
+
+def add_received_range(upload_id: str, start: int, stop: int) -> List[ByteRange]:
+    """
+    Store a received range and return all the received ranges merged
+    """
+    r = redis.get_instance().r
+    key = RANGES_KEY.format(upload_id)
+    pipe = r.pipeline()
+    pipe.sadd(key, f"{start}-{stop}")
+    pipe.expire(key, UPLOAD_RANGES_TTL)
+    pipe.execute()
+    return get_received_ranges(upload_id)
+
+
+def claim_completion(upload_id: str) -> bool:
+    """
+    Return True only to the first request completing the upload,
+    when the last chunks are received by concurrent requests
+    """
+    r = redis.get_instance().r
+    return bool(r.set(COMPLETION_KEY.format(upload_id), 1, nx=True, ex=3600))
+
+
+def release_completion(upload_id: str) -> None:
+    # the completion failed and can be retried
+    r = redis.get_instance().r
+    r.delete(COMPLETION_KEY.format(upload_id))
+
+
+def is_completed(received: List[ByteRange], size: int) -> bool:
+    # an empty file is completed without receiving any chunk
+    return not missing_ranges(received, size)
+
+
+def clear_upload(upload_id: str) -> None:
+    r = redis.get_instance().r
+    # the hasher stops when its key is removed
+    r.delete(
+        RANGES_KEY.format(upload_id),
+        COMPLETION_KEY.format(upload_id),
+        HASHER_KEY.format(upload_id),
+        RESET_KEY.format(upload_id),
+        NOTIFY_KEY.format(upload_id),
+        CHECKSUMS_KEY.format(upload_id),
+    )
+
+
+def contiguous_end(received: List[ByteRange]) -> int:
+    if received and received[0][0] == 0:
+        return received[0][1]
+    return 0
+
+
+def store_checksums(r: Any, upload_id: str, checksum: Checksum) -> bool:
+    """
+    Store the checksums, unless hashed bytes have been written again
+    since the hasher checked the reset flag
+    """
+    reset_key = RESET_KEY.format(upload_id)
+    key = CHECKSUMS_KEY.format(upload_id)
+    with r.pipeline() as pipe:
+        try:
+            pipe.watch(reset_key)
+            if pipe.exists(reset_key):
+                return False
+            pipe.multi()
+            pipe.hset(key, mapping=checksum.hexdigests())
+            pipe.expire(key, UPLOAD_RANGES_TTL)
+            pipe.execute()
+        except WatchError:
+            return False
+    return True
+
+
+def run_hasher(upload_id: str, path: Path, size: int, token: str) -> None:
+    """
+    Hash the contiguous prefix of the received data as it grows, until the
+    end of the file is reached or the hasher is replaced or stopped
+    """
+    r = redis.get_instance().r
+    hasher_key = HASHER_KEY.format(upload_id)
+    reset_key = RESET_KEY.format(upload_id)
+    notify_key = NOTIFY_KEY.format(upload_id)
+
+    checksum = Checksum()
+    last_progress = time.monotonic()
+    try:
+        while r.get(hasher_key) == token.encode():
+            r.expire(hasher_key, HASHER_TTL)
+            if r.delete(reset_key):
+                # the hashed bytes could be changed
+                checksum = Checksum()
+
+            end = contiguous_end(read_received_ranges(r, upload_id))
+            if end > checksum.offset:
+                checksum.catch_up(path, end)
+                last_progress = time.monotonic()
+
+            if checksum.offset == size and store_checksums(r, upload_id, checksum):
+                break
+            if time.monotonic() - last_progress > HASHER_IDLE_TIMEOUT:
+                break
+            if r.blpop(notify_key, timeout=HASHER_POLL):
+                # the ranges are read again, the pending signals are useless
+                r.delete(notify_key)
+    except Exception as e:  # pragma: no cover
+        log.error("Failed to hash the upload {}: {}", upload_id, e)
+    finally:
+        if r.get(hasher_key) == token.encode():
+            r.delete(hasher_key)
+
+
+def start_hasher(upload_id: str, path: Path, size: int) -> None:
+    """
+    Start the hasher of the upload in this process, if not running elsewhere
+    """
+    r = redis.get_instance().r
+    token = uuid4().hex
+    if r.set(HASHER_KEY.format(upload_id), token, nx=True, ex=HASHER_TTL):
+        Thread(
+            target=run_hasher, args=(upload_id, path, size, token), daemon=True
+        ).start()
+
+
+def write_chunk(
+    upload_id: str, path: Path, stream: IO[bytes], start: int, stop: int, size: int
+) -> List[ByteRange]:
+    """
+    Write the chunk read from the stream at its offset and signal it to the
+    hasher of the upload. Returns the received ranges merged
+    """
+    if not path.exists():
+        raise ServiceUnavailable(
+            "Permission denied: the destination file does not exist"
+        )
+
+    # the hasher could have read the bytes of a range already received
+    resent = any(s < stop and start < e for s, e in get_received_ranges(upload_id))
+
+    try:
+        fd = os.open(path, os.O_WRONLY)
+    except PermissionError:
+        raise ServiceUnavailable("Permission denied: failed to write the file")
+    try:
+        offset = start
+        while offset < stop:
+            data = stream.read(min(UPLOAD_CHUNK_SIZE, stop - offset))
+            if not data:
+                break
+            os.pwrite(fd, data, offset)
+            offset += len(data)
+    finally:
+        os.close(fd)
+
+    if offset != stop or stream.read(1):
+        raise BadRequest("The chunk size does not correspond to the Content-Range")
+
+    r = redis.get_instance().r
+    if resent:
+        # the chunk is sent again, the hashed bytes could be changed
+        pipe = r.pipeline()
+        pipe.set(RESET_KEY.format(upload_id), 1, ex=UPLOAD_RANGES_TTL)
+        pipe.delete(CHECKSUMS_KEY.format(upload_id))
+        pipe.execute()
+
+    received = add_received_range(upload_id, start, stop)
+
+    notify_key = NOTIFY_KEY.format(upload_id)
+    pipe = r.pipeline()
+    pipe.rpush(notify_key, 1)
+    pipe.expire(notify_key, UPLOAD_RANGES_TTL)
+    pipe.execute()
+    start_hasher(upload_id, path, size)
+
+    return received
+
+
+def get_checksums(upload_id: str, path: Path, size: int) -> Dict[str, str]:
+    """
+    Return the checksums of a completed upload, waiting for the hasher to
+    reach the end of the file
+    """
+    r = redis.get_instance().r
+    key = CHECKSUMS_KEY.format(upload_id)
+    deadline = time.monotonic() + CHECKSUM_WAIT
+    while True:
+        stored = r.hgetall(key)
+        if len(stored) == len(CHECKSUM_ALGORITHMS):
+            return {a.decode(): h.decode() for a, h in stored.items()}
+        if time.monotonic() > deadline:
+            raise ServiceUnavailable(
+                "The checksums of the file are not available yet, please retry"
+            )
+        # e.g. an empty file or a hasher lost with its process
+        start_hasher(upload_id, path, size)
+        time.sleep(0.1)
+
+
+def verify_checksum(
+    checksums: Dict[str, str], expected: Dict[str, Optional[str]]
+) -> Optional[str]:
+    """
+    Compare the computed checksums with the expected ones, if any.
+    Returns the first algorithm that does not match
+    """
+    for algorithm in CHECKSUM_ALGORITHMS:
+        value = expected.get(algorithm)
+        if value and value.lower() != checksums[algorithm]:
+            return algorithm
+    return None
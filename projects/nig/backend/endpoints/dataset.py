@@ -1,23 +1,68 @@
 import shutil
 from datetime import datetime
-from typing import Any, Dict, Optional, Type, Union
+from typing import Any, Dict, List, Optional, Type, Union
 
 import pytz
-from nig.endpoints import PHENOTYPE_NOT_FOUND, TECHMETA_NOT_FOUND, NIGEndpoint
+from nig.endpoints import (
+    PHENOTYPE_NOT_FOUND,
+    READ_ACCESS_FILTER,
+    TECHMETA_NOT_FOUND,
+    ListQuery,
+    NIGEndpoint,
+    get_page,
+)
+from nig.endpoints._dataset_schema import get_dataset_schema
 from nig.endpoints._injectors import (
     verify_dataset_access,
     verify_dataset_status_update,
     verify_study_access,
 )
+from nig.endpoints._stats import remove_dataset_stats, update_stats
 from restapi import decorators
 from restapi.connectors import neo4j
 from restapi.customizer import FlaskRequest
 from restapi.exceptions import BadRequest, Conflict, NotFound
 from restapi.models import Schema, fields, validate
 from restapi.rest.definition import Response
-from restapi.services.authentication import User
+from restapi.services.authentication import Role, User
 from restapi.utilities.logs import log
 
+STATUS_UPDATE_FORMAT = "%d-%m-%Y, %H:%M"
+
+# phenotypes and technicals selectable in the dataset input schema
+STUDY_CHOICES_QUERY = """
+MATCH (s:Study {uuid: $study_uuid})
+RETURN
+    [(s)<-[:DEFINED_IN]-(p:Phenotype) | [p.uuid, p.name]],
+    [(s)<-[:DEFINED_IN]-(t:TechnicalMetadata) | [t.uuid, t.name]]
+"""
+DATASET_STUDY_QUERY = """
+MATCH (:Dataset {uuid: $dataset_uuid})<-[:CONTAINS]-(s:Study)
+RETURN s.uuid
+"""
+
+# All the columns of the dataset list are retrieved with a single query,
+# whatever the number of datasets in the study
+DATASET_LIST_MATCH = """
+MATCH (u:User {uuid: $user_uuid})
+MATCH (:Study {uuid: $study_uuid})-[:CONTAINS]->(n:Dataset)
+""" + READ_ACCESS_FILTER
+DATASET_LIST_PROJECTION = """n {
+    .uuid,
+    .name,
+    .description,
+    .status,
+    .error_message,
+    .joint_analysis,
+    .eta,
+    status_update: coalesce(n.status_update, n.modified),
+    technical: head([(n)-[:IS_DESCRIBED_BY]->(t:TechnicalMetadata) | t {.uuid, .name}]),
+    phenotype: head([(n)-[:IS_DESCRIBED_BY]->(p:Phenotype) | p {.uuid, .name}]),
+    files: size([(n)-[:CONTAINS]->(f:File) | f]),
+    readonly: readonly
+}"""
+DATASET_SORT_KEYS = {"created": "n.created", "name": "n.name", "status": "n.status"}
+
 
 class TechnicalMetadata(Schema):
     uuid = fields.Str(required=True)
@@ -38,6 +83,8 @@ class DatasetOutput(Schema):
     status_update = fields.Str(required=False)
     error_message = fields.Str(required=False)
     joint_analysis = fields.Bool(required=False)
+    # expected end of the analysis of a queued dataset
+    eta = fields.DateTime(required=False, allow_none=True)
     technical = fields.Neo4jRelationshipToSingle(TechnicalMetadata)
     phenotype = fields.Neo4jRelationshipToSingle(Phenotype)
     files = fields.Neo4jRelationshipToCount()
@@ -47,28 +94,39 @@ class DatasetOutput(Schema):
     # virtual files?
 
 
-def getInputSchema(request: FlaskRequest, is_post: bool) -> Type[Schema]:
-    graph = neo4j.get_instance()
+# Output schema of the dataset list, filled with an already aggregated projection
+class DatasetListOutput(DatasetOutput):
+    technical = fields.Nested(TechnicalMetadata, allow_none=True)
+    phenotype = fields.Nested(Phenotype, allow_none=True)
+    files = fields.Integer()
+
+
+class DatasetListQuery(ListQuery):
+    sort_by = fields.Str(
+        required=False,
+        load_default=None,
+        validate=validate.OneOf(list(DATASET_SORT_KEYS)),
+    )
+    status = fields.Str(required=False, metadata={"description": "Filter by status"})
+
+
+def build_input_schema(study_uuid: Optional[str], is_post: bool) -> Type[Schema]:
     # as defined in Marshmallow.schema.from_dict
     attributes: Dict[str, Union[fields.Field, type]] = {}
 
     attributes["name"] = fields.Str(required=is_post)
     attributes["description"] = fields.Str(required=is_post)
-    if request:
-        if is_post:
-            study_uuid = request.view_args["uuid"]
-            study = graph.Study.nodes.get_or_none(uuid=study_uuid)
-        else:
-            dataset_uuid = request.view_args["uuid"]
-            dataset = graph.Dataset.nodes.get_or_none(uuid=dataset_uuid)
-            study = dataset.parent_study.single()
+    if study_uuid:
+        graph = neo4j.get_instance()
 
-        phenotype_keys = []
-        phenotype_labels = []
+        phenotypes: List[List[str]] = []
+        technicals: List[List[str]] = []
+        for row in graph.cypher(STUDY_CHOICES_QUERY, study_uuid=study_uuid):
+            phenotypes = row[0]
+            technicals = row[1]
 
-        for p in study.phenotypes.all():
-            phenotype_keys.append(p.uuid)
-            phenotype_labels.append(p.name)
+        phenotype_keys = [p[0] for p in phenotypes]
+        phenotype_labels = [p[1] for p in phenotypes]
 
         if len(phenotype_keys) == 1:
             default_phenotype = phenotype_keys[0]
@@ -87,12 +145,8 @@ def getInputSchema(request: FlaskRequest, is_post: bool) -> Type[Schema]:
             validate=validate.OneOf(choices=phenotype_keys, labels=phenotype_labels),
         )
 
-        techmeta_keys = []
-        techmeta_labels = []
-
-        for t in study.technicals.all():
-            techmeta_keys.append(t.uuid)
-            techmeta_labels.append(t.name)
+        techmeta_keys = [t[0] for t in technicals]
+        techmeta_labels = [t[1] for t in technicals]
 
         if len(techmeta_keys) == 1:
             default_techmeta = techmeta_keys[0]
@@ -114,6 +168,27 @@ def getInputSchema(request: FlaskRequest, is_post: bool) -> Type[Schema]:
     return Schema.from_dict(attributes, name="DatasetDefinition")
 
 
+def getInputSchema(request: FlaskRequest, is_post: bool) -> Type[Schema]:
+    if not request:
+        return build_input_schema(None, is_post)
+
+    if is_post:
+        study_uuid = request.view_args["uuid"]
+    else:
+        graph = neo4j.get_instance()
+        study_uuid = None
+        for row in graph.cypher(
+            DATASET_STUDY_QUERY, dataset_uuid=request.view_args["uuid"]
+        ):
+            study_uuid = row[0]
+        if not study_uuid:
+            return build_input_schema(None, is_post)
+
+    return get_dataset_schema(
+        study_uuid, is_post, lambda: build_input_schema(study_uuid, is_post)
+    )
+
+
 def getPOSTInputSchema(request: FlaskRequest) -> Type[Schema]:
     return getInputSchema(request, True)
 
@@ -133,50 +208,63 @@ class Datasets(NIGEndpoint):
             200: "Dataset list successfully retrieved",
         },
     )
-    @decorators.marshal_with(DatasetOutput(many=True), code=200)
-    def get(self, uuid: str, user: User) -> Response:
+    @decorators.use_kwargs(DatasetListQuery, location="query")
+    @decorators.marshal_with(DatasetListOutput(many=True), code=200)
+    def get(
+        self,
+        uuid: str,
+        user: User,
+        sort_order: str,
+        size: int,
+        sort_by: Optional[str] = None,
+        cursor: Optional[str] = None,
+        name: Optional[str] = None,
+        status: Optional[str] = None,
+    ) -> Response:
 
         graph = neo4j.get_instance()
 
         study = graph.Study.nodes.get_or_none(uuid=uuid)
         self.verifyStudyAccess(study, user=user, read=True)
 
-        data = []
-        for dataset in study.datasets.all():
-
-            if not self.verifyDatasetAccess(
-                dataset, user=user, read=True, raiseError=False
-            ):
-                continue
-            dataset_el = {}
-            dataset_el["uuid"] = dataset.uuid
-            dataset_el["name"] = dataset.name
-            dataset_el["description"] = dataset.description
-            dataset_el["status"] = dataset.status
-            dataset_el["error_message"] = dataset.error_message
-            dataset_el["technical"] = dataset.technical
-            dataset_el["phenotype"] = dataset.phenotype
-            dataset_el["files"] = dataset.files
-            dataset_el["joint_analysis"] = dataset.joint_analysis
-
-            # check if the date of the status is available. If not get the dataset last modified date
-            if dataset.status_update:
-                status_update = dataset.status_update
-            else:
-                status_update = dataset.modified
-            dataset_el["status_update"] = status_update.strftime("%d-%m-%Y, %H:%M")
-
-            owner = dataset.ownership.single()
-            if owner == user:
-                dataset_el["readonly"] = False
-
-            for group in owner.belongs_to.all():
-                if group.members.is_connected(user):
-                    dataset_el["readonly"] = False
+        params: Dict[str, Any] = {
+            "user_uuid": user.uuid,
+            "study_uuid": study.uuid,
+            "admin_role": Role.ADMIN.value,
+        }
+        filters = []
+        if name:
+            filters.append("n.name STARTS WITH $name")
+            params["name"] = name
+        if status:
+            filters.append("n.status = $status")
+            params["status"] = status
+
+        rows, total, next_cursor = get_page(
+            DATASET_LIST_MATCH,
+            DATASET_LIST_PROJECTION,
+            DATASET_SORT_KEYS,
+            filters,
+            params,
+            size=size,
+            cursor=cursor,
+            sort_by=sort_by,
+            sort_order=sort_order,
+        )
 
+        data = []
+        for dataset_el in rows:
+            # status_update falls back to the dataset last modified date
+            # if the date of the status is not available
+            status_update = datetime.fromtimestamp(
+                dataset_el["status_update"], pytz.utc
+            )
+            dataset_el["status_update"] = status_update.strftime(STATUS_UPDATE_FORMAT)
+            if dataset_el["eta"]:
+                dataset_el["eta"] = datetime.fromtimestamp(dataset_el["eta"], pytz.utc)
             data.append(dataset_el)
 
-        return self.response(data)
+        return self.paginated_response(data, total, next_cursor)
 
 
 class Dataset(NIGEndpoint):
@@ -235,6 +323,7 @@ def post(
 
         dataset.ownership.connect(user)
         dataset.parent_study.connect(study)
+        update_stats(user.belongs_to.single().uuid, datasets=1)
         if phenotype:
             kwargs["phenotype"] = phenotype
             phenotype = study.phenotypes.get_or_none(uuid=phenotype)
@@ -400,8 +489,11 @@ def delete(self, uuid: str, user: User) -> Response:
         input_path = self.getPath(user=user, dataset=dataset)
         output_path = self.getPath(user=user, dataset=dataset, get_output_dir=True)
 
+        remove_dataset_stats(user.belongs_to.single().uuid, dataset)
         for f in dataset.files.all():
             f.delete()
+        for f in dataset.results.all():
+            f.delete()
 
         dataset.delete()
 
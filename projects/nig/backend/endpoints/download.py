@@ -1,21 +1,72 @@
+import re
 from pathlib import Path
-from typing import Optional
+from typing import Any, Dict, List, Optional, Set
 
-from flask import send_from_directory
-from nig.endpoints import FILE_NOT_FOUND, NIGEndpoint
+from flask import Response as FlaskResponse
+from flask import stream_with_context
+from nig.endpoints import FILE_NOT_FOUND, Dataset, NIGEndpoint
+from nig.endpoints._archive import ARCHIVE_FORMATS, ArchiveEntry, archive_stream
+from nig.endpoints._download import region_commands, send_file_ranges, stream_region
+from nig.endpoints._results import Result, get_result, invalidate_results
 from restapi import decorators
 from restapi.connectors import neo4j
-from restapi.exceptions import NotFound
+from restapi.exceptions import BadRequest, NotFound
 from restapi.models import fields, validate
 from restapi.rest.definition import Response
 from restapi.services.authentication import User
-from restapi.services.download import Downloader
 
 FILE_TO_DOWNLOAD = ["bam", "g.vcf"]
-RESOURCE_FOLDER = {"bam": "bwa", "g.vcf": "gatk_gvcf"}
+RESOURCE_KIND = {"bam": "bam", "g.vcf": "gvcf"}
 
+# indexed results that can be sliced by region, with the kind of their index
+REGION_INDEX = {"bam": "bai", "gvcf": "tbi"}
+REGION_MIMETYPE = {"bam": "application/octet-stream", "gvcf": "application/gzip"}
+REGION_EXTENSION = {"bam": "bam", "gvcf": "g.vcf.gz"}
+# chr:start-end, coordinates are 1-based and can contain thousands separators,
+# the contig cannot start with a dash not to be parsed as an option
+REGION_PATTERN = (
+    r"^[A-Za-z0-9_.*+|][A-Za-z0-9_.*+|-]*(?::([0-9][0-9,]*)(?:-([0-9][0-9,]*))?)?$"
+)
 
-class ResultDownload(NIGEndpoint):
+STUDY_RESULTS_QUERY = """
+MATCH (:Study {uuid: $study_uuid})-[:CONTAINS]->(d:Dataset {status: "COMPLETED"})
+WHERE $dataset_uuids IS NULL OR d.uuid IN $dataset_uuids
+MATCH (d)-[:HAS_RESULT]->(f:File)
+WHERE f.kind IN $kinds
+RETURN d.uuid, d.name, f.name, f.path
+ORDER BY d.name, d.uuid, f.name
+"""
+
+
+class ResultEndpoint(NIGEndpoint):
+    def get_completed_dataset(self, uuid: str, user: User) -> Dataset:
+        # check dataset ownership
+        graph = neo4j.get_instance()
+        dataset = graph.Dataset.nodes.get_or_none(uuid=uuid)
+        self.verifyDatasetAccess(dataset, user=user, read=False)
+
+        study = dataset.parent_study.single()
+
+        self.verifyStudyAccess(study, user=user, error_type="Dataset", read=True)
+
+        # check if the analysis is completed
+        if dataset.status != "COMPLETED":
+            raise NotFound(
+                "Results non found: The dataset analysis has not been completed"
+            )
+        return dataset
+
+    @staticmethod
+    def get_result(dataset: Any, kind: str) -> Result:
+        # the results are registered by the pipeline and, for the datasets
+        # analysed before the registration, by the consistency check
+        result = get_result(dataset.uuid, kind)
+        if result is None:
+            raise NotFound(f"{kind} file for dataset {dataset.uuid} not found")
+        return result
+
+
+class ResultDownload(ResultEndpoint):
 
     labels = ["download"]
 
@@ -32,56 +83,215 @@ class ResultDownload(NIGEndpoint):
     @decorators.endpoint(
         path="dataset/<uuid>/download",
         summary="Download analysis results",
-        responses={200: "Found the file to download", 404: "File not found"},
+        responses={
+            200: "Found the file to download",
+            206: "Requested ranges of the file to download",
+            404: "File not found",
+            416: "Requested ranges not satisfiable",
+        },
     )
     # 200: {'schema': {'$ref': '#/definitions/Fileoutput'}}
     def get(
         self, uuid: str, user: User, file: str, get_total_size: bool = False
     ) -> Response:
 
-        # check dataset ownership
-        graph = neo4j.get_instance()
-        dataset = graph.Dataset.nodes.get_or_none(uuid=uuid)
-        self.verifyDatasetAccess(dataset, user=user, read=False)
+        dataset = self.get_completed_dataset(uuid, user)
 
-        study = dataset.parent_study.single()
+        result = self.get_result(dataset, RESOURCE_KIND[file])
 
-        self.verifyStudyAccess(study, user=user, error_type="Dataset", read=True)
+        if get_total_size:
+            # return the registered size of the file to download
+            return self.response(result.size)
 
-        # check if the analysis is completed
-        if dataset.status != "COMPLETED":
-            raise NotFound(
-                "Results non found: The dataset analysis has not been completed"
-            )
+        try:
+            # download the file, or the requested byte ranges, as a response attachment
+            response = send_file_ranges(result.path)
+        except FileNotFoundError:
+            # the registry is out of date, fixed by the next consistency check
+            invalidate_results(dataset.uuid)
+            raise NotFound(f"file .{file} for dataset {dataset.uuid} not found")
 
-        # get the file location
-        dataset_output_dir = self.getPath(
-            user=user, dataset=dataset, get_output_dir=True
+        # save the action in the log event
+        self.log_event(
+            self.events.access, dataset, {"downloaded_file": str(result.path)}
         )
+        return response
 
-        resource_dir = Path(dataset_output_dir, RESOURCE_FOLDER[file])
 
-        # check if the output dir exists and if it is not empty
-        if not resource_dir.is_dir():
-            raise NotFound("Directory for dataset output not found")
+class ResultRegion(ResultEndpoint):
 
-        filepath: Optional[Path] = None
-        for f in resource_dir.iterdir():
-            if f.suffix == f".{file}" or f.name.endswith(f".{file}.gz"):
-                filepath = f
-                break
+    labels = ["download"]
 
-        if not filepath:
-            raise NotFound(f"file .{file} for dataset {uuid} not found")
+    @decorators.auth.require(allow_access_token_parameter=True)
+    @decorators.use_kwargs(
+        {
+            "region": fields.Str(
+                required=True,
+                validate=validate.Regexp(REGION_PATTERN),
+                metadata={"description": "Genomic region, e.g. chr1:10000-20000"},
+            ),
+        },
+        location="query",
+    )
+    @decorators.endpoint(
+        path="dataset/<uuid>/results/<kind>",
+        summary="Download a region of an indexed analysis result",
+        responses={
+            200: "Region of the result (BAM or bgzipped g.vcf)",
+            400: "Invalid region",
+            404: "Result or index not found",
+        },
+    )
+    def get(self, uuid: str, kind: str, user: User, region: str) -> Response:
 
-        if get_total_size:
-            # return the total size of the file to download
-            total_size = filepath.stat().st_size
-            return self.response(total_size)
+        if kind not in REGION_INDEX:
+            raise NotFound(f"Results of kind {kind} cannot be sliced by region")
+
+        coordinates = re.match(REGION_PATTERN, region)
+        if coordinates:
+            start, end = coordinates.groups()
+            if (
+                start
+                and end
+                and int(start.replace(",", "")) > int(end.replace(",", ""))
+            ):
+                raise BadRequest("Invalid region: the start is greater than the end")
+
+        dataset = self.get_completed_dataset(uuid, user)
+
+        filepath = self.get_result(dataset, kind).path
+        index = self.get_result(dataset, REGION_INDEX[kind]).path
+
+        # only the blocks of the region are read, through the index
+        blocks = stream_region(region_commands(kind, filepath, index, region))
+
+        self.log_event(
+            self.events.access,
+            dataset,
+            {"downloaded_file": str(filepath), "region": region},
+        )
+
+        region_name = re.sub(r"[^A-Za-z0-9_.]", "_", region)
+        sample = filepath.name.split(".")[0]
+        response = FlaskResponse(
+            stream_with_context(blocks), mimetype=REGION_MIMETYPE[kind]
+        )
+        response.headers["Content-Disposition"] = (
+            f"attachment; filename={sample}_{region_name}.{REGION_EXTENSION[kind]}"
+        )
+        return response
+
+
+class StudyResultsDownload(ResultEndpoint):
+
+    labels = ["download"]
+
+    @decorators.auth.require(allow_access_token_parameter=True)
+    @decorators.use_kwargs(
+        {
+            "file": fields.Str(
+                required=True, validate=validate.OneOf(FILE_TO_DOWNLOAD)
+            ),
+            "datasets": fields.DelimitedList(
+                fields.Str(),
+                required=False,
+                metadata={"description": "Datasets to download, all if missing"},
+            ),
+            "index": fields.Bool(
+                required=False,
+                metadata={"description": "Include the .bai/.tbi index files"},
+            ),
+            "archive": fields.Str(
+                required=False, validate=validate.OneOf(list(ARCHIVE_FORMATS))
+            ),
+        },
+        location="query",
+    )
+    @decorators.endpoint(
+        path="study/<uuid>/download",
+        summary="Download the analysis results of a study as a single archive",
+        responses={
+            200: "ZIP or TAR archive of the results, with a MD5SUMS manifest",
+            404: "Study, datasets or results not found",
+        },
+    )
+    def get(
+        self,
+        uuid: str,
+        user: User,
+        file: str,
+        datasets: Optional[List[str]] = None,
+        index: bool = False,
+        archive: str = "zip",
+    ) -> Response:
+
+        graph = neo4j.get_instance()
+        study = graph.Study.nodes.get_or_none(uuid=uuid)
+        self.verifyStudyAccess(study, user=user, read=True)
+
+        kinds = [RESOURCE_KIND[file]]
+        if index:
+            kinds.append(REGION_INDEX[RESOURCE_KIND[file]])
+
+        params: Dict[str, Any] = {
+            "study_uuid": uuid,
+            "dataset_uuids": datasets or None,
+            "kinds": kinds,
+        }
+        rows = list(graph.cypher(STUDY_RESULTS_QUERY, **params))
+
+        # the dataset access is verified once for all the datasets
+        access_map = self.getAccessMap("Dataset", [row[0] for row in rows], user)
+        allowed = {u for u, access in access_map.items() if access.allows()}
+
+        missing = set(datasets or []) - allowed
+        if missing:
+            raise NotFound(
+                f"Results not found for the datasets: {', '.join(sorted(missing))}"
+            )
+
+        entries: List[ArchiveEntry] = []
+        folders: Dict[str, str] = {}
+        used: Set[str] = set()
+        for dataset_uuid, dataset_name, filename, path in rows:
+            if dataset_uuid not in allowed:
+                continue
+            if dataset_uuid not in folders:
+                # datasets with the same name are distinguished by their uuid
+                folder = safe_name(dataset_name)
+                if folder in used:
+                    folder = f"{folder}_{dataset_uuid}"
+                used.add(folder)
+                folders[dataset_uuid] = folder
+            entries.append(
+                ArchiveEntry(f"{folders[dataset_uuid]}/{filename}", Path(path))
+            )
+
+        if not entries:
+            raise NotFound(f"No .{file} results found for study {uuid}")
+
+        self.log_event(
+            self.events.access,
+            study,
+            {"downloaded_files": len(entries), "datasets": len(folders)},
+        )
+
+        study_name = safe_name(study.name)
+        response = FlaskResponse(
+            stream_with_context(archive_stream(entries, archive)),
+            mimetype=ARCHIVE_FORMATS[archive],
+        )
+        response.headers["Content-Disposition"] = (
+            f"attachment; filename={study_name}_{RESOURCE_KIND[file]}.{archive}"
+        )
+        return response
 
-        # save the action in the log event
-        self.log_event(self.events.access, dataset, {"downloaded_file": str(filepath)})
 
-        # download the file as a response attachment
-        # return send_from_directory(resource_dir, filepath.name, as_attachment=True)
-        return Downloader.send_file_streamed(filepath.name, subfolder=resource_dir)
+def safe_name(name: str) -> str:
+    """
+    Name usable as a file or folder name, without separators or dot-only names
+    """
+    name = re.sub(r"[^A-Za-z0-9_.-]", "_", name)
+    if not name.strip("."):
+        name = name.replace(".", "_")
+    return name
@@ -1,18 +1,46 @@
 import gzip
 import re
 from pathlib import Path
-from typing import Any, Tuple
-
-from nig.endpoints import FILE_NOT_FOUND, NIGEndpoint
+from typing import Any, Dict, Optional, Tuple
+
+from flask import request
+from nig.endpoints import (
+    FILE_NOT_FOUND,
+    Dataset,
+    File,
+    ListQuery,
+    NIGEndpoint,
+    get_page,
+)
+from nig.endpoints._files import get_file_kind
+from nig.endpoints._stats import remove_file_stats, update_stats
+from nig.endpoints._upload import (
+    CHECKSUM_ALGORITHMS,
+    claim_completion,
+    clear_upload,
+    contiguous_end,
+    get_checksums,
+    get_received_ranges,
+    is_completed,
+    missing_ranges,
+    release_completion,
+    verify_checksum,
+    write_chunk,
+)
 from restapi import decorators
-from restapi.connectors import neo4j
+from restapi.connectors import celery, neo4j
 from restapi.decorators import ChunkUpload
-from restapi.exceptions import BadRequest, NotFound, ServerError
-from restapi.models import Schema, fields
+from restapi.exceptions import BadRequest, Conflict, NotFound, ServerError
+from restapi.models import Schema, fields, validate
 from restapi.rest.definition import Response
 from restapi.services.authentication import User
-from restapi.services.uploader import Uploader
+from restapi.services.uploader import DEFAULT_PERMISSIONS, Uploader
 from restapi.utilities.logs import log
+from werkzeug.http import parse_content_range_header
+from werkzeug.utils import secure_filename
+
+FILE_LIST_MATCH = "MATCH (:Dataset {uuid: $dataset_uuid})-[:CONTAINS]->(n:File)"
+FILE_SORT_KEYS = {"name": "n.name", "size": "n.size", "status": "n.status"}
 
 
 class FileOutput(Schema):
@@ -21,11 +49,47 @@ class FileOutput(Schema):
     type = fields.Str(required=False)
     size = fields.Integer(required=False)
     status = fields.Str(required=False)
-    # metadata?
+    metadata = fields.Dict(required=False)
+    md5 = fields.Str(required=False)
+    sha256 = fields.Str(required=False)
+
+
+class FileListQuery(ListQuery):
+    sort_by = fields.Str(
+        required=False,
+        load_default=None,
+        validate=validate.OneOf(list(FILE_SORT_KEYS)),
+    )
+    status = fields.Str(required=False, metadata={"description": "Filter by status"})
+
+
+class UploadStatus(Schema):
+    uuid = fields.Str(required=True)
+    size = fields.Integer(required=True)
+    status = fields.Str(required=True)
+    received = fields.Integer(required=True)
+    # start included, stop excluded
+    missing = fields.List(fields.Tuple((fields.Integer(), fields.Integer())))
 
 
 class ChunkUploadExtended(ChunkUpload):
     testing = fields.Bool(required=False)
+    md5 = fields.Str(
+        required=False,
+        validate=validate.Regexp(r"^[0-9a-fA-F]{32}$"),
+        metadata={"description": "MD5 checksum of the file"},
+    )
+    sha256 = fields.Str(
+        required=False,
+        validate=validate.Regexp(r"^[0-9a-fA-F]{64}$"),
+        metadata={"description": "SHA-256 checksum of the file"},
+    )
+    deep_validation = fields.Bool(
+        required=False,
+        metadata={
+            "description": "Validate the whole file content when the upload completes"
+        },
+    )
 
 
 class Files(NIGEndpoint):
@@ -41,8 +105,19 @@ class Files(NIGEndpoint):
             404: "This file cannot be found or you are not authorized to access",
         },
     )
+    @decorators.use_kwargs(FileListQuery, location="query")
     @decorators.marshal_with(FileOutput(many=True), code=200)
-    def get(self, uuid: str, user: User) -> Response:
+    def get(
+        self,
+        uuid: str,
+        user: User,
+        sort_order: str,
+        size: int,
+        sort_by: Optional[str] = None,
+        cursor: Optional[str] = None,
+        name: Optional[str] = None,
+        status: Optional[str] = None,
+    ) -> Response:
 
         graph = neo4j.get_instance()
         dataset = graph.Dataset.nodes.get_or_none(uuid=uuid)
@@ -52,26 +127,33 @@ def get(self, uuid: str, user: User) -> Response:
 
         self.verifyStudyAccess(study, user=user, error_type="Dataset", read=True)
 
-        path = self.getPath(user=user, dataset=dataset, read=True)
-
-        data = []
-
-        for file in dataset.files.all():
-            if not path.joinpath(file.name).exists():
-                file.status = "unknown"
-                file.save()
-            else:
-                # check if the status is correct
-                if file.status == "unknown":
-                    filepath = self.getPath(user=user, file=file, read=True)
-                    if filepath.stat().st_size != file.size:
-                        file.status = "importing"
-                    else:
-                        file.status = "uploaded"
-                    file.save()
-            data.append(file)
+        params: Dict[str, Any] = {"dataset_uuid": dataset.uuid}
+        filters = []
+        if name:
+            filters.append("n.name STARTS WITH $name")
+            params["name"] = name
+        if status:
+            filters.append("n.status = $status")
+            params["status"] = status
+
+        rows, total, next_cursor = get_page(
+            FILE_LIST_MATCH,
+            "n",
+            FILE_SORT_KEYS,
+            filters,
+            params,
+            size=size,
+            cursor=cursor,
+            sort_by=sort_by,
+            sort_order=sort_order,
+        )
+
+        # the status is not checked against the disk on read, it is reconciled
+        # by the check_consistency task: in place size changes and removed
+        # directories are only detected by its weekly full scan
+        data = [graph.File.inflate(row) for row in rows]
 
-        return self.response(data)
+        return self.paginated_response(data, total, next_cursor)
 
 
 class SingleFile(NIGEndpoint):
@@ -102,22 +184,7 @@ def get(self, uuid: str, user: User) -> Response:
         study = dataset.parent_study.single()
         self.verifyStudyAccess(study, user=user, error_type="File", read=True)
 
-        # check if file exists in the folder
-        path = self.getPath(user=user, dataset=dataset, read=True)
-
-        if not path.joinpath(file.name).exists():
-            file.status = "unknown"
-            file.save()
-        else:
-            # check if the status is correct
-            if file.status == "unknown":
-                filepath = self.getPath(user=user, file=file, read=True)
-                if filepath.stat().st_size != file.size:
-                    file.status = "importing"
-                else:
-                    file.status = "uploaded"
-                file.save()
-
+        # the status can be outdated until the next check_consistency scan
         self.log_event(self.events.access, file)
 
         return self.response(file)
@@ -145,6 +212,8 @@ def delete(self, uuid: str, user: User) -> Response:
         self.verifyStudyAccess(study, user=user, error_type="File")
         path = self.getPath(user=user, file=file)
 
+        remove_file_stats(user.belongs_to.single().uuid, dataset, file.uuid)
+        clear_upload(file.uuid)
         file.delete()
 
         if path.exists():
@@ -159,6 +228,50 @@ class FileUpload(Uploader, NIGEndpoint):
 
     labels = ["file"]
 
+    @staticmethod
+    def get_upload(dataset: Dataset, filename: str) -> File:
+        for f in dataset.files.all():
+            if f.name == filename:
+                return f
+        raise NotFound(FILE_NOT_FOUND)
+
+    @decorators.auth.require()
+    @decorators.endpoint(
+        path="/dataset/<uuid>/files/upload/<filename>",
+        summary="Obtain the ranges of a file still to be uploaded",
+        responses={
+            200: "Missing ranges successfully retrieved",
+            404: "File not found",
+        },
+    )
+    @decorators.marshal_with(UploadStatus, code=200)
+    def get(self, uuid: str, filename: str, user: User) -> Response:
+
+        graph = neo4j.get_instance()
+        # check permission
+        dataset = graph.Dataset.nodes.get_or_none(uuid=uuid)
+        self.verifyDatasetAccess(dataset, user=user)
+
+        study = dataset.parent_study.single()
+        self.verifyStudyAccess(study, user=user, error_type="Dataset")
+
+        file = self.get_upload(dataset, filename)
+
+        if file.status == "importing":
+            received = get_received_ranges(file.uuid)
+        else:
+            received = [(0, file.size)]
+
+        data = {
+            "uuid": file.uuid,
+            "size": file.size,
+            "status": file.status,
+            "received": sum(stop - start for start, stop in received),
+            "missing": missing_ranges(received, file.size),
+        }
+
+        return self.response(data)
+
     @decorators.auth.require()
     @decorators.endpoint(
         path="/dataset/<uuid>/files/upload/<filename>",
@@ -182,51 +295,121 @@ def put(self, uuid: str, filename: str, user: User) -> Response:
         self.verifyStudyAccess(study, user=user, error_type="Dataset")
 
         path = self.getPath(user=user, dataset=dataset)
-        completed, response = self.chunk_upload(Path(path), filename)
-        log.debug("check {}", response)
-        if completed:
-            # get the file
-            file = None
-            for f in dataset.files.all():
-                if f.name == filename:
-                    file = f
-            if not file:
-                raise NotFound(FILE_NOT_FOUND)
-
-            # check the final size
-            filepath = self.getPath(user=user, file=file)
-            filesize = filepath.stat().st_size
-            # check the final size
-            if filesize != file.size:
-                log.debug(
-                    "size expected: {},actual size: {}",
-                    file.size,
-                    filesize,
-                )
-                file.delete()
-                graph.db.commit()
-                filepath.unlink()
-                raise ServerError(
-                    "File has not been uploaded correctly: final size does not "
-                    "correspond to total size. Please try a new upload",
+        self.validate_upload_folder(path)
+
+        file = self.get_upload(dataset, filename)
+        # the same name given to the file when the upload was initialized
+        filepath = path.joinpath(secure_filename(filename))
+
+        if file.status != "importing":
+            # the completing chunk is sent again, e.g. if the response was lost
+            if file.status == "uploaded":
+                return self.response(
+                    {"filename": filename, "meta": self.get_file_metadata(filepath)},
+                    code=200,
                 )
-            # check the content of the file
-            file_validation = validate_gzipped_fastq(filepath)
-            if not file_validation[0]:
-                # delete the file
-                file.delete()
-                graph.db.commit()
-                filepath.unlink()
-                raise BadRequest(file_validation[1])
-            file.status = "uploaded"
-            file.save()
-            self.log_event(
-                self.events.create,
-                file,
-                {filename: f"Upload completed in dataset {uuid}"},
+            raise Conflict(f"File {filename} is {file.status}, upload not allowed")
+
+        content_range = parse_content_range_header(request.headers.get("Content-Range"))
+        if content_range is None or content_range.length != file.size:
+            raise BadRequest("Invalid Content-Range")
+
+        if content_range.start is None:
+            # bytes */size, only asking for the received ranges
+            received = get_received_ranges(file.uuid)
+        else:
+            received = write_chunk(
+                file.uuid,
+                filepath,
+                request.stream,
+                content_range.start,
+                content_range.stop,
+                file.size,
             )
 
-        return response
+        if not is_completed(received, file.size) or not claim_completion(file.uuid):
+            headers = {}
+            # the contiguous bytes received from the beginning of the file
+            if end := contiguous_end(received):
+                headers["Access-Control-Expose-Headers"] = "Range"
+                headers["Range"] = f"0-{end - 1}"
+            return self.response("partial", headers=headers, code=206)
+
+        try:
+            self.complete_upload(user, dataset, file, filepath)
+        except Exception:
+            # a retry can complete the upload, if not deleted
+            release_completion(file.uuid)
+            raise
+        clear_upload(file.uuid)
+
+        self.log_event(
+            self.events.create,
+            file,
+            {filename: f"Upload completed in dataset {uuid}"},
+        )
+
+        return self.response(
+            {"filename": filename, "meta": self.get_file_metadata(filepath)},
+            code=200,
+        )
+
+    @staticmethod
+    def delete_upload(user: User, dataset: Dataset, file: File, filepath: Path) -> None:
+        graph = neo4j.get_instance()
+        remove_file_stats(user.belongs_to.single().uuid, dataset, file.uuid)
+        clear_upload(file.uuid)
+        file.delete()
+        graph.db.commit()
+        filepath.unlink()
+
+    def complete_upload(
+        self, user: User, dataset: Dataset, file: File, filepath: Path
+    ) -> None:
+        checksums = get_checksums(file.uuid, filepath, file.size)
+        filesize = filepath.stat().st_size
+        # check the final size
+        if filesize != file.size:
+            log.debug(
+                "size expected: {},actual size: {}",
+                file.size,
+                filesize,
+            )
+            self.delete_upload(user, dataset, file, filepath)
+            raise ServerError(
+                "File has not been uploaded correctly: final size does not "
+                "correspond to total size. Please try a new upload",
+            )
+        # check the checksums provided when the upload was initialized
+        wrong_checksum = verify_checksum(
+            checksums, {"md5": file.md5, "sha256": file.sha256}
+        )
+        if wrong_checksum:
+            self.delete_upload(user, dataset, file, filepath)
+            raise ServerError(
+                f"File has not been uploaded correctly: {wrong_checksum} checksum "
+                "does not correspond. Please try a new upload",
+            )
+        # check the content of the file
+        file_validation = validate_gzipped_fastq(filepath)
+        if not file_validation[0]:
+            # delete the file
+            self.delete_upload(user, dataset, file, filepath)
+            raise BadRequest(file_validation[1])
+        file.md5 = checksums["md5"]
+        file.sha256 = checksums["sha256"]
+        file.status = "uploaded"
+        if file.metadata and file.metadata.get("validation") == "requested":
+            # the whole content is validated in background
+            c = celery.get_instance()
+            task = c.celery_app.send_task(
+                "validate_fastq", args=(file.uuid,), countdown=1
+            )
+            file.task_id = task.id
+            file.metadata = {"validation": "queued"}
+        file.save()
+        # write protected once completed
+        filepath.chmod(DEFAULT_PERMISSIONS)
 
     @decorators.auth.require()
     @decorators.init_chunk_upload
@@ -291,12 +474,20 @@ def post(self, uuid: str, name: str, user: User, **kwargs: Any) -> Response:
             "size": kwargs["size"],
             # Currently fixed
             "type": "fastq.gz",
+            "kind": get_file_kind(name),
             "status": "importing",
         }
+        # the expected checksums are replaced by the computed ones at completion
+        for algorithm in CHECKSUM_ALGORITHMS:
+            if kwargs.get(algorithm):
+                properties[algorithm] = kwargs[algorithm].lower()
+        if kwargs.get("deep_validation", False):
+            properties["metadata"] = {"validation": "requested"}
 
         file = graph.File(**properties).save()
 
         file.dataset.connect(dataset)
+        update_stats(user.belongs_to.single().uuid, files=1)
 
         self.log_event(
             self.events.create,
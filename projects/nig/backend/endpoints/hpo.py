@@ -1,12 +1,42 @@
 import re
-from typing import Dict, List
+from typing import Any, Dict, Optional
 
-from nig.endpoints import NIGEndpoint
+from nig.endpoints import READ_ACCESS_FILTER, NIGEndpoint
+from nig.endpoints._hpo import HPOIndex, get_hpo_index
 from restapi import decorators
 from restapi.connectors import neo4j
-from restapi.exceptions import BadRequest
+from restapi.exceptions import BadRequest, NotFound
+from restapi.models import Schema, fields, validate
 from restapi.rest.definition import Response
-from restapi.services.authentication import User
+from restapi.services.authentication import Role, User
+
+HPO_NOT_FOUND = "This hpo term cannot be found"
+
+# phenotypes of the studies readable by the user annotated with any of the terms.
+# The terms are looked up by their unique index and only the studies of their
+# phenotypes are checked against the access rules
+ANNOTATED_PHENOTYPES_QUERY = (
+    """
+MATCH (u:User {uuid: $user_uuid})
+MATCH (h:HPO)<-[:DESCRIBED_BY]-(:Phenotype)-[:DEFINED_IN]->(n:Study)
+WHERE h.hpo_id IN $hpo_ids
+WITH DISTINCT u, n
+"""
+    + READ_ACCESS_FILTER
+    + """
+MATCH (n)<-[:DEFINED_IN]-(p:Phenotype)-[:DESCRIBED_BY]->(h:HPO)
+WHERE h.hpo_id IN $hpo_ids
+WITH n, p, collect(h.hpo_id) AS hpo
+RETURN p {
+    .uuid,
+    .name,
+    study_uuid: n.uuid,
+    study_name: n.name,
+    hpo: hpo
+}
+ORDER BY p.name
+"""
+)
 
 
 class HPO(NIGEndpoint):
@@ -16,7 +46,7 @@ class HPO(NIGEndpoint):
     @decorators.auth.require()
     @decorators.endpoint(
         path="/hpo/<query>",
-        summary="List of existing hpo terms matching a substring query",
+        summary="List of existing hpo terms matching a substring query, prefix matches first",
         responses={
             200: "Matching hpo terms successfully retrieved",
         },
@@ -27,22 +57,138 @@ def get(self, query: str, user: User) -> Response:
         if not re.match("^[a-zA-Z0-9 :-]+$", query):
             raise BadRequest("Invalid HPO query")
 
-        cypher = "MATCH (hpo:HPO)"
+        data = get_hpo_index().search(query)
 
-        regexp = f"(?i).*{query}.*"
-        if query.startswith("HP:") and len(query) >= 4:
-            cypher += " WHERE hpo.hpo_id =~ $regexp"
-        else:
-            cypher += " WHERE hpo.label =~ $regexp"
-        cypher += " RETURN hpo ORDER BY hpo.hpo_id DESC"
-        cypher += " LIMIT 50"
+        return self.response(data)
 
-        graph = neo4j.get_instance()
-        result = graph.cypher(cypher, regexp=regexp)
 
-        data: List[Dict[str, str]] = []
-        for row in result:
-            hpo = graph.HPO.inflate(row[0])
-            data.append({"hpo_id": hpo.hpo_id, "label": hpo.label})
+class HpoTreeQuery(Schema):
+    depth = fields.Int(
+        required=False,
+        validate=validate.Range(min=1),
+        metadata={"description": "Maximum distance from the term"},
+    )
+
+
+class HpoTerm(Schema):
+    hpo_id = fields.Str(required=True)
+    label = fields.Str(required=True)
+    distance = fields.Int(required=False)
+
+
+class AnnotatedPhenotype(Schema):
+    uuid = fields.Str(required=True)
+    name = fields.Str(required=True)
+    study_uuid = fields.Str(required=True)
+    study_name = fields.Str(required=True)
+    hpo = fields.List(fields.Str())
+
+
+def get_term_position(index: HPOIndex, hpo_id: str) -> int:
+    position = index.position(hpo_id)
+    if position is None:
+        raise NotFound(HPO_NOT_FOUND)
+    return position
+
+
+class HPOAncestors(NIGEndpoint):
+
+    labels = ["miscellaneous"]
+
+    @decorators.auth.require()
+    @decorators.endpoint(
+        path="/hpo/<hpo_id>/ancestors",
+        summary="List the ancestors of an hpo term",
+        responses={
+            200: "Ancestors of the hpo term successfully retrieved",
+            404: "This hpo term cannot be found",
+        },
+    )
+    @decorators.use_kwargs(HpoTreeQuery, location="query")
+    @decorators.marshal_with(HpoTerm(many=True), code=200)
+    def get(self, hpo_id: str, user: User, depth: Optional[int] = None) -> Response:
+
+        index = get_hpo_index()
+        position = get_term_position(index, hpo_id)
+
+        return self.response(index.terms(index.ancestors(position, depth)))
+
+
+class HPODescendants(NIGEndpoint):
+
+    labels = ["miscellaneous"]
+
+    @decorators.auth.require()
+    @decorators.endpoint(
+        path="/hpo/<hpo_id>/descendants",
+        summary="List the descendants of an hpo term",
+        responses={
+            200: "Descendants of the hpo term successfully retrieved",
+            404: "This hpo term cannot be found",
+        },
+    )
+    @decorators.use_kwargs(HpoTreeQuery, location="query")
+    @decorators.marshal_with(HpoTerm(many=True), code=200)
+    def get(self, hpo_id: str, user: User, depth: Optional[int] = None) -> Response:
+
+        index = get_hpo_index()
+        position = get_term_position(index, hpo_id)
+
+        return self.response(index.terms(index.descendants(position, depth)))
+
+
+class HPOCommonAncestors(NIGEndpoint):
+
+    labels = ["miscellaneous"]
+
+    @decorators.auth.require()
+    @decorators.endpoint(
+        path="/hpo/<hpo_id>/lca/<other_hpo_id>",
+        summary="List the lowest common ancestors of two hpo terms",
+        responses={
+            200: "Lowest common ancestors successfully retrieved",
+            404: "This hpo term cannot be found",
+        },
+    )
+    @decorators.marshal_with(HpoTerm(many=True), code=200)
+    def get(self, hpo_id: str, other_hpo_id: str, user: User) -> Response:
+
+        index = get_hpo_index()
+        position = get_term_position(index, hpo_id)
+        other_position = get_term_position(index, other_hpo_id)
+
+        data = [index.term(p) for p in index.common_ancestors(position, other_position)]
+        return self.response(data)
+
+
+class HPOPhenotypes(NIGEndpoint):
+
+    labels = ["miscellaneous"]
+
+    @decorators.auth.require()
+    @decorators.endpoint(
+        path="/hpo/<hpo_id>/phenotypes",
+        summary="List the phenotypes annotated with an hpo term or a descendant",
+        description="Only phenotypes defined in accessible studies are returned",
+        responses={
+            200: "Annotated phenotypes successfully retrieved",
+            404: "This hpo term cannot be found",
+        },
+    )
+    @decorators.marshal_with(AnnotatedPhenotype(many=True), code=200)
+    def get(self, hpo_id: str, user: User) -> Response:
+
+        index = get_hpo_index()
+        position = get_term_position(index, hpo_id)
+
+        hpo_ids = [hpo_id] + [index.ids[p] for p in index.descendants(position)]
+
+        graph = neo4j.get_instance()
+        params: Dict[str, Any] = {
+            "user_uuid": user.uuid,
+            "admin_role": Role.ADMIN.value,
+            "hpo_ids": hpo_ids,
+        }
+        data = [row[0] for row in graph.cypher(ANNOTATED_PHENOTYPES_QUERY, **params)]
 
         return self.response(data)
@@ -2,12 +2,27 @@
 from typing import Any, Dict, List, Optional, Type, Union
 
 import pytz
-from nig.endpoints import PHENOTYPE_NOT_FOUND, NIGEndpoint
+from nig.endpoints import (
+    ADMIN_STUDY_LIST_MATCH,
+    MAX_PAGE_SIZE,
+    PHENOTYPE_NOT_FOUND,
+    STUDY_LIST_MATCH,
+    ListQuery,
+    NIGEndpoint,
+    get_page,
+)
+from nig.endpoints._dataset_schema import invalidate_dataset_schema
+from nig.endpoints._geodata import (
+    get_geodata_choices,
+    invalidate_geodata_cache,
+    is_valid_geodata,
+)
+from nig.endpoints._hpo import get_hpo_index
 from nig.endpoints._injectors import verify_phenotype_access, verify_study_access
 from restapi import decorators
 from restapi.connectors import neo4j
 from restapi.customizer import FlaskRequest
-from restapi.exceptions import NotFound
+from restapi.exceptions import BadRequest, NotFound
 from restapi.models import Schema, fields, validate
 from restapi.rest.definition import Response
 from restapi.services.authentication import User
@@ -17,6 +32,42 @@
 
 SEX = ["male", "female"]
 
+PHENOTYPE_LIST_MATCH = "MATCH (:Study {uuid: $study_uuid})<-[:DEFINED_IN]-(n:Phenotype)"
+# Phenotypes are serialized with a single projection including hpo terms,
+# birth place and family relationships, shared by the list and the single view
+PHENOTYPE_PROJECTION = """n {
+    .uuid,
+    .name,
+    .age,
+    .sex,
+    hpo: [(n)-[:DESCRIBED_BY]->(h:HPO) | h {.hpo_id, .label}],
+    birth_place: head([
+        (n)-[:BIRTH_PLACE]->(g:GeoData) | g {.uuid, .country, .region, .province, .code}
+    ]),
+    father: head([(n)-[:FATHER]->(f:Phenotype) | f {.uuid, .name}]),
+    mother: head([(n)-[:MOTHER]->(m:Phenotype) | m {.uuid, .name}]),
+    sons: [(n)-[:SON]->(s:Phenotype) | s {.uuid, .name}]
+}"""
+LINK_GEODATA_QUERY = """
+MATCH (p:Phenotype {uuid: $phenotype_uuid}), (g:GeoData {uuid: $geodata_uuid})
+MERGE (p)-[:BIRTH_PLACE]->(g)
+RETURN g.uuid
+"""
+# hpo profiles of the phenotypes defined in the studies readable by the user,
+# to be appended to the study list match of the user (or of the admins)
+HPO_PROFILES_RETURN = """
+MATCH (n)<-[:DEFINED_IN]-(p:Phenotype)
+WITH n, p, [(p)-[:DESCRIBED_BY]->(h:HPO) | h.hpo_id] AS hpo
+WHERE size(hpo) > 0
+RETURN p.uuid, p.name, n.uuid, n.name, hpo
+"""
+PHENOTYPE_SORT_KEYS = {
+    "created": "n.created",
+    "name": "n.name",
+    "age": "n.age",
+    "sex": "n.sex",
+}
+
 
 class Hpo(Schema):
     hpo_id = fields.Str(required=True)
@@ -55,8 +106,59 @@ class PhenotypeOutputSchema(Schema):
     )
 
 
+class PhenotypeListQuery(ListQuery):
+    sort_by = fields.Str(
+        required=False,
+        load_default=None,
+        validate=validate.OneOf(list(PHENOTYPE_SORT_KEYS)),
+    )
+    sex = fields.Str(required=False, validate=validate.OneOf(SEX))
+
+
+class SimilarityQuery(Schema):
+    hpo = fields.DelimitedList(
+        fields.Str(),
+        required=True,
+        metadata={"description": "HPO terms of the patient profile"},
+    )
+    size = fields.Int(
+        required=False,
+        load_default=20,
+        validate=validate.Range(min=1, max=MAX_PAGE_SIZE),
+        metadata={"description": "Number of phenotypes to retrieve"},
+    )
+
+
+class SimilarPhenotype(Schema):
+    uuid = fields.Str(required=True)
+    name = fields.Str(required=True)
+    study_uuid = fields.Str(required=True)
+    study_name = fields.Str(required=True)
+    score = fields.Float(required=True)
+
+
+def get_phenotype_output(row: Dict[str, Any]) -> Dict[str, Any]:
+    phenotype_el: Dict[str, Any] = {}
+    phenotype_el["uuid"] = row["uuid"]
+    phenotype_el["name"] = row["name"]
+    if row["age"]:
+        phenotype_el["age"] = row["age"]
+    phenotype_el["sex"] = row["sex"]
+    phenotype_el["hpo"] = row["hpo"]
+    if row["birth_place"]:
+        phenotype_el["birth_place"] = row["birth_place"]
+
+    phenotype_el["relationships"] = {}
+    if row["father"]:
+        phenotype_el["relationships"]["father"] = row["father"]
+    if row["mother"]:
+        phenotype_el["relationships"]["mother"] = row["mother"]
+    if row["sons"]:
+        phenotype_el["relationships"]["sons"] = row["sons"]
+    return phenotype_el
+
+
 def getInputSchema(request: FlaskRequest, is_post: bool) -> Type[Schema]:
-    graph = neo4j.get_instance()
     # as defined in Marshmallow.schema.from_dict
     attributes: Dict[str, Union[fields.Field, type]] = {}
 
@@ -76,12 +178,7 @@ def getInputSchema(request: FlaskRequest, is_post: bool) -> Type[Schema]:
         },
     )
 
-    geodata_keys = []
-    geodata_labels = []
-
-    for g in graph.GeoData.nodes.all():
-        geodata_keys.append(g.uuid)
-        geodata_labels.append(g.province)
+    geodata_keys, geodata_labels = get_geodata_choices()
 
     if len(geodata_keys) == 1:
         default_geodata = geodata_keys[0]
@@ -124,73 +221,102 @@ class PhenotypeList(NIGEndpoint):
             404: "This study cannot be found or you are not authorized to access",
         },
     )
+    @decorators.use_kwargs(PhenotypeListQuery, location="query")
     @decorators.marshal_with(PhenotypeOutputSchema(many=True), code=200)
-    def get(self, uuid: str, user: User) -> Response:
+    def get(
+        self,
+        uuid: str,
+        user: User,
+        sort_order: str,
+        size: int,
+        sort_by: Optional[str] = None,
+        cursor: Optional[str] = None,
+        name: Optional[str] = None,
+        sex: Optional[str] = None,
+    ) -> Response:
 
         graph = neo4j.get_instance()
 
         study = graph.Study.nodes.get_or_none(uuid=uuid)
         self.verifyStudyAccess(study, user=user, read=True)
-        nodeset = study.phenotypes
+
+        params: Dict[str, Any] = {"study_uuid": study.uuid}
+        filters = []
+        if name:
+            filters.append("n.name STARTS WITH $name")
+            params["name"] = name
+        if sex:
+            filters.append("n.sex = $sex")
+            params["sex"] = sex
+
+        rows, total, next_cursor = get_page(
+            PHENOTYPE_LIST_MATCH,
+            PHENOTYPE_PROJECTION,
+            PHENOTYPE_SORT_KEYS,
+            filters,
+            params,
+            size=size,
+            cursor=cursor,
+            sort_by=sort_by,
+            sort_order=sort_order,
+        )
+
+        data = [get_phenotype_output(row) for row in rows]
+
+        return self.paginated_response(data, total, next_cursor)
+
+
+class PhenotypeSimilarity(NIGEndpoint):
+
+    labels = ["phenotype"]
+
+    @decorators.auth.require()
+    @decorators.endpoint(
+        path="/phenotypes/similar",
+        summary="Find the phenotypes with an hpo profile similar to the given one",
+        description="Phenotypes of the accessible studies are ranked by the "
+        "best-match average of the Resnik similarities of their hpo terms",
+        responses={
+            200: "Similar phenotypes successfully retrieved",
+            400: "None of the hpo terms can be found",
+        },
+    )
+    @decorators.use_kwargs(SimilarityQuery, location="query")
+    @decorators.marshal_with(SimilarPhenotype(many=True), code=200)
+    def get(self, hpo: List[str], size: int, user: User) -> Response:
+
+        index = get_hpo_index()
+        query = [p for p in map(index.position, hpo) if p is not None]
+        if not query:
+            raise BadRequest("None of the hpo terms can be found")
+
+        if self.auth.is_admin(user):
+            match = ADMIN_STUDY_LIST_MATCH
+        else:
+            match = STUDY_LIST_MATCH
+
+        graph = neo4j.get_instance()
+        candidates = []
+        profiles = []
+        for row in graph.cypher(match + HPO_PROFILES_RETURN, user_uuid=user.uuid):
+            profile = [p for p in map(index.position, row[4]) if p is not None]
+            if profile:
+                candidates.append(row)
+                profiles.append(profile)
 
         data = []
-        for phenotype in nodeset.all():
-            phenotype_el = {}
-            phenotype_el["uuid"] = phenotype.uuid
-            phenotype_el["name"] = phenotype.name
-            if phenotype.age:
-                phenotype_el["age"] = phenotype.age
-            phenotype_el["sex"] = phenotype.sex
-            phenotype_el["hpo"] = []
-            for hpo in phenotype.hpo:
-                hpo_el = {}
-                hpo_el["hpo_id"] = hpo.hpo_id
-                hpo_el["label"] = hpo.label
-                phenotype_el["hpo"].append(hpo_el)
-
-            if phenotype.birth_place.single():
-                phenotype_el["birth_place"] = {}
-                phenotype_el["birth_place"][
-                    "uuid"
-                ] = phenotype.birth_place.single().uuid
-                phenotype_el["birth_place"][
-                    "country"
-                ] = phenotype.birth_place.single().country
-                phenotype_el["birth_place"][
-                    "region"
-                ] = phenotype.birth_place.single().region
-                phenotype_el["birth_place"][
-                    "province"
-                ] = phenotype.birth_place.single().province
-                phenotype_el["birth_place"][
-                    "code"
-                ] = phenotype.birth_place.single().code
-
-            phenotype_el["relationships"] = {}
-            if phenotype.father:
-                phenotype_el["relationships"]["father"] = {}
-                phenotype_el["relationships"]["father"][
-                    "uuid"
-                ] = phenotype.father.single().uuid
-                phenotype_el["relationships"]["father"][
-                    "name"
-                ] = phenotype.father.single().name
-            if phenotype.mother:
-                phenotype_el["relationships"]["mother"] = {}
-                phenotype_el["relationships"]["mother"][
-                    "uuid"
-                ] = phenotype.mother.single().uuid
-                phenotype_el["relationships"]["mother"][
-                    "name"
-                ] = phenotype.mother.single().name
-            if phenotype.son:
-                phenotype_el["relationships"]["sons"] = []
-                for son in phenotype.son.all():
-                    son_el = {}
-                    son_el["uuid"] = son.uuid
-                    son_el["name"] = son.name
-                    phenotype_el["relationships"]["sons"].append(son_el)
-            data.append(phenotype_el)
+        if candidates:
+            scores = index.best_match_average(query, profiles)
+            for i in scores.argsort()[::-1][:size].tolist():
+                data.append(
+                    {
+                        "uuid": candidates[i][0],
+                        "name": candidates[i][1],
+                        "study_uuid": candidates[i][2],
+                        "study_name": candidates[i][3],
+                        "score": float(scores[i]),
+                    }
+                )
 
         return self.response(data)
 
@@ -221,11 +347,18 @@ def link_geodata(
         if previous := phenotype.birth_place.single():
             phenotype.birth_place.disconnect(previous)
 
-        geodata = graph.GeoData.nodes.get_or_none(uuid=geodata_uuid)
-        if geodata is None:
+        if not is_valid_geodata(geodata_uuid):
             raise NotFound("This birth place cannot be found")
 
-        phenotype.birth_place.connect(geodata)
+        linked = graph.cypher(
+            LINK_GEODATA_QUERY,
+            phenotype_uuid=phenotype.uuid,
+            geodata_uuid=geodata_uuid,
+        )
+        if not linked:
+            # the cached choices are stale, the node has been removed
+            invalidate_geodata_cache()
+            raise NotFound("This birth place cannot be found")
 
     def check_timezone(self, date: datetime) -> datetime:
         if date.tzinfo is None:
@@ -254,57 +387,10 @@ def get(self, uuid: str, user: User) -> Response:
 
         self.log_event(self.events.access, phenotype)
 
-        phenotype_el = {}
-        phenotype_el["uuid"] = phenotype.uuid
-        phenotype_el["name"] = phenotype.name
-        if phenotype.age:
-            phenotype_el["age"] = phenotype.age
-        phenotype_el["sex"] = phenotype.sex
-        phenotype_el["hpo"] = []
-        for hpo in phenotype.hpo:
-            hpo_el = {}
-            hpo_el["hpo_id"] = hpo.hpo_id
-            hpo_el["label"] = hpo.label
-            phenotype_el["hpo"].append(hpo_el)
-
-        if phenotype.birth_place.single():
-            phenotype_el["birth_place"] = {}
-            phenotype_el["birth_place"]["uuid"] = phenotype.birth_place.single().uuid
-            phenotype_el["birth_place"][
-                "country"
-            ] = phenotype.birth_place.single().country
-            phenotype_el["birth_place"][
-                "region"
-            ] = phenotype.birth_place.single().region
-            phenotype_el["birth_place"][
-                "province"
-            ] = phenotype.birth_place.single().province
-            phenotype_el["birth_place"]["code"] = phenotype.birth_place.single().code
-
-        phenotype_el["relationships"] = {}
-        if phenotype.father:
-            phenotype_el["relationships"]["father"] = {}
-            phenotype_el["relationships"]["father"][
-                "uuid"
-            ] = phenotype.father.single().uuid
-            phenotype_el["relationships"]["father"][
-                "name"
-            ] = phenotype.father.single().name
-        if phenotype.mother:
-            phenotype_el["relationships"]["mother"] = {}
-            phenotype_el["relationships"]["mother"][
-                "uuid"
-            ] = phenotype.mother.single().uuid
-            phenotype_el["relationships"]["mother"][
-                "name"
-            ] = phenotype.mother.single().name
-        if phenotype.son:
-            phenotype_el["relationships"]["sons"] = []
-            for son in phenotype.son.all():
-                son_el = {}
-                son_el["uuid"] = son.uuid
-                son_el["name"] = son.name
-                phenotype_el["relationships"]["sons"].append(son_el)
+        query = f"MATCH (n:Phenotype {{uuid: $uuid}}) RETURN {PHENOTYPE_PROJECTION}"
+        phenotype_el: Dict[str, Any] = {}
+        for row in graph.cypher(query, uuid=phenotype.uuid):
+            phenotype_el = get_phenotype_output(row[0])
 
         return self.response(phenotype_el)
 
@@ -346,6 +432,7 @@ def post(
         phenotype = graph.Phenotype(**kwargs).save()
 
         phenotype.defined_in.connect(study)
+        invalidate_dataset_schema(study.uuid)
         if birth_place:
             self.link_geodata(graph, phenotype, birth_place)
             kwargs["birth_place"] = birth_place
@@ -421,6 +508,7 @@ def put(
                 phenotype.hpo.disconnect(p)
 
         phenotype.save()
+        invalidate_dataset_schema(study.uuid)
 
         # c = celery.get_instance()
         # c.celery_app.send_task(
@@ -452,6 +540,7 @@ def delete(self, uuid: str, user: User) -> Response:
         self.verifyStudyAccess(study, user=user, error_type="Phenotype")
 
         phenotype.delete()
+        invalidate_dataset_schema(study.uuid)
 
         self.log_event(self.events.delete, phenotype)
 
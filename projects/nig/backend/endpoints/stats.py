@@ -1,9 +1,12 @@
-from typing import Dict, List, Union, cast
+from datetime import date, timedelta
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 from nig.endpoints import NIGEndpoint
+from nig.endpoints._stats import STATS_COUNTERS
 from restapi import decorators
 from restapi.connectors import neo4j
-from restapi.models import Schema, fields
+from restapi.exceptions import BadRequest
+from restapi.models import Schema, fields, validate
 from restapi.rest.definition import Response
 from restapi.services.authentication import User
 
@@ -36,114 +39,202 @@ class PrivateStatsOutput(Schema):
     num_files = fields.Integer(required=False)
 
 
-def get_filter_by_group() -> str:
-    filter_group: str = ""
-    if NIGEndpoint.GROUPS_TO_FILTER:
-        for g in NIGEndpoint.GROUPS_TO_FILTER:
-            if not filter_group:
-                filter_group = f"WHERE g.fullname <> '{g}' "
-            else:
-                filter_group += f"and g.fullname <> '{g}' "
-
-    return filter_group
-
-
-query_dictionary: Dict[str, Dict[str, Union[str, List[str]]]] = {
-    "count_users": {
-        "match": "MATCH(u: User)-[: BELONGS_TO]->(g:Group)",
-        "count": "RETURN count(u)",
-    },
-    "count_studies": {
-        "match": "MATCH (g:Group)<-[:BELONGS_TO]-(u:User)<-[:IS_OWNED_BY]-(s:Study)",
-        "count": "RETURN count(s)",
-    },
-    "count_datasets": {
-        "match": "MATCH (g:Group)<-[:BELONGS_TO]-(u:User)<-[:IS_OWNED_BY]-(d:Dataset)",
-        "count": "RETURN count(d)",
-        "count_per_group": "RETURN g.fullname, count(d)",
-    },
-    "count_files": {
-        "match": "MATCH (g:Group)<-[:BELONGS_TO]-(u:User)<-[:IS_OWNED_BY]-(d:Dataset)-[]-(f:File)",
-        "count": "RETURN count(f)",
-    },
-    "count_dataset_with_vcf": {
-        "match": [
-            "MATCH (g:Group)<-[:BELONGS_TO]-(u:User)<-[:IS_OWNED_BY]-(d:Dataset)-[]-(:Phenotype) ",
-            "filter_by_group",
-            "WITH g, d limit 15000 ",
-            "MATCH (d)-[]-(f:File) ",
-            "WHERE f.name ENDS WITH '.vcf' AND NOT(f.name ENDS WITH '.g.vcf') ",
-        ],
-        "count": "RETURN count(d)",
-        "count_per_group": "RETURN g.fullname, count(d)",
-    },
-    "count_dataset_with_gvcf": {
-        "match": [
-            "MATCH (g:Group)<-[:BELONGS_TO]-(u:User)<-[:IS_OWNED_BY]-(d:Dataset) ",
-            "filter_by_group",
-            "WITH g, d limit 15000 ",
-            "MATCH (d)-[]-(f:File)",
-            "WHERE (f.name ENDS WITH '.g.vcf' OR f.name =~ '.*\\\\.g.vcf\\\\..*') ",
-            "AND NOT f.name ENDS WITH '.tbi'",
-        ],
-        "count": "RETURN count(d)",
-        "count_per_group": "RETURN g.fullname, count(d)",
-    },
+DATE_FORMAT = "%Y-%m-%d"
+MAX_HISTORY_POINTS = 1000
+
+
+class HistoryQuery(Schema):
+    start = fields.Date(
+        required=False,
+        format=DATE_FORMAT,
+        metadata={"description": "First day of the series, default one year ago"},
+    )
+    end = fields.Date(
+        required=False,
+        format=DATE_FORMAT,
+        metadata={"description": "Last day of the series, default today"},
+    )
+    points = fields.Int(
+        required=False,
+        load_default=100,
+        validate=validate.Range(min=1, max=MAX_HISTORY_POINTS),
+        metadata={"description": "Maximum number of points of the series"},
+    )
+
+
+class HistoryCounters(Schema):
+    studies = fields.Integer()
+    datasets = fields.Integer()
+    files = fields.Integer()
+    datasets_with_vcf = fields.Integer()
+    datasets_with_gvcf = fields.Integer()
+    completed_analyses = fields.Integer()
+
+
+class HistoryOutput(HistoryCounters):
+    date = fields.Str(required=True)
+    per_group = fields.Dict(keys=fields.Str(), values=fields.Nested(HistoryCounters))
+
+
+# aggregations computed in a single pass over the datasets of a group,
+# with kinds bound to the kinds of the files and results of each dataset d
+DATASET_AGGREGATIONS = {
+    "datasets": "count(d)",
+    "files": "sum(files)",
+    "datasets_with_vcf": "sum(CASE WHEN has_phenotype AND 'vcf' IN kinds "
+    "THEN 1 ELSE 0 END)",
+    "datasets_with_gvcf": "sum(CASE WHEN 'gvcf' IN kinds THEN 1 ELSE 0 END)",
 }
 
+# datasets whose analysis has been completed, only tracked in the snapshots
+SNAPSHOT_AGGREGATIONS = {
+    **DATASET_AGGREGATIONS,
+    "completed_analyses": "sum(CASE WHEN d.status = 'COMPLETED' THEN 1 ELSE 0 END)",
+}
+SNAPSHOT_COUNTERS = ["studies", *SNAPSHOT_AGGREGATIONS]
+
+
+def build_stats_query(dataset_aggregations: Dict[str, str]) -> str:
+    """
+    Build the query computing all the counters of the requested groups
+    ($group_uuids, or all the groups if null) except the $excluded_groups
+    """
+    aggregations = ",\n        ".join(
+        f"{aggregation} AS {counter}"
+        for counter, aggregation in dataset_aggregations.items()
+    )
+    return f"""
+MATCH (g:Group)
+WHERE ($group_uuids IS NULL OR g.uuid IN $group_uuids)
+AND NOT g.fullname IN $excluded_groups
+CALL {{
+    WITH g
+    MATCH (g)<-[:BELONGS_TO]-(:User)<-[:IS_OWNED_BY]-(d:Dataset)
+    WITH DISTINCT d
+    WITH d,
+        size([(d)-[:CONTAINS]->(f:File) | f]) AS files,
+        [(d)-->(f:File) | f.kind] AS kinds,
+        size([(d)-[]-(p:Phenotype) | p]) > 0 AS has_phenotype
+    RETURN
+        {aggregations}
+}}
+RETURN g.uuid AS group_uuid, {{
+    studies: size([(g)<-[:BELONGS_TO]-(:User)<-[:IS_OWNED_BY]-(s:Study) | s]),
+    {", ".join(f"{c}: {c}" for c in dataset_aggregations)}
+}} AS counters, g.fullname AS group_name
+"""
+
+
+STATS_QUERY = build_stats_query(DATASET_AGGREGATIONS)
+SNAPSHOT_QUERY = build_stats_query(SNAPSHOT_AGGREGATIONS)
+
+SET_SNAPSHOT_QUERY = """
+UNWIND $stats AS row
+MERGE (s:StatsSnapshot {date: $date, group_uuid: row.group_uuid})
+SET s += row.counters, s.group_name = row.group_name
+"""
+
+# a single range read on the indexed snapshot date
+HISTORY_QUERY = """
+MATCH (s:StatsSnapshot)
+WHERE s.date >= $start AND s.date <= $end
+AND NOT s.group_name IN $excluded_groups
+RETURN s.date, s.group_name, s {
+    .studies, .datasets, .files, .datasets_with_vcf, .datasets_with_gvcf,
+    .completed_analyses
+}
+ORDER BY s.date
+"""
+
+SET_STATS_QUERY = """
+UNWIND $stats AS row
+MERGE (s:Stats {group_uuid: row.group_uuid})
+SET s += row.counters
+"""
+
+# users are counted live, all the other counters are read from the Stats nodes
+GET_STATS_QUERY = """
+MATCH (g:Group)
+WHERE NOT g.fullname IN $excluded_groups
+OPTIONAL MATCH (s:Stats {group_uuid: g.uuid})
+RETURN
+    g.fullname,
+    size([(g)<-[:BELONGS_TO]-(u:User) | u]),
+    s {.studies, .datasets, .files, .datasets_with_vcf, .datasets_with_gvcf}
+"""
+
+
+def recount_stats(group_uuids: Optional[List[str]] = None) -> None:
+    """
+    Recount the materialized stats of the given groups, or of all the groups
+    """
+    graph = neo4j.get_instance()
+
+    params: Dict[str, Any] = {"group_uuids": group_uuids, "excluded_groups": []}
+    stats = [
+        {"group_uuid": row[0], "counters": row[1]}
+        for row in graph.cypher(STATS_QUERY, **params)
+    ]
+    params = {"stats": stats}
+    graph.cypher(SET_STATS_QUERY, **params)
+
+    if group_uuids is None:
+        # remove the stats of deleted groups
+        params = {"group_uuids": [s["group_uuid"] for s in stats]}
+        graph.cypher(
+            "MATCH (s:Stats) WHERE NOT s.group_uuid IN $group_uuids DELETE s",
+            **params,
+        )
+
 
-def count_nodes(graph: neo4j.NeoModel, key: str) -> int:
-    filter_group = get_filter_by_group()
-    if (
-        type(query_dictionary[key]["match"]) == list
-    ):  # exception in case of advanced queries who needs the filter by group in between
-        query = ""
-        for m in query_dictionary[key]["match"]:
-            if (
-                m != "filter_by_group"
-            ):  # this expression in the list means where the filter group(if any) has to be inserted
-                query += m
-            else:
-                query += filter_group
-        query += cast(str, query_dictionary[key]["count"])
-    else:
-        query = f"{query_dictionary[key]['match']} {filter_group} {query_dictionary[key]['count']}"
-
-    result = graph.cypher(query)
-
-    for row in result:
-        return int(row[0])
-
-    return 0
-
-
-def count_by_group(graph: neo4j.NeoModel, key: str) -> Dict[str, int]:
-    filter_group = get_filter_by_group()
-
-    if (
-        type(query_dictionary[key]["match"]) == list
-    ):  # exception in case of advanced queries who needs the filter by group in between
-        query = ""
-        for m in query_dictionary[key]["match"]:
-            if (
-                m != "filter_by_group"
-            ):  # this expression in the list means where the filter group(if any) has to be inserted
-                query += m
-            else:
-                query += filter_group
-        query += cast(str, query_dictionary[key]["count_per_group"])
-    else:
-        query = f"{query_dictionary[key]['match']} {filter_group} {query_dictionary[key]['count_per_group']}"
-
-    result = graph.cypher(query)
-    data: Dict[str, int] = {}
-    for row in result:
-        key = row[0]
-        if key is None:
-            continue  # type: ignore
-        data[key] = int(row[1])
-
-    return data
+def take_stats_snapshot(day: Optional[date] = None) -> int:
+    """
+    Store the counters of all the groups for the given day (default today),
+    replacing any previous snapshot of the same day.
+    Returns the number of stored group records
+    """
+    graph = neo4j.get_instance()
+
+    params: Dict[str, Any] = {"group_uuids": None, "excluded_groups": []}
+    stats = [
+        {"group_uuid": row[0], "counters": row[1], "group_name": row[2]}
+        for row in graph.cypher(SNAPSHOT_QUERY, **params)
+    ]
+    params = {"stats": stats, "date": (day or date.today()).isoformat()}
+    graph.cypher(SET_SNAPSHOT_QUERY, **params)
+    return len(stats)
+
+
+def downsample(days: List[str], points: int) -> List[str]:
+    """
+    Split the days in the given number of buckets and keep the last day of
+    each one, counters are cumulative so the last value represents the bucket
+    """
+    if len(days) <= points:
+        return days
+    return [days[(i + 1) * len(days) // points - 1] for i in range(points)]
+
+
+def get_stats(
+    graph: neo4j.NeoModel,
+) -> Tuple[Dict[str, int], Dict[str, Dict[str, int]]]:
+    """
+    Return the stats totals and the counters per group name,
+    excluding the groups in GROUPS_TO_FILTER
+    """
+    totals = {"users": 0, **{c: 0 for c in STATS_COUNTERS}}
+    per_group: Dict[str, Dict[str, int]] = {c: {} for c in STATS_COUNTERS}
+
+    params: Dict[str, Any] = {"excluded_groups": NIGEndpoint.GROUPS_TO_FILTER}
+    for group, users, counters in graph.cypher(GET_STATS_QUERY, **params):
+        totals["users"] += users
+        for c in STATS_COUNTERS:
+            value = (counters or {}).get(c) or 0
+            totals[c] += value
+            if value:
+                per_group[c][group] = value
+
+    return totals, per_group
 
 
 class PublicStats(NIGEndpoint):
@@ -162,14 +253,16 @@ def get(self) -> Response:
 
         graph = neo4j.get_instance()
 
+        totals, _ = get_stats(graph)
+
         data = {}
-        data["num_users"] = count_nodes(graph, "count_users")
-        data["num_studies"] = count_nodes(graph, "count_studies")
+        data["num_users"] = totals["users"]
+        data["num_studies"] = totals["studies"]
 
-        data["num_datasets"] = count_nodes(graph, "count_datasets")
-        data["num_datasets_with_vcf"] = count_nodes(graph, "count_dataset_with_vcf")
+        data["num_datasets"] = totals["datasets"]
+        data["num_datasets_with_vcf"] = totals["datasets_with_vcf"]
 
-        data["num_files"] = count_nodes(graph, "count_files")
+        data["num_files"] = totals["files"]
 
         return self.response(data)
 
@@ -191,23 +284,73 @@ def get(self, user: User) -> Response:
 
         graph = neo4j.get_instance()
 
+        totals, per_group = get_stats(graph)
+
         data: Dict[str, Union[int, Dict[str, int]]] = {}
-        data["num_users"] = count_nodes(graph, "count_users")
-        data["num_studies"] = count_nodes(graph, "count_studies")
+        data["num_users"] = totals["users"]
+        data["num_studies"] = totals["studies"]
 
-        data["num_datasets"] = count_nodes(graph, "count_datasets")
-        data["num_datasets_per_group"] = count_by_group(graph, "count_datasets")
+        data["num_datasets"] = totals["datasets"]
+        data["num_datasets_per_group"] = per_group["datasets"]
 
-        data["num_datasets_with_vcf"] = count_nodes(graph, "count_dataset_with_vcf")
-        data["num_datasets_with_vcf_per_group"] = count_by_group(
-            graph, "count_dataset_with_vcf"
-        )
+        data["num_datasets_with_vcf"] = totals["datasets_with_vcf"]
+        data["num_datasets_with_vcf_per_group"] = per_group["datasets_with_vcf"]
 
-        data["num_datasets_with_gvcf"] = count_nodes(graph, "count_dataset_with_gvcf")
-        data["num_datasets_with_gvcf_per_group"] = count_by_group(
-            graph, "count_dataset_with_gvcf"
-        )
+        data["num_datasets_with_gvcf"] = totals["datasets_with_gvcf"]
+        data["num_datasets_with_gvcf_per_group"] = per_group["datasets_with_gvcf"]
+
+        data["num_files"] = totals["files"]
+
+        return self.response(data)
+
+
+class StatsHistory(NIGEndpoint):
 
-        data["num_files"] = count_nodes(graph, "count_files")
+    labels = ["stats"]
+
+    @decorators.auth.require()
+    @decorators.endpoint(
+        path="/stats/history",
+        summary="Retrieve the daily series of the repository statistics",
+        responses={
+            200: "Statistics history successfully retrieved",
+        },
+    )
+    @decorators.use_kwargs(HistoryQuery, location="query")
+    @decorators.marshal_with(HistoryOutput(many=True), code=200)
+    def get(
+        self,
+        user: User,
+        points: int,
+        start: Optional[date] = None,
+        end: Optional[date] = None,
+    ) -> Response:
+
+        end = end or date.today()
+        start = start or end - timedelta(days=365)
+        if start > end:
+            raise BadRequest("The start date follows the end date")
+
+        graph = neo4j.get_instance()
+        params: Dict[str, Any] = {
+            "start": start.isoformat(),
+            "end": end.isoformat(),
+            "excluded_groups": NIGEndpoint.GROUPS_TO_FILTER,
+        }
+
+        history: Dict[str, Dict[str, Any]] = {}
+        for day, group, snapshot in graph.cypher(HISTORY_QUERY, **params):
+            if day not in history:
+                history[day] = {
+                    "date": day,
+                    "per_group": {},
+                    **{c: 0 for c in SNAPSHOT_COUNTERS},
+                }
+            counters = {c: snapshot.get(c) or 0 for c in SNAPSHOT_COUNTERS}
+            history[day]["per_group"][group] = counters
+            for c, value in counters.items():
+                history[day][c] += value
+
+        data = [history[day] for day in downsample(list(history), points)]
 
         return self.response(data)
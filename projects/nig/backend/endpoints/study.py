@@ -1,16 +1,37 @@
 import shutil
-from typing import Any
-
-from nig.endpoints import NIGEndpoint
+from typing import Any, Dict, Optional
+
+from nig.endpoints import (
+    ADMIN_STUDY_LIST_MATCH,
+    STUDY_LIST_MATCH,
+    ListQuery,
+    NIGEndpoint,
+    get_page,
+)
+from nig.endpoints._stats import remove_dataset_stats, update_stats
 from restapi import decorators
 from restapi.connectors import neo4j
 from restapi.exceptions import Conflict
-from restapi.models import Schema, fields
+from restapi.models import Schema, fields, validate
 from restapi.rest.definition import Response
 from restapi.services.authentication import User
 
 # from restapi.utilities.logs import log
 
+STUDY_LIST_PROJECTION = """n {
+    .uuid,
+    .name,
+    .description,
+    datasets: size([(n)-[:CONTAINS]->(d:Dataset) | d]),
+    phenotypes: size([(n)<-[:DEFINED_IN]-(p:Phenotype) | p]),
+    technicals: size([(n)<-[:DEFINED_IN]-(t:TechnicalMetadata) | t]),
+    readonly: readonly,
+    owning_group_name: head(
+        [(n)-[:IS_OWNED_BY]->(:User)-[:BELONGS_TO]->(g:Group) | g.fullname]
+    )
+}"""
+STUDY_SORT_KEYS = {"created": "n.created", "name": "n.name"}
+
 
 # Output schema
 class StudyOutput(Schema):
@@ -25,6 +46,21 @@ class StudyOutput(Schema):
     owning_group_name = fields.Str()
 
 
+# Output schema of the study list, filled with an already aggregated projection
+class StudyListOutput(StudyOutput):
+    datasets = fields.Integer()
+    phenotypes = fields.Integer()
+    technicals = fields.Integer()
+
+
+class StudyListQuery(ListQuery):
+    sort_by = fields.Str(
+        required=False,
+        load_default=None,
+        validate=validate.OneOf(list(STUDY_SORT_KEYS)),
+    )
+
+
 class StudyInputSchema(Schema):
     name = fields.Str(required=True)
     description = fields.Str(required=True)
@@ -46,36 +82,42 @@ class Studies(NIGEndpoint):
             200: "List of studies successfully retrieved",
         },
     )
-    @decorators.marshal_with(StudyOutput(many=True), code=200)
-    def get(self, user: User) -> Response:
-
-        graph = neo4j.get_instance()
-
-        data = []
-        for t in graph.Study.nodes.order_by().all():
-
-            if not self.verifyStudyAccess(t, user=user, read=True, raiseError=False):
-                continue
-
-            study_el = {}
-            study_el["uuid"] = t.uuid
-            study_el["name"] = t.name
-            study_el["description"] = t.description
-            study_el["datasets"] = t.datasets
-            study_el["phenotypes"] = t.phenotypes
-            study_el["technicals"] = t.technicals
-            owner = t.ownership.single()
-            if owner == user:
-                study_el["readonly"] = False
-
-            for group in owner.belongs_to.all():
-                study_el["owning_group_name"] = group.fullname
-                if group.members.is_connected(user):
-                    study_el["readonly"] = False
-
-            data.append(study_el)
-
-        return self.response(data)
+    @decorators.use_kwargs(StudyListQuery, location="query")
+    @decorators.marshal_with(StudyListOutput(many=True), code=200)
+    def get(
+        self,
+        user: User,
+        sort_order: str,
+        size: int,
+        sort_by: Optional[str] = None,
+        cursor: Optional[str] = None,
+        name: Optional[str] = None,
+    ) -> Response:
+
+        if self.auth.is_admin(user):
+            match = ADMIN_STUDY_LIST_MATCH
+        else:
+            match = STUDY_LIST_MATCH
+
+        params: Dict[str, Any] = {"user_uuid": user.uuid}
+        filters = []
+        if name:
+            filters.append("n.name STARTS WITH $name")
+            params["name"] = name
+
+        data, total, next_cursor = get_page(
+            match,
+            STUDY_LIST_PROJECTION,
+            STUDY_SORT_KEYS,
+            filters,
+            params,
+            size=size,
+            cursor=cursor,
+            sort_by=sort_by,
+            sort_order=sort_order,
+        )
+
+        return self.paginated_response(data, total, next_cursor)
 
 
 class Study(NIGEndpoint):
@@ -120,6 +162,7 @@ def post(self, user: User, **kwargs: Any) -> Response:
         study = graph.Study(**kwargs).save()
 
         study.ownership.connect(user)
+        update_stats(user.belongs_to.single().uuid, studies=1)
 
         path = self.getPath(user=user, study=study)
 
@@ -181,9 +224,13 @@ def delete(self, uuid: str, user: User) -> Response:
         input_path = self.getPath(user=user, study=study)
         output_path = self.getPath(user=user, study=study, get_output_dir=True)
 
+        group_uuid = user.belongs_to.single().uuid
         for d in study.datasets.all():
+            remove_dataset_stats(group_uuid, d)
             for f in d.files.all():
                 f.delete()
+            for f in d.results.all():
+                f.delete()
             d.delete()
 
         for n in study.phenotypes.all():
@@ -193,6 +240,7 @@ def delete(self, uuid: str, user: User) -> Response:
             n.delete()
 
         study.delete()
+        update_stats(group_uuid, studies=-1)
 
         # remove the study folders
         shutil.rmtree(input_path)
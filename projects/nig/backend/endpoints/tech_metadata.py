@@ -1,7 +1,8 @@
-from typing import Any, Dict
+from typing import Any, Dict, Optional
 
 from marshmallow import pre_load
-from nig.endpoints import TECHMETA_NOT_FOUND, NIGEndpoint
+from nig.endpoints import TECHMETA_NOT_FOUND, ListQuery, NIGEndpoint, get_page
+from nig.endpoints._dataset_schema import invalidate_dataset_schema
 from restapi import decorators
 from restapi.connectors import neo4j
 from restapi.exceptions import NotFound
@@ -22,6 +23,15 @@
     "Other",
 ]
 
+TECHMETA_LIST_MATCH = (
+    "MATCH (:Study {uuid: $study_uuid})<-[:DEFINED_IN]-(n:TechnicalMetadata)"
+)
+TECHMETA_SORT_KEYS = {
+    "created": "n.created",
+    "name": "n.name",
+    "sequencing_date": "n.sequencing_date",
+}
+
 
 class TechmetaInputSchema(Schema):
     name = fields.Str(required=True)
@@ -43,6 +53,15 @@ def null_platform(self, data: Dict[str, Any], **kwargs: Any) -> Dict[str, Any]:
         return data
 
 
+class TechmetaListQuery(ListQuery):
+    sort_by = fields.Str(
+        required=False,
+        load_default=None,
+        validate=validate.OneOf(list(TECHMETA_SORT_KEYS)),
+    )
+    platform = fields.Str(required=False, validate=validate.OneOf(PLATFORMS))
+
+
 class TechmetaOutputSchema(Schema):
     uuid = fields.Str(required=True)
     name = fields.Str(required=True)
@@ -65,21 +84,52 @@ class TechnicalMetadatas(NIGEndpoint):
             404: "This set of technical metadata cannot be found or you are not authorized to access",
         },
     )
+    @decorators.use_kwargs(TechmetaListQuery, location="query")
     @decorators.marshal_with(TechmetaOutputSchema(many=True), code=200)
-    def get(self, uuid: str, user: User) -> Response:
+    def get(
+        self,
+        uuid: str,
+        user: User,
+        sort_order: str,
+        size: int,
+        sort_by: Optional[str] = None,
+        cursor: Optional[str] = None,
+        name: Optional[str] = None,
+        platform: Optional[str] = None,
+    ) -> Response:
 
         graph = neo4j.get_instance()
 
         study = graph.Study.nodes.get_or_none(uuid=uuid)
         self.verifyStudyAccess(study, user=user, read=True)
-        nodeset = study.technicals
+
+        params: Dict[str, Any] = {"study_uuid": study.uuid}
+        filters = []
+        if name:
+            filters.append("n.name STARTS WITH $name")
+            params["name"] = name
+        if platform:
+            filters.append("n.platform = $platform")
+            params["platform"] = platform
+
+        rows, total, next_cursor = get_page(
+            TECHMETA_LIST_MATCH,
+            "n",
+            TECHMETA_SORT_KEYS,
+            filters,
+            params,
+            size=size,
+            cursor=cursor,
+            sort_by=sort_by,
+            sort_order=sort_order,
+        )
 
         data = []
-        for techmeta in nodeset.all():
+        for row in rows:
 
-            data.append(techmeta)
+            data.append(graph.TechnicalMetadata.inflate(row))
 
-        return self.response(data)
+        return self.paginated_response(data, total, next_cursor)
 
 
 class TechnicalMetadata(NIGEndpoint):
@@ -137,6 +187,7 @@ def post(self, uuid: str, user: User, **kwargs: Any) -> Response:
         techmeta = graph.TechnicalMetadata(**kwargs).save()
 
         techmeta.defined_in.connect(study)
+        invalidate_dataset_schema(study.uuid)
 
         self.log_event(self.events.create, techmeta, kwargs)
 
@@ -169,6 +220,7 @@ def put(self, uuid: str, user: User, **kwargs: Any) -> Response:
 
         graph.update_properties(techmeta, kwargs)
         techmeta.save()
+        invalidate_dataset_schema(study.uuid)
 
         self.log_event(self.events.modify, techmeta, kwargs)
 
@@ -195,6 +247,7 @@ def delete(self, uuid: str, user: User) -> Response:
         self.verifyStudyAccess(study, user=user, error_type="Technical Metadata")
 
         techmeta.delete()
+        invalidate_dataset_schema(study.uuid)
 
         self.log_event(self.events.delete, techmeta)
 
@@ -1,6 +1,8 @@
 import csv
 from typing import List, Optional
 
+from nig.endpoints._geodata import invalidate_geodata_cache
+from nig.endpoints.stats import recount_stats
 from restapi.config import DATA_PATH
 from restapi.connectors import neo4j
 from restapi.utilities.logs import log
@@ -30,8 +32,13 @@ def __init__(self) -> None:
                                 setattr(geodata, key, value)
                                 geodata.save()
 
+        invalidate_geodata_cache()
         log.info("GeoData nodes succesfully created")
 
+        # initialize the materialized stats
+        recount_stats()
+        log.info("Stats succesfully computed")
+
     # This method is called after normal initialization if TESTING mode is enabled
     def initialize_testing_environment(self) -> None:
         pass
@@ -57,6 +57,8 @@ class Dataset(TimestampedNode):
     status_update = DateTimeProperty()
     error_message = StringProperty()
     joint_analysis = BooleanProperty()
+    # expected end of the analysis while queued
+    eta = DateTimeProperty()
 
     ownership = RelationshipTo(
         "restapi.connectors.neo4j.models.User", "IS_OWNED_BY", cardinality=ZeroOrMore
@@ -64,6 +66,7 @@ class Dataset(TimestampedNode):
     parent_study = RelationshipFrom("Study", "CONTAINS", cardinality=ZeroOrMore)
     linked_studies = RelationshipFrom("Study", "IS_LINKED", cardinality=ZeroOrMore)
     files = RelationshipTo("File", "CONTAINS", cardinality=ZeroOrMore)
+    results = RelationshipTo("File", "HAS_RESULT", cardinality=ZeroOrMore)
     phenotype = RelationshipTo("Phenotype", "IS_DESCRIBED_BY", cardinality=ZeroOrOne)
     technical = RelationshipTo(
         "TechnicalMetadata", "IS_DESCRIBED_BY", cardinality=ZeroOrOne
@@ -129,12 +132,22 @@ class VariantRelation(StructuredRel):  # type: ignore
 class File(IdentifiedNode):
     name = StringProperty(required=True)
     type = StringProperty()
+    # fastq, bam, bai, vcf, gvcf, tbi or other
+    kind = StringProperty(index=True)
+    # absolute path, only set for the analysis results
+    path = StringProperty()
     size = IntegerProperty()
+    # modification time of the result when registered
+    mtime = FloatProperty()
     status = StringProperty()
     task_id = StringProperty()
     metadata = JSONProperty()
+    # computed during the upload, or expected until the upload is completed
+    md5 = StringProperty()
+    sha256 = StringProperty()
 
     dataset = RelationshipFrom("Dataset", "CONTAINS", cardinality=ZeroOrMore)
+    result_of = RelationshipFrom("Dataset", "HAS_RESULT", cardinality=ZeroOrMore)
 
     has_variant = RelationshipFrom(
         "Variant", "OBSERVED_IN", cardinality=ZeroOrMore, model=VariantRelation
@@ -327,3 +340,26 @@ class HPO(StructuredNode):  # type: ignore
 
     parent = RelationshipFrom("HPO", "IS_CHILD_OF")
     children = RelationshipTo("HPO", "IS_CHILD_OF")
+
+
+class Stats(StructuredNode):  # type: ignore
+    # materialized counters of the studies, datasets and files of a group
+    group_uuid = StringProperty(required=True, unique_index=True)
+    studies = IntegerProperty(default=0)
+    datasets = IntegerProperty(default=0)
+    files = IntegerProperty(default=0)
+    datasets_with_vcf = IntegerProperty(default=0)
+    datasets_with_gvcf = IntegerProperty(default=0)
+
+
+class StatsSnapshot(StructuredNode):  # type: ignore
+    # daily copy of the counters of a group, taken by scripts/stats_snapshot.py
+    date = DateProperty(required=True, index=True)
+    group_uuid = StringProperty(required=True, index=True)
+    group_name = StringProperty()
+    studies = IntegerProperty(default=0)
+    datasets = IntegerProperty(default=0)
+    files = IntegerProperty(default=0)
+    datasets_with_vcf = IntegerProperty(default=0)
+    datasets_with_gvcf = IntegerProperty(default=0)
+    completed_analyses = IntegerProperty(default=0)
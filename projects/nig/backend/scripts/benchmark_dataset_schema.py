@@ -0,0 +1,45 @@
+#!/usr/bin/python3
+
+# Micro-benchmark of the dataset input schema generation.
+# Usage: python3 benchmark_dataset_schema.py [study_uuid] [iterations]
+
+import sys
+import timeit
+
+from nig.endpoints._dataset_schema import get_dataset_schema, invalidate_dataset_schema
+from nig.endpoints.dataset import build_input_schema
+from restapi.connectors import neo4j
+from restapi.utilities.logs import log
+
+graph = neo4j.get_instance()
+
+if len(sys.argv) > 1:
+    study = graph.Study.nodes.get_or_none(uuid=sys.argv[1])
+else:
+    study = graph.Study.nodes.first_or_none()
+
+if study is None:
+    log.error("No study found")
+    sys.exit(1)
+
+iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+
+
+def uncached() -> None:
+    build_input_schema(study.uuid, True)
+
+
+def cached() -> None:
+    get_dataset_schema(study.uuid, True, lambda: build_input_schema(study.uuid, True))
+
+
+invalidate_dataset_schema(study.uuid)
+
+for name, func in (("uncached", uncached), ("cached", cached)):
+    elapsed = timeit.timeit(func, number=iterations)
+    log.info(
+        "{}: {:.3f} ms per request ({} iterations)",
+        name,
+        elapsed * 1000 / iterations,
+        iterations,
+    )
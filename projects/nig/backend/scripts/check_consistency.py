@@ -0,0 +1,17 @@
+#!/usr/bin/python3
+
+import sys
+
+from restapi.connectors import celery
+from restapi.utilities.logs import log
+
+# the incremental scan only lists the directories modified since the last one,
+# a periodic full scan is requested with --full
+full = "--full" in sys.argv[1:]
+
+log.info("Starting check consistency cron (full scan: {})", full)
+
+c = celery.get_instance()
+task = c.celery_app.send_task("check_consistency", kwargs={"full": full})
+
+log.info("Consistency check sent to task {}\n", task)
@@ -3,8 +3,8 @@
 from datetime import datetime
 
 import pytz
+from nig.tasks.launch_pipeline import CHUNKS_LIMIT, FAN_OUT, update_queue_etas
 from restapi.connectors import celery, neo4j
-from restapi.env import Env
 from restapi.utilities.logs import log
 
 log.info("Starting init pipeline cron")
@@ -16,11 +16,9 @@
 # get all the dataset uuid
 datasets_uuid = [x.uuid for x in datasets_to_analise]
 
-chunks_limit = Env.get_int("CHUNKS_LIMIT", 16)
-
 for chunk in [
-    datasets_uuid[i : i + chunks_limit]
-    for i in range(0, len(datasets_uuid), chunks_limit)
+    datasets_uuid[i : i + CHUNKS_LIMIT]
+    for i in range(0, len(datasets_uuid), CHUNKS_LIMIT)
 ]:
     log.info("Sending pipeline for datasets: {}", chunk)
     # pass the chunk to the celery task
@@ -28,6 +26,7 @@
     task = c.celery_app.send_task(
         "launch_pipeline",
         args=(chunk,),
+        kwargs={"fan_out": FAN_OUT},
         countdown=1,
     )
     log.info("{} datasets sent to task {}", len(chunk), task)
@@ -38,4 +37,7 @@
         dataset.status_update = datetime.now(pytz.utc)
         dataset.save()
 
+# the queued datasets get the expected end of their analysis
+update_queue_etas()
+
 log.info("Init pipeline cron completed\n")
@@ -0,0 +1,11 @@
+#!/usr/bin/python3
+
+from nig.endpoints.stats import recount_stats
+from restapi.utilities.logs import log
+
+log.info("Starting refresh stats cron")
+
+# recount all the materialized stats to correct any drift of the counters
+recount_stats()
+
+log.info("Refresh stats cron completed\n")
@@ -0,0 +1,50 @@
+#!/usr/bin/python3
+
+# Backfill of the File.kind property and of the results of the datasets
+# analysed before the registration of the results was introduced
+
+from typing import Any, Dict
+
+from nig.endpoints import OUTPUT_ROOT
+from nig.endpoints._files import get_file_kind, register_results
+from nig.endpoints.stats import recount_stats
+from restapi.connectors import neo4j
+from restapi.utilities.logs import log
+
+BATCH_SIZE = 1000
+
+SET_KIND_QUERY = """
+UNWIND $files AS file
+MATCH (f:File {uuid: file.uuid})
+SET f.kind = file.kind
+"""
+
+COMPLETED_DATASETS_QUERY = """
+MATCH (g:Group)<-[:BELONGS_TO]-(:User)<-[:IS_OWNED_BY]-(d:Dataset {status: "COMPLETED"})
+MATCH (s:Study)-[:CONTAINS]->(d)
+RETURN g.uuid, s.uuid, d.uuid
+"""
+
+log.info("Starting file kind backfill")
+graph = neo4j.get_instance()
+
+files = [
+    {"uuid": uuid, "kind": get_file_kind(name)}
+    for uuid, name in graph.cypher(
+        "MATCH (f:File) WHERE f.kind IS NULL RETURN f.uuid, f.name"
+    )
+]
+for i in range(0, len(files), BATCH_SIZE):
+    params: Dict[str, Any] = {"files": files[i : i + BATCH_SIZE]}
+    graph.cypher(SET_KIND_QUERY, **params)
+log.info("Kind set for {} files", len(files))
+
+results = 0
+for group_uuid, study_uuid, dataset_uuid in graph.cypher(COMPLETED_DATASETS_QUERY):
+    output_path = OUTPUT_ROOT.joinpath(group_uuid, study_uuid, dataset_uuid)
+    results += register_results(dataset_uuid, output_path)
+log.info("{} results registered", results)
+
+recount_stats()
+
+log.info("File kind backfill completed\n")
@@ -0,0 +1,11 @@
+#!/usr/bin/python3
+
+from nig.endpoints.stats import take_stats_snapshot
+from restapi.utilities.logs import log
+
+log.info("Starting stats snapshot cron")
+
+# store today's counters of every group to build the stats history
+groups = take_stats_snapshot()
+
+log.info("Stats snapshot cron completed: {} groups stored\n", groups)
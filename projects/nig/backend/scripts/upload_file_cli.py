@@ -1,12 +1,82 @@
-import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from mimetypes import MimeTypes
 from pathlib import Path
+from threading import local
+from typing import Dict, List, Optional, Tuple
 
 import requests
 import typer
 
 app = typer.Typer()
 
+MB = 1024 * 1024
+# attempts for each chunk before giving up, the upload can then be resumed
+CHUNK_ATTEMPTS = 3
+
+thread_data = local()
+
+
+def get_session(headers: Dict[str, str]) -> requests.Session:
+    # a session (and its connection) for each thread
+    if not hasattr(thread_data, "session"):
+        thread_data.session = requests.Session()
+        thread_data.session.headers.update(headers)
+    session: requests.Session = thread_data.session
+    return session
+
+
+def get_chunks(missing: List[List[int]], chunksize: int) -> List[Tuple[int, int]]:
+    # split the missing ranges (stop excluded) in chunks
+    chunks = []
+    for start, stop in missing:
+        for offset in range(start, stop, chunksize):
+            chunks.append((offset, min(offset + chunksize, stop)))
+    return chunks
+
+
+def send_chunk(
+    url: str,
+    headers: Dict[str, str],
+    file: Path,
+    filesize: int,
+    chunk: Optional[Tuple[int, int]],
+) -> requests.Response:
+    if chunk is None:
+        # no data to send, only asking to complete the upload
+        content_range = f"bytes */{filesize}"
+        data = b""
+    else:
+        start, stop = chunk
+        content_range = f"bytes {start}-{stop - 1}/{filesize}"
+        with open(file, "rb") as f:
+            f.seek(start)
+            data = f.read(stop - start)
+
+    session = get_session(headers)
+    for attempt in range(1, CHUNK_ATTEMPTS + 1):
+        try:
+            r = session.put(
+                url,
+                headers={"Content-Range": content_range},
+                data=data,
+                timeout=300,
+            )
+            if r.status_code in (200, 206) or attempt == CHUNK_ATTEMPTS:
+                return r
+        except requests.exceptions.ConnectionError:
+            if attempt == CHUNK_ATTEMPTS:
+                raise
+    return r  # pragma: no cover
+
+
+def compute_md5(file: Path) -> str:
+    md5 = hashlib.md5()
+    with open(file, "rb") as f:
+        while data := f.read(16 * MB):
+            md5.update(data)
+    return md5.hexdigest()
+
 
 @app.command()
 def upload(
@@ -16,6 +86,11 @@ def upload(
     totp: str = typer.Option(None, prompt=True),
     env: str = typer.Option("local", help="choose between local and dev"),
     dataset: str = typer.Option(None, help="dataset uuid"),
+    connections: int = typer.Option(4, min=1, help="number of parallel uploads"),
+    chunk_size: int = typer.Option(8, min=1, help="size of the chunks in MB"),
+    checksum: bool = typer.Option(
+        False, help="compute the md5 of the file to verify the upload"
+    ),
 ) -> None:
     if env == "local":
         url = "http://localhost:8080/"
@@ -50,73 +125,87 @@ def upload(
     # get the data for the upload request
     filename = file.name
     filesize = file.stat().st_size
-    mimeType = MimeTypes().guess_type(str(file))
-    lastModified = int(file.stat().st_mtime)
-
-    data = {
-        "name": filename,
-        "mimeType": mimeType,
-        "size": filesize,
-        "lastModified": lastModified,
-    }
-
-    # init the upload
-
-    r = requests.post(
-        f"{url}api/dataset/{dataset}/files/upload",
-        headers=headers,
-        data=data,
-        timeout=30,
-    )
-    if r.status_code != 201:
-        typer.echo(
-            f"ERROR: can't start the upload. Status {r.status_code}, response: {r.json()}"
+    upload_url = f"{url}api/dataset/{dataset}/files/upload/{filename}"
+
+    # check if an interrupted upload can be resumed
+    r = requests.get(upload_url, headers=headers, timeout=30)
+    if r.status_code == 200 and r.json()["size"] == filesize:
+        if r.json()["status"] != "importing":
+            typer.echo("The file has already been uploaded")
+            return None
+        missing = r.json()["missing"]
+        typer.echo(f"Resuming the upload, {r.json()['received']} bytes received")
+    else:
+        mimeType = MimeTypes().guess_type(str(file))
+        lastModified = int(file.stat().st_mtime)
+
+        data = {
+            "name": filename,
+            "mimeType": mimeType,
+            "size": filesize,
+            "lastModified": lastModified,
+        }
+        if checksum:
+            typer.echo("Computing the md5 checksum")
+            data["md5"] = compute_md5(file)
+
+        # init the upload
+        r = requests.post(
+            f"{url}api/dataset/{dataset}/files/upload",
+            headers=headers,
+            data=data,
+            timeout=30,
         )
-        return None
-
-    typer.echo("Upload initialized succesfully")
-
-    chunksize = 100000  # 1kb
-    range_start = 0
-
-    with open(file, "rb") as f:
-        with typer.progressbar(length=filesize, label="Uploading") as progress:
-            while True:
-                read_data = f.read(chunksize)
-                if not read_data:
-                    break  # done
-                if range_start != 0:
-                    range_start += 1
-                range_max = range_start + chunksize
-                if range_max > filesize:
-                    range_max = filesize
-                headers["Content-Range"] = f"bytes {range_start}-{range_max}/{filesize}"
-                r = requests.put(
-                    f"{url}api/dataset/{dataset}/files/upload/{filename}",
-                    headers=headers,
-                    data=read_data,
-                    timeout=30,
-                )
-                if r.status_code != 206:
-                    if r.status_code == 200:
-                        # upload is complete
-                        progress.update(filesize)
-                        break
-                    typer.echo(
-                        f"ERROR: Fail in uploading the file. Status: {r.status_code}, response: {r.json()}"
-                    )
-                    return None
-                # update the typer progress bar
-                time.sleep(1)
-                progress.update(chunksize)
-                # update the range variable
-                range_start += chunksize
-        if r.status_code == 200:
-            typer.echo("Upload finished succesfully")
-        else:
+        if r.status_code != 201:
             typer.echo(
-                f"ERROR: Fail in uploading the file. Status: {r.status_code}, response: {r.json()}"
+                f"ERROR: can't start the upload. Status {r.status_code}, response: {r.json()}"
             )
+            return None
+
+        typer.echo("Upload initialized succesfully")
+        missing = [[0, filesize]]
+
+    chunks = get_chunks(missing, chunk_size * MB)
+    # the chunk completing the upload is sent when all the others are received,
+    # without chunks left (e.g. an empty file) the upload is only completed
+    last_chunk = chunks.pop() if chunks else None
+
+    failed: Optional[requests.Response] = None
+    with typer.progressbar(length=filesize, label="Uploading") as progress:
+        with ThreadPoolExecutor(max_workers=connections) as executor:
+            futures = {
+                executor.submit(
+                    send_chunk, upload_url, headers, file, filesize, chunk
+                ): chunk
+                for chunk in chunks
+            }
+            for future in as_completed(futures):
+                r = future.result()
+                if r.status_code != 206:
+                    failed = r
+                    # cancel_futures is not available before python 3.9
+                    for pending in futures:
+                        pending.cancel()
+                    executor.shutdown(wait=False)
+                    break
+                start, stop = futures[future]
+                progress.update(stop - start)
+
+        if not failed:
+            r = send_chunk(upload_url, headers, file, filesize, last_chunk)
+            if r.status_code == 200:
+                if last_chunk:
+                    progress.update(last_chunk[1] - last_chunk[0])
+            else:
+                failed = r
+
+    if failed is None:
+        typer.echo("Upload finished succesfully")
+    else:
+        typer.echo(
+            f"ERROR: Fail in uploading the file. Status: {failed.status_code}, "
+            f"response: {failed.json()}. Run the command again to resume the upload"
+        )
     return None
 
 
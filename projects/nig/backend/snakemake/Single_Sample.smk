@@ -61,6 +61,8 @@ rule BwaS:
         config["THREAD"]["bwa"]
     params:
         config["PARAMS"]["bwas"]
+    resources:
+        mem_mb=config["MEMORY"]["bwa"]
     shell:
         "bwa mem -t {threads} {params} {refg} {input.i} 1> {output} 2> {log} "
 
@@ -80,6 +82,8 @@ rule BwaP:
         config["THREAD"]["bwa"]
     params:
         config["PARAMS"]["bwap"]
+    resources:
+        mem_mb=config["MEMORY"]["bwa"]
     shell:
         "seqtk mergepe {input.i1} {input.i2} | bwa mem -p -t {threads} {params} {refg} - 1> {output} 2> {log}"
 
@@ -112,6 +116,8 @@ rule Samsort:
         "{O}/bwa/{S}_sort_nodup.sam.benchmark"
     threads:
         config["THREAD"]["samtool"]
+    resources:
+        mem_mb=config["MEMORY"]["samtool"]
     shell:
         "samtools sort -@ {threads} {input} -O BAM -o {output} > {log} 2>&1"
 
@@ -139,6 +145,8 @@ rule BaseRecalibrator:
     params:
         jv = config["JAVA"]["brc"],
         p1=Mult_Params('--known-sites',[ config["IFOLDER"]["gatk"]+name for name in config["IFILES"]["dbsnp"] ])
+    resources:
+        mem_mb=config["MEMORY"]["brc"]
     shell:
         '''gatk {params.jv} BaseRecalibrator --input {input.bam} --output {output} \
         --reference {refg} {params.p1} --use-original-qualities -L {input.inter} > {log} 2>&1'''
@@ -158,6 +166,8 @@ rule ApplyBQSR:
         jv = config["JAVA"]["absq"],
         p1 = Mult_Params( '--static-quantized-quals' , config["PARAMS"]["absq"] ),
         p2 = '--use-original-qualities'
+    resources:
+        mem_mb=config["MEMORY"]["absq"]
     shell:
         '''gatk {params.jv} ApplyBQSR --input {input.bam} --output {output} --reference {refg} \
         --bqsr {input.rec}  {params.p1} {params.p2} -L {input.inter} > {log} 2>&1'''
@@ -179,6 +189,8 @@ rule HaplotypeCaller:
         p1 = Mult_Params( '-G' , config["PARAMS"]["hapl_g"] ) ,
         p2 = Mult_Params( '-GQB' , config["PARAMS"]["hapl_gqb"] ) ,
         p3 = '-native-pair-hmm-threads'
+    resources:
+        mem_mb=config["MEMORY"]["hapl"]
     shell:
         '''gatk {params.jv} HaplotypeCaller -R {refg} -I {input.bam} --intervals {input.inter} \
         -O {output} -ERC GVCF {params.p1} {params.p2} {params.p3} {threads}  > {log} 2>&1'''
@@ -0,0 +1,380 @@
+"""
+Admission of the pipeline tasks on the worker hosts.
+
+Each worker host publishes its cores, memory and scratch disk on redis and
+every pipeline task reserves the resources it needs on its host before
+starting snakemake, that then runs with the reserved cores and memory as its
+budget. The reservations of a host are checked and updated under a redis
+lock, so concurrent tasks can't oversubscribe it. A task not fitting in the
+free resources of its host is sent back to the queue to be taken later by
+any worker. Reservations are leases renewed while the task runs, so that
+the ones of the killed tasks expire whatever the duration of the analysis.
+
+The queued datasets get an ETA, estimated by assigning their tasks in order
+to the analysis slots of the known hosts, that become free at the expected
+end of the running reservations. The expected duration of the analysis of a
+dataset is a moving average of the measured ones, a task analysing several
+datasets at once takes as many rounds as needed to analyse all of them.
+"""
+
+import json
+import math
+import os
+import shutil
+import socket
+import time
+from contextlib import contextmanager
+from heapq import heapify, heappop, heappush
+from pathlib import Path
+from threading import Event, Thread
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional
+
+import yaml
+from restapi.config import DATA_PATH
+from restapi.connectors import neo4j, redis
+from restapi.env import Env
+from restapi.utilities.logs import log
+
+HOSTS_KEY = "nig:scheduler:hosts"
+RESERVATIONS_KEY = "nig:scheduler:reservations:{}"
+DURATION_KEY = "nig:scheduler:duration:{}"
+LOCK_KEY = "nig:scheduler:lock"
+
+MB = 1024 * 1024
+# hosts not seen for a day are not considered in the ETA estimation
+HOST_TTL = 86400
+# seconds after which the reservation of a task not renewing it is dropped
+RESERVATION_LEASE = 600
+# seconds before a task not admitted is tried again
+ADMISSION_DELAY = Env.get_int("SCHEDULER_ADMISSION_DELAY", 300)
+# expected duration of a dataset analysis until one has been measured
+DEFAULT_DATASET_DURATION = 6 * 3600
+# weight of the last measured duration in the moving average
+DURATION_SMOOTHING = 0.2
+# scratch space needed by an analysis, as a multiple of the input size
+SCRATCH_FACTOR = 4
+
+UPDATE_ETA_QUERY = """
+MATCH (d:Dataset)
+WHERE d.eta IS NOT NULL AND NOT d.uuid IN [e IN $etas | e.uuid]
+REMOVE d.eta
+WITH count(*) AS removed
+UNWIND $etas AS e
+MATCH (d:Dataset {uuid: e.uuid})
+SET d.eta = e.eta
+"""
+
+
+class Resources(NamedTuple):
+    cores: int
+    mem_mb: int
+    scratch_mb: int
+
+    def fits(self, available: "Resources") -> bool:
+        return (
+            self.cores <= available.cores
+            and self.mem_mb <= available.mem_mb
+            and self.scratch_mb <= available.scratch_mb
+        )
+
+    def minus(self, other: "Resources") -> "Resources":
+        return Resources(
+            self.cores - other.cores,
+            self.mem_mb - other.mem_mb,
+            self.scratch_mb - other.scratch_mb,
+        )
+
+    def limit(self, capacity: "Resources") -> "Resources":
+        return Resources(
+            min(self.cores, capacity.cores),
+            min(self.mem_mb, capacity.mem_mb),
+            min(self.scratch_mb, capacity.scratch_mb),
+        )
+
+    def times(self, count: int) -> "Resources":
+        return Resources(
+            self.cores * count, self.mem_mb * count, self.scratch_mb * count
+        )
+
+    def slots(self, demand: "Resources") -> int:
+        """
+        Number of tasks with the given demand running at once within these
+        resources, at least one
+        """
+        return max(
+            1,
+            min(
+                self.cores // max(demand.cores, 1),
+                self.mem_mb // max(demand.mem_mb, 1),
+            ),
+        )
+
+
+class Slot(NamedTuple):
+    # time at which the slot is free
+    free_at: float
+    # datasets analysed at once by a task in the slot
+    parallel: int
+
+
+def get_hostname() -> str:
+    return Env.get("SCHEDULER_HOSTNAME", socket.gethostname())
+
+
+def host_resources() -> Resources:
+    """
+    Resources of this host, the defaults can be overridden to leave room
+    for other services
+    """
+    memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // MB
+    jobs_dir = DATA_PATH.joinpath("jobs")
+    jobs_dir.mkdir(parents=True, exist_ok=True)
+    scratch = shutil.disk_usage(jobs_dir).free // MB
+    return Resources(
+        cores=Env.get_int("SCHEDULER_HOST_CORES", os.cpu_count() or 1),
+        mem_mb=Env.get_int("SCHEDULER_HOST_MEM_MB", memory),
+        scratch_mb=Env.get_int("SCHEDULER_HOST_SCRATCH_MB", scratch),
+    )
+
+
+def rule_resources(config_file: Path) -> Resources:
+    """
+    Resources needed by the largest rule declared in the snakemake config
+    """
+    with open(config_file) as f:
+        config = yaml.safe_load(f)
+    return Resources(
+        cores=max(config.get("THREAD", {}).values(), default=1),
+        mem_mb=max(config.get("MEMORY", {}).values(), default=0),
+        scratch_mb=0,
+    )
+
+
+def task_demand(
+    config_file: Path, cores: int, mem_mb: int, input_bytes: int = 0
+) -> Resources:
+    """
+    Resources to reserve for a task with the given budget, never less than
+    the ones needed by the largest rule so that every job can be started
+    """
+    largest = rule_resources(config_file)
+    return Resources(
+        cores=max(cores, largest.cores),
+        mem_mb=max(mem_mb, largest.mem_mb),
+        scratch_mb=input_bytes * SCRATCH_FACTOR // MB,
+    )
+
+
+def analysis_rounds(datasets: int, parallel: int) -> int:
+    """
+    Rounds needed by a task to analyse the datasets, parallel at a time
+    """
+    return max(1, math.ceil(datasets / max(parallel, 1)))
+
+
+def get_dataset_duration(analysis: str = "single") -> float:
+    r = redis.get_instance().r
+    duration = r.get(DURATION_KEY.format(analysis))
+    return float(duration) if duration else DEFAULT_DATASET_DURATION
+
+
+def add_dataset_duration(duration: float, analysis: str = "single") -> None:
+    r = redis.get_instance().r
+    average = get_dataset_duration(analysis)
+    r.set(
+        DURATION_KEY.format(analysis),
+        average + DURATION_SMOOTHING * (duration - average),
+    )
+
+
+def get_reservations(host: str, now: float) -> Dict[str, Dict[str, Any]]:
+    """
+    Return the reservations of a host, dropping the expired ones
+    """
+    r = redis.get_instance().r
+    key = RESERVATIONS_KEY.format(host)
+    reservations = {}
+    for task_id, value in r.hgetall(key).items():
+        reservation = json.loads(value)
+        if reservation["expires"] < now:
+            log.warning("Reservation of task {} expired", task_id.decode())
+            r.hdel(key, task_id)
+            continue
+        reservations[task_id.decode()] = reservation
+    return reservations
+
+
+def reserved_resources(reservations: Dict[str, Dict[str, Any]]) -> Resources:
+    return Resources(
+        cores=sum(r["cores"] for r in reservations.values()),
+        mem_mb=sum(r["mem_mb"] for r in reservations.values()),
+        scratch_mb=sum(r["scratch_mb"] for r in reservations.values()),
+    )
+
+
+def reserve(task_id: str, demand: Resources, duration: float) -> Optional[Resources]:
+    """
+    Reserve the resources on this host, returns the reserved resources or
+    None if they are not available now
+    """
+    r = redis.get_instance().r
+    host = get_hostname()
+    capacity = host_resources()
+    now = time.time()
+    # a task larger than the host can only run alone, within the whole host
+    demand = demand.limit(capacity)
+
+    with r.lock(LOCK_KEY, timeout=60, blocking_timeout=60):
+        r.hset(HOSTS_KEY, host, json.dumps({**capacity._asdict(), "updated": now}))
+
+        reservations = get_reservations(host, now)
+        reserved = reserved_resources(reservations)
+        # the scratch space already written by the running tasks is counted
+        # both in the reservations and in the used disk, to be safe
+        if not demand.fits(capacity.minus(reserved)):
+            log.info(
+                "Task {} not admitted on {}: {} requested, {} reserved of {}",
+                task_id,
+                host,
+                demand,
+                reserved,
+                capacity,
+            )
+            return None
+
+        reservation = {
+            **demand._asdict(),
+            "started": now,
+            "expected_end": now + duration,
+            "expires": now + RESERVATION_LEASE,
+        }
+        r.hset(RESERVATIONS_KEY.format(host), task_id, json.dumps(reservation))
+
+    log.info("Task {} admitted on {} with {}", task_id, host, demand)
+    return demand
+
+
+def renew(task_id: str) -> None:
+    r = redis.get_instance().r
+    key = RESERVATIONS_KEY.format(get_hostname())
+    with r.lock(LOCK_KEY, timeout=60, blocking_timeout=60):
+        value = r.hget(key, task_id)
+        if value is None:
+            log.warning("Reservation of task {} not found", task_id)
+            return
+        reservation = json.loads(value)
+        reservation["expires"] = time.time() + RESERVATION_LEASE
+        r.hset(key, task_id, json.dumps(reservation))
+
+
+def release(task_id: str) -> None:
+    r = redis.get_instance().r
+    r.hdel(RESERVATIONS_KEY.format(get_hostname()), task_id)
+
+
+@contextmanager
+def hold_reservation(task_id: str) -> Iterator[None]:
+    """
+    Renew the reservation of a task while it runs and release it at the end
+    """
+    stopped = Event()
+
+    def renew_lease() -> None:
+        while not stopped.wait(RESERVATION_LEASE / 3):
+            try:
+                renew(task_id)
+            except Exception as e:  # pragma: no cover
+                log.error("Failed to renew the reservation of task {}: {}", task_id, e)
+
+    renewer = Thread(target=renew_lease, daemon=True)
+    renewer.start()
+    try:
+        yield
+    finally:
+        stopped.set()
+        renewer.join()
+        release(task_id)
+
+
+def host_slots(
+    capacity: Resources,
+    demand: Resources,
+    dataset_demand: Resources,
+    ends: List[float],
+    now: float,
+) -> List[Slot]:
+    """
+    Slots of a host for tasks with the given demand, each analysing as many
+    datasets at once as allowed by the demand. Running reservations free the
+    slots at their expected end, the latest ones being the last to free them
+    """
+    demand_on_host = demand.limit(capacity)
+    count = capacity.slots(demand_on_host)
+    parallel = demand_on_host.slots(dataset_demand)
+    ends = sorted(max(end, now) for end in ends)
+    # the earliest ends free resources not enough for a whole slot
+    skipped = len(ends) - count
+    return [
+        Slot(ends[skipped + position] if skipped + position >= 0 else now, parallel)
+        for position in range(count)
+    ]
+
+
+def get_slots(demand: Resources, dataset_demand: Resources, now: float) -> List[Slot]:
+    """
+    Slots of the known hosts for tasks with the given demand
+    """
+    r = redis.get_instance().r
+    slots: List[Slot] = []
+    for host, value in r.hgetall(HOSTS_KEY).items():
+        info = json.loads(value)
+        if info.pop("updated") < now - HOST_TTL:
+            continue
+        reservations = get_reservations(host.decode(), now)
+        ends = [res["expected_end"] for res in reservations.values()]
+        slots.extend(host_slots(Resources(**info), demand, dataset_demand, ends, now))
+
+    if not slots:
+        # no host has ever run an analysis
+        slots = [Slot(now, demand.slots(dataset_demand))]
+    return slots
+
+
+def estimate_etas(slots: List[Slot], tasks: List[int], duration: float) -> List[float]:
+    """
+    Return the expected end of the tasks, given as the number of datasets
+    they analyse, assigned in order to the first free slot
+    """
+    heap = list(slots)
+    heapify(heap)
+    etas = []
+    for datasets in tasks:
+        slot = heappop(heap)
+        end = slot.free_at + duration * analysis_rounds(datasets, slot.parallel)
+        heappush(heap, Slot(end, slot.parallel))
+        etas.append(end)
+    return etas
+
+
+def update_etas(dataset_demand: Resources, chunk_size: int = 1) -> None:
+    """
+    Set the ETA of the queued datasets, analysed in the order they have been
+    queued by tasks of chunk_size datasets each
+    """
+    graph = neo4j.get_instance()
+    queued = graph.Dataset.nodes.filter(status="QUEUED").order_by("status_update")
+    uuids = [d.uuid for d in queued]
+    chunks = [uuids[i : i + chunk_size] for i in range(0, len(uuids), chunk_size)]
+
+    now = time.time()
+    slots = get_slots(dataset_demand.times(chunk_size), dataset_demand, now)
+    etas = estimate_etas(slots, [len(c) for c in chunks], get_dataset_duration())
+    # stored as the timestamps of the neomodel DateTimeProperty
+    params: Dict[str, Any] = {
+        "etas": [
+            {"uuid": uuid, "eta": eta}
+            for chunk, eta in zip(chunks, etas)
+            for uuid in chunk
+        ]
+    }
+    graph.cypher(UPDATE_ETA_QUERY, **params)
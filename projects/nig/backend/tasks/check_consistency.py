@@ -0,0 +1,209 @@
+import os
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from nig.endpoints import INPUT_ROOT, OUTPUT_ROOT
+from nig.endpoints._files import (
+    RESULT_FOLDERS,
+    UPDATE_FILE_STATUS_QUERY,
+    get_file_status,
+    register_results,
+    scan_file_sizes,
+    scan_results,
+)
+from restapi.connectors import neo4j, redis
+from restapi.connectors.celery import CeleryExt, Task
+from restapi.utilities.logs import log
+
+# start time of the last completed scan
+CHECKPOINT_KEY = "nig:consistency:checkpoint"
+# directories modified slightly before the checkpoint are scanned again
+# to be safe against the coarse granularity of the filesystem timestamps
+CHECKPOINT_MARGIN = 5.0
+# number of dataset directories reconciled with a single query
+SCAN_BATCH_SIZE = 200
+
+INPUT_FILES_QUERY = """
+UNWIND $dataset_uuids AS dataset_uuid
+OPTIONAL MATCH (d:Dataset {uuid: dataset_uuid})
+RETURN
+    dataset_uuid,
+    d IS NOT NULL,
+    [(d)-[:CONTAINS]->(f:File) | f {.uuid, .name, .size, .status}]
+"""
+
+OUTPUT_FILES_QUERY = """
+UNWIND $dataset_uuids AS dataset_uuid
+OPTIONAL MATCH (d:Dataset {uuid: dataset_uuid})
+RETURN
+    dataset_uuid,
+    d IS NOT NULL,
+    [(d)-[:HAS_RESULT]->(f:File) | f {.path, .size, .mtime}]
+"""
+
+DatasetDir = Tuple[str, Path]
+
+
+def get_mtime(path: str) -> float:
+    try:
+        return os.stat(path).st_mtime
+    except FileNotFoundError:
+        return 0.0
+
+
+def subdirectories(path: str) -> Iterator[os.DirEntry]:  # type: ignore
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield entry
+
+
+def modified_datasets(
+    root: Path, checkpoint: float, folders: Optional[List[str]] = None
+) -> Iterator[DatasetDir]:
+    """
+    Yield the dataset directories (root/group/study/dataset) modified since
+    the checkpoint. Only the mtime of the dataset directories (or of their
+    given subfolders) is read, the contents of the unmodified ones are never
+    listed. Directories are yielded while walking, the tree is never loaded
+    """
+    if not root.is_dir():
+        return
+    for group in subdirectories(str(root)):
+        for study in subdirectories(group.path):
+            for dataset in subdirectories(study.path):
+                if folders:
+                    mtime = max(
+                        get_mtime(os.path.join(dataset.path, f)) for f in folders
+                    )
+                else:
+                    mtime = dataset.stat(follow_symlinks=False).st_mtime
+                if mtime >= checkpoint:
+                    yield dataset.name, Path(dataset.path)
+
+
+def batches(datasets: Iterator[DatasetDir]) -> Iterator[List[DatasetDir]]:
+    batch: List[DatasetDir] = []
+    for dataset in datasets:
+        batch.append(dataset)
+        if len(batch) >= SCAN_BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def check_input_batch(batch: List[DatasetDir], report: Dict[str, int]) -> None:
+    graph = neo4j.get_instance()
+    paths = dict(batch)
+
+    params: Dict[str, Any] = {"dataset_uuids": list(paths)}
+    changes: List[Dict[str, str]] = []
+    for dataset_uuid, exists, files in graph.cypher(INPUT_FILES_QUERY, **params):
+        path = paths[dataset_uuid]
+        if not exists:
+            log.warning("Orphan dataset directory: {}", path)
+            report["orphan_directories"] += 1
+            continue
+
+        sizes = scan_file_sizes(path)
+        report["files"] += len(sizes)
+        for file in files:
+            disk_size = sizes.pop(file["name"], None)
+            if disk_size is None:
+                log.warning("File {} not found in {}", file["uuid"], path)
+                report["orphan_nodes"] += 1
+            status = get_file_status(file["status"], file["size"], disk_size)
+            if status != file["status"]:
+                changes.append({"uuid": file["uuid"], "status": status})
+        # the remaining files on disk have no related node
+        for name in sizes:
+            log.warning("Orphan file: {}", path.joinpath(name))
+            report["orphan_files"] += 1
+
+    if changes:
+        params = {"changes": changes}
+        graph.cypher(UPDATE_FILE_STATUS_QUERY, **params)
+        report["fixed"] += len(changes)
+
+
+def check_output_batch(batch: List[DatasetDir], report: Dict[str, int]) -> None:
+    graph = neo4j.get_instance()
+    paths = dict(batch)
+
+    params: Dict[str, Any] = {"dataset_uuids": list(paths)}
+    for dataset_uuid, exists, registered in graph.cypher(OUTPUT_FILES_QUERY, **params):
+        path = paths[dataset_uuid]
+        if not exists:
+            log.warning("Orphan dataset output directory: {}", path)
+            report["orphan_directories"] += 1
+            continue
+
+        results = scan_results(path)
+        report["files"] += len(results)
+        on_disk = {r["path"]: (r["size"], r["mtime"]) for r in results}
+        in_graph = {r["path"]: (r["size"], r["mtime"]) for r in registered}
+        if on_disk == in_graph:
+            continue
+
+        for filepath in in_graph.keys() - on_disk.keys():
+            log.warning("Result {} not found, removed from the registry", filepath)
+            report["orphan_nodes"] += 1
+        # unregistered results and size or mtime drifts are fixed by registering again
+        register_results(dataset_uuid, path, results)
+        report["fixed"] += 1
+
+
+@CeleryExt.task(idempotent=True)
+def check_consistency(
+    self: Task[[bool], Dict[str, int]],
+    full: bool = False,
+) -> Dict[str, int]:
+    """
+    Reconcile the File nodes with the input and output directories.
+    Only the dataset directories modified since the last completed scan are
+    listed, unless a full scan is requested.
+    The results found in the output directories are registered, this is the
+    only registration of the datasets analysed before it was introduced,
+    since the downloads only read the registry
+
+    The incremental scan relies on the mtime of the dataset directories, so
+    it does not detect:
+    - files appended or truncated in place, that don't change the mtime of
+      their directory, hence size drifts of the uploaded files
+    - removed dataset directories, whose File nodes are never visited
+    Both are only fixed by the full scan, run weekly by cron
+    """
+    task_id = self.request.id
+    log.info("Start task [{}:{}]", task_id, self.name)
+
+    r = redis.get_instance().r
+    started = time.time()
+    checkpoint = 0.0
+    last_scan = r.get(CHECKPOINT_KEY)
+    if last_scan and not full:
+        checkpoint = float(last_scan) - CHECKPOINT_MARGIN
+
+    report = {
+        "datasets": 0,
+        "files": 0,
+        "fixed": 0,
+        "orphan_files": 0,
+        "orphan_nodes": 0,
+        "orphan_directories": 0,
+    }
+    for batch in batches(modified_datasets(INPUT_ROOT, checkpoint)):
+        report["datasets"] += len(batch)
+        check_input_batch(batch, report)
+
+    result_folders = list(RESULT_FOLDERS)
+    for batch in batches(modified_datasets(OUTPUT_ROOT, checkpoint, result_folders)):
+        report["datasets"] += len(batch)
+        check_output_batch(batch, report)
+
+    # the checkpoint is only moved forward by a completed scan
+    r.set(CHECKPOINT_KEY, started)
+
+    log.info("Consistency check completed: {}", report)
+    return report
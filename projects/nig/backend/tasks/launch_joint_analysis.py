@@ -1,13 +1,22 @@
 import os
 import re
 import shutil
+import time
 from pathlib import Path
 from typing import List
 
 from nig.endpoints import INPUT_ROOT, OUTPUT_ROOT
+from nig.tasks._scheduler import (
+    ADMISSION_DELAY,
+    add_dataset_duration,
+    get_dataset_duration,
+    hold_reservation,
+    reserve,
+    task_demand,
+)
 from pandas import DataFrame
 from restapi.config import DATA_PATH
-from restapi.connectors import neo4j
+from restapi.connectors import celery, neo4j
 from restapi.connectors.celery import CeleryExt, Task
 from restapi.connectors.smtp.notifications import send_notification
 from restapi.utilities.logs import log
@@ -23,6 +32,35 @@ def launch_joint_analysis(
 ) -> None:
     task_id = self.request.id
     log.info("Start joint analysis task [{}:{}]", task_id, self.name)
+
+    # the joint analysis uses all the cores of the host
+    config_file = Path("/snakemake").joinpath("config.yaml")
+    demand = task_demand(config_file, os.cpu_count() or 1, 0)
+    # the joint analysis is measured apart, its duration grows with the datasets
+    duration = get_dataset_duration("joint") * len(dataset_list)
+    granted = reserve(task_id, demand, duration)
+    if not granted:
+        # sent back to the queue, to be taken by a worker with free resources
+        c = celery.get_instance()
+        c.celery_app.send_task(
+            "launch_joint_analysis",
+            args=(dataset_list, snakefile, force),
+            countdown=ADMISSION_DELAY,
+        )
+        return None
+
+    with hold_reservation(task_id):
+        started = time.time()
+        run_joint_analysis(task_id, dataset_list, snakefile, force, granted.cores)
+        if dataset_list:
+            add_dataset_duration((time.time() - started) / len(dataset_list), "joint")
+
+    return None
+
+
+def run_joint_analysis(
+    task_id: str, dataset_list: List[str], snakefile: str, force: bool, cores: int
+) -> None:
     # create a job node related to the task
     graph = neo4j.get_instance()
     job = graph.JointAnalysisJob(uuid=task_id).save()
@@ -85,7 +123,6 @@ def launch_joint_analysis(
     # Launch snakemake
     config = [wrkdir.joinpath("config.yaml")]
 
-    cores = os.cpu_count()
     log.info("Calling Snakemake with {} cores and forceall {}", cores, force)
     snakefile_path = wrkdir.joinpath(snakefile)
 
@@ -105,5 +142,3 @@ def launch_joint_analysis(
     )
 
     log.info(f"job {task_id} completed")
-
-    return None
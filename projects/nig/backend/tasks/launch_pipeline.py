@@ -1,9 +1,9 @@
-import os
 import re
 import shutil
+import time
 from datetime import datetime
 from pathlib import Path
-from typing import List
+from typing import Any, Dict, List, Optional
 
 import pytz
 from juan.qc.applybqsr import ApplyBQSR  # type: ignore
@@ -13,99 +13,132 @@
 from juan.qc.haplotype import HaploType  # type: ignore
 from juan.qc.samsort import SamSort  # type: ignore
 from nig.endpoints import INPUT_ROOT, OUTPUT_ROOT
+from nig.endpoints._files import register_results
+from nig.endpoints.stats import recount_stats
+from nig.tasks._scheduler import (
+    ADMISSION_DELAY,
+    Resources,
+    add_dataset_duration,
+    analysis_rounds,
+    get_dataset_duration,
+    hold_reservation,
+    host_resources,
+    reserve,
+    task_demand,
+    update_etas,
+)
 from pandas import DataFrame
 from restapi.config import DATA_PATH
-from restapi.connectors import neo4j
+from restapi.connectors import celery, neo4j
 from restapi.connectors.celery import CeleryExt, Task
 from restapi.connectors.smtp.notifications import send_notification
+from restapi.env import Env
 from restapi.utilities.logs import log
 from snakemake import snakemake
 
+# the pattern is check also in the file upload endpoint. This is an additional check
+FASTQ_PATTERN = r"([a-zA-Z0-9_-]+)_(R[12]).fastq.gz"
+SNAKEMAKE_DIR = Path("/snakemake")
+INPUT_PARAMETER_PATH = "/code/juan/template_recaldat.log"
+
+# budget of the subtasks analysing a single dataset, several subtasks
+# can be executed at once by the workers of one or more nodes
+DATASET_CORES = Env.get_int("PIPELINE_DATASET_CORES", 16)
+DATASET_MEM_MB = Env.get_int("PIPELINE_DATASET_MEM_MB", 32768)
+# datasets sent to each pipeline task
+CHUNKS_LIMIT = Env.get_int("CHUNKS_LIMIT", 16)
+# analyse each dataset of the chunk in a separate subtask
+FAN_OUT = Env.get_bool("PIPELINE_FAN_OUT")
 
-@CeleryExt.task(idempotent=True, autoretry_for=(ConnectionResetError,))
-def launch_pipeline(
-    self: Task[[List[str], str, bool], None],
-    dataset_list: List[str],
-    snakefile: str = "Single_Sample.smk",
-    force: bool = False,
-) -> None:
-    task_id = self.request.id
-    log.info("Start task [{}:{}]", task_id, self.name)
-    # create a job node related to the task
-    graph = neo4j.get_instance()
-    job = graph.Job(uuid=task_id).save()
 
+def prepare_workdir(task_id: str) -> Path:
     # create a unique workdir for every celery task / and snakemake launch)
     wrkdir = DATA_PATH.joinpath("jobs", task_id)
     wrkdir.mkdir(parents=True, exist_ok=True)
     # copy the files used by snakemake in the work dir
-    source_dir = Path("/snakemake")
-    for snk_file in source_dir.glob("*"):
+    for snk_file in SNAKEMAKE_DIR.glob("*"):
         if snk_file.is_file():
             shutil.copy(snk_file, wrkdir)
+    return wrkdir
 
-    # get the file list from the dataset list
-    file_list = []
-    # the pattern is check also in the file upload endpoint. This is an additional check
-    pattern = r"([a-zA-Z0-9_-]+)_(R[12]).fastq.gz"
-    analized_datasets = []
-    for d in dataset_list:
-        # get the path of the dataset directory
-        dataset = graph.Dataset.nodes.get_or_none(uuid=d)
-        owner = dataset.ownership.single()
-        group = owner.belongs_to.single()
-        study = dataset.parent_study.single()
-        datasetDirectory = INPUT_ROOT.joinpath(group.uuid, study.uuid, dataset.uuid)
-        # check if the directory exists
-        if not datasetDirectory.exists():
-            # an error should be raised?
-            log.warning("Folder for dataset {} not found", d)
+
+def get_dataset_files(dataset: Any, job: Any) -> Optional[List[Path]]:
+    """
+    Return the fastq files of a dataset and mark it as running,
+    None if the dataset can't be analysed
+    """
+    owner = dataset.ownership.single()
+    group = owner.belongs_to.single()
+    study = dataset.parent_study.single()
+    datasetDirectory = INPUT_ROOT.joinpath(group.uuid, study.uuid, dataset.uuid)
+    # check if the directory exists
+    if not datasetDirectory.exists():
+        # an error should be raised?
+        log.warning("Folder for dataset {} not found", dataset.uuid)
+        return None
+    dataset_files = []
+    for f in datasetDirectory.iterdir():
+        # check if the pattern is respected
+        fname = f.name
+        if re.match(FASTQ_PATTERN, fname):
+            dataset_files.append(f)
+        else:
+            log.info(
+                "fastq {} should follow correct naming convention: "
+                "SampleName_R1/R2.fastq.gz",
+                f,
+            )
             continue
-        dataset_files = []
-        for f in datasetDirectory.iterdir():
-            # check if the pattern is respected
-            fname = f.name
-            if re.match(pattern, fname):
-                dataset_files.append(f)
-            else:
-                log.info(
-                    "fastq {} should follow correct naming convention: "
-                    "SampleName_R1/R2.fastq.gz",
-                    f,
-                )
-                continue
-        # check if in case of a single file it is of R1 type
-        if len(dataset_files) == 1:
-            fname = dataset_files[0].name
-            match = re.match(pattern, fname)
-            if match and match.group(2) == "R2":
-                # mark the dataset as error
-                msg = "R1 file is missing"
-                dataset.status = "ERROR"
-                dataset.error_message = msg
-                dataset.status_update = datetime.now(pytz.utc)
-                # connect the dataset to the job node
-                dataset.job.connect(job, {"status": "ERROR", "error_message": msg})
-                dataset.save()
-                continue
-        if dataset_files:
-            for f in dataset_files:
-                # append the contained files in the file list
-                file_list.append(f)
-        # mark the dataset as running
-        dataset.status = "RUNNING"
-        dataset.status_update = datetime.now(pytz.utc)
-        # connect the dataset to the job node
-        dataset.job.connect(job, {"status": "RUNNING"})
-        dataset.save()
-        analized_datasets.append(d)
+    # check if in case of a single file it is of R1 type
+    if len(dataset_files) == 1:
+        fname = dataset_files[0].name
+        match = re.match(FASTQ_PATTERN, fname)
+        if match and match.group(2) == "R2":
+            # mark the dataset as error
+            msg = "R1 file is missing"
+            dataset.status = "ERROR"
+            dataset.error_message = msg
+            dataset.status_update = datetime.now(pytz.utc)
+            # connect the dataset to the job node
+            dataset.job.connect(job, {"status": "ERROR", "error_message": msg})
+            dataset.save()
+            return None
+    # mark the dataset as running
+    dataset.status = "RUNNING"
+    dataset.status_update = datetime.now(pytz.utc)
+    # connect the dataset to the job node
+    dataset.job.connect(job, {"status": "RUNNING"})
+    dataset.save()
+    return dataset_files
+
+
+def dataset_demand(datasets: List[Any], cores: int, mem_mb: int) -> Resources:
+    """
+    Resources to reserve for the analysis of the datasets
+    """
+    input_bytes = sum(f.size or 0 for d in datasets for f in d.files.all())
+    return task_demand(
+        SNAKEMAKE_DIR.joinpath("config.yaml"), cores, mem_mb, input_bytes
+    )
+
+
+def update_queue_etas() -> None:
+    demand = dataset_demand([], DATASET_CORES, DATASET_MEM_MB)
+    if FAN_OUT:
+        # the queued datasets are analysed by separate subtasks
+        update_etas(demand)
+    else:
+        # the queued datasets are analysed at once by a task for each chunk
+        update_etas(demand, CHUNKS_LIMIT)
 
+
+def write_fastq_csv(wrkdir: Path, file_list: List[Path]) -> Path:
     # create a list of fastq files as csv file: fastq.csv
     fastq = []
 
     for filepath in file_list:
         fname = filepath.name
-        match = re.match(pattern, fname)
+        match = re.match(FASTQ_PATTERN, fname)
         file_label = None
         fragment = None
         if match:
@@ -133,18 +166,28 @@ def launch_pipeline(
     log.info("*************************************")
     log.info("New file {} is now created", fastq_csv_file)
     log.info("Total Number Of Fastq identified:{}\n", df.shape[0])
+    return fastq_csv_file
+
 
+def run_snakemake(
+    wrkdir: Path,
+    snakefile: str,
+    force: bool,
+    cores: Optional[int],
+    resources: Optional[Dict[str, int]] = None,
+) -> None:
     # Launch snakemake
     config = [wrkdir.joinpath("config.yaml")]
 
-    cores = os.cpu_count()
-    log.info("Calling Snakemake with {} cores", cores)
+    log.info("Calling Snakemake with {} cores and resources {}", cores, resources)
     snakefile_path = wrkdir.joinpath(snakefile)
 
     # https://snakemake.readthedocs.io/en/stable/api_reference/snakemake.html
     snakemake(
         snakefile_path,
         cores=cores,
+        # jobs are only started if the declared resources fit the budget
+        resources=resources or {},
         workdir=wrkdir,
         configfiles=config,
         forceall=force,
@@ -156,116 +199,305 @@ def launch_pipeline(
         lock=False,
     )
 
-    # check the status of the analysed datasets
-    input_parameter_path = "/code/juan/template_recaldat.log"
-    for d in analized_datasets:
-        # get the output path
+
+def check_dataset(
+    dataset_uuid: str, job: Any, fastq_csv_file: Path, wrkdir: Path
+) -> Optional[str]:
+    """
+    Check the logs of the analysis of a dataset and set its final status.
+    Returns the uuid of the group owning the dataset
+    """
+    graph = neo4j.get_instance()
+    # get the output path
+    dataset = graph.Dataset.nodes.get_or_none(uuid=dataset_uuid)
+    if not dataset:
+        log.warning(f"no dataset with id {dataset_uuid} was found")
+        return None
+    owner = dataset.ownership.single()
+    group = owner.belongs_to.single()
+    study = dataset.parent_study.single()
+    output_path = OUTPUT_ROOT.joinpath(group.uuid, study.uuid, dataset.uuid)
+
+    # get the name of the sample
+    sample = "N/A"
+    for f in dataset.files.all():
+        sample = re.findall(FASTQ_PATTERN, f.name)[0][0]
+        break
+
+    check_list = [
+        "Fastqc",
+        "Bwa",
+        "SamSort",
+        "BaseRecalibrator",
+        "ApplyBQSR",
+        "HaploType",
+    ]
+    check_passed = None
+    error_message = None
+    try:
+        # log.info(f"checking for sample {sample} in {output_path}")
+        # check all the logs
+        Fastqc(path=f"{output_path}/fastqc/", sample=sample).check_log()
+        check_passed = "Fastqc"
+        Bwa(
+            path=f"{output_path}/bwa/", sample=sample, table_path=fastq_csv_file
+        ).check_log()
+        check_passed = "Bwa"
+        SamSort(
+            path=f"{output_path}/bwa/", sample=sample, table_path=fastq_csv_file
+        ).check_log(check_finish_statement=False, check_lines=False)
+        check_passed = "SamSort"
+        BaseRecalibrator(
+            path=f"{output_path}/gatk_bsr/",
+            sample=sample,
+            table_path=fastq_csv_file,
+            input_parameter_path=INPUT_PARAMETER_PATH,
+        ).check_log(check_final_section=False)
+        # check_final_section is excluded for now because raises an exception that should be a warning
+        check_passed = "BaseRecalibrator"
+        ApplyBQSR(
+            path=f"{output_path}/gatk_bsr/",
+            sample=sample,
+            input_parameter_path=INPUT_PARAMETER_PATH,
+        ).check_log(progressmeter_analysis=False)
+        # progressmeter_analysis and score are excluded for now because raise an index out of range exception
+        check_passed = "ApplyBQSR"
+        HaploType(
+            path=f"{output_path}/gatk_gvcf/",
+            sample=sample,
+        ).check_log()
+        check_passed = "HaploType"
+
+        # if all the checks are passed set the dataset status as COMPLETED
+        dataset_status = "COMPLETED"
+    except Exception as exc:
+        # get the check that raised the exception
+        if check_passed:
+            last_checked = check_list.index(check_passed)
+            check_failed_index = last_checked + 1
+        else:
+            check_failed_index = 0
+        error_message = f"Step {check_list[check_failed_index]}: {exc}"
+        # log.error(error_message)
+
+        # if the datasets has not passed all the checks its status will be ERROR
+        dataset_status = "ERROR"
+
+    # update the dataset status in the db
+    dataset.status = dataset_status
+    dataset.status_update = datetime.now(pytz.utc)
+    if error_message:
+        dataset.error_message = error_message
+    dataset.save()
+    # log.info(f"set status for dataset {d} as {dataset_status}")
+
+    if dataset_status == "COMPLETED":
+        # register the analysis results to be found by kind
+        register_results(dataset.uuid, output_path)
+
+    # update the job relationship
+    rel = dataset.job.relationship(job)
+    rel.status = dataset_status
+    if error_message:
+        rel.error_message = error_message
+    rel.save()
+
+    if dataset_status == "ERROR":
+        # send notification email
+        send_notification(
+            subject="A dataset analysis ended in an error",
+            template="dataset_error.html",
+            to_address=None,
+            data={
+                "dataset_id": dataset.uuid,
+                "dataset_name": dataset.name,
+                "study_id": study.uuid,
+                "study_name": study.name,
+                "error_message": error_message,
+                "output_path": output_path,
+                "job_path": wrkdir,
+            },
+        )
+
+    return str(group.uuid)
+
+
+@CeleryExt.task(idempotent=True, autoretry_for=(ConnectionResetError,))
+def launch_pipeline(
+    self: Task[[List[str], str, bool, bool], None],
+    dataset_list: List[str],
+    snakefile: str = "Single_Sample.smk",
+    force: bool = False,
+    fan_out: bool = False,
+) -> None:
+    task_id = self.request.id
+    log.info("Start task [{}:{}]", task_id, self.name)
+
+    if fan_out:
+        # each dataset is analysed by a subtask, with its own budget, so that
+        # the chunk is shared among the workers and a slow sample does not
+        # hold back the others
+        c = celery.get_instance()
+        for d in dataset_list:
+            subtask = c.celery_app.send_task(
+                "launch_dataset_pipeline", args=(d, snakefile, force)
+            )
+            log.info("Dataset {} sent to task {}", d, subtask)
+        return None
+
+    graph = neo4j.get_instance()
+    datasets = [graph.Dataset.nodes.get_or_none(uuid=d) for d in dataset_list]
+    # the datasets of the chunk are analysed at once, within the whole host
+    demand = dataset_demand(
+        [d for d in datasets if d],
+        DATASET_CORES * len(dataset_list),
+        DATASET_MEM_MB * len(dataset_list),
+    )
+    # the datasets not fitting in the reserved resources are analysed in rounds
+    parallel = granted_parallel(demand.limit(host_resources()))
+    duration = get_dataset_duration() * analysis_rounds(len(dataset_list), parallel)
+    granted = reserve(task_id, demand, duration)
+    if not granted:
+        # sent back to the queue, to be taken by a worker with free resources
+        c = celery.get_instance()
+        c.celery_app.send_task(
+            "launch_pipeline",
+            args=(dataset_list, snakefile, force),
+            countdown=ADMISSION_DELAY,
+        )
+        return None
+
+    try:
+        with hold_reservation(task_id):
+            run_chunk(task_id, dataset_list, snakefile, force, granted)
+    finally:
+        update_queue_etas()
+
+    return None
+
+
+def granted_parallel(granted: Resources) -> int:
+    """
+    Datasets analysed at once within the granted resources
+    """
+    return granted.slots(dataset_demand([], DATASET_CORES, DATASET_MEM_MB))
+
+
+def run_chunk(
+    task_id: str,
+    dataset_list: List[str],
+    snakefile: str,
+    force: bool,
+    granted: Resources,
+) -> None:
+    # create a job node related to the task
+    graph = neo4j.get_instance()
+    job = graph.Job(uuid=task_id).save()
+
+    wrkdir = prepare_workdir(task_id)
+
+    # get the file list from the dataset list
+    file_list = []
+    analized_datasets = []
+    for d in dataset_list:
         dataset = graph.Dataset.nodes.get_or_none(uuid=d)
-        if not dataset:
-            log.warning(f"no dataset with id {d} was found")
+        dataset_files = get_dataset_files(dataset, job)
+        if dataset_files is None:
             continue
-        owner = dataset.ownership.single()
-        group = owner.belongs_to.single()
-        study = dataset.parent_study.single()
-        output_path = OUTPUT_ROOT.joinpath(group.uuid, study.uuid, dataset.uuid)
-
-        # get the name of the sample
-        sample = "N/A"
-        for f in dataset.files.all():
-            sample = re.findall(pattern, f.name)[0][0]
-            break
-
-        check_list = [
-            "Fastqc",
-            "Bwa",
-            "SamSort",
-            "BaseRecalibrator",
-            "ApplyBQSR",
-            "HaploType",
-        ]
-        check_passed = None
-        error_message = None
-        try:
-            # log.info(f"checking for sample {sample} in {output_path}")
-            # check all the logs
-            Fastqc(path=f"{output_path}/fastqc/", sample=sample).check_log()
-            check_passed = "Fastqc"
-            Bwa(
-                path=f"{output_path}/bwa/", sample=sample, table_path=fastq_csv_file
-            ).check_log()
-            check_passed = "Bwa"
-            SamSort(
-                path=f"{output_path}/bwa/", sample=sample, table_path=fastq_csv_file
-            ).check_log(check_finish_statement=False, check_lines=False)
-            check_passed = "SamSort"
-            BaseRecalibrator(
-                path=f"{output_path}/gatk_bsr/",
-                sample=sample,
-                table_path=fastq_csv_file,
-                input_parameter_path=input_parameter_path,
-            ).check_log(check_final_section=False)
-            # check_final_section is excluded for now because raises an exception that should be a warning
-            check_passed = "BaseRecalibrator"
-            ApplyBQSR(
-                path=f"{output_path}/gatk_bsr/",
-                sample=sample,
-                input_parameter_path=input_parameter_path,
-            ).check_log(progressmeter_analysis=False)
-            # progressmeter_analysis and score are excluded for now because raise an index out of range exception
-            check_passed = "ApplyBQSR"
-            HaploType(
-                path=f"{output_path}/gatk_gvcf/",
-                sample=sample,
-            ).check_log()
-            check_passed = "HaploType"
-
-            # if all the checks are passed set the dataset status as COMPLETED
-            dataset_status = "COMPLETED"
-        except Exception as exc:
-            # get the check that raised the exception
-            if check_passed:
-                last_checked = check_list.index(check_passed)
-                check_failed_index = last_checked + 1
-            else:
-                check_failed_index = 0
-            error_message = f"Step {check_list[check_failed_index]}: {exc}"
-            # log.error(error_message)
-
-            # if the datasets has not passed all the checks its status will be ERROR
-            dataset_status = "ERROR"
-
-        # update the dataset status in the db
-        dataset.status = dataset_status
-        dataset.status_update = datetime.now(pytz.utc)
-        if error_message:
-            dataset.error_message = error_message
-        dataset.save()
-        # log.info(f"set status for dataset {d} as {dataset_status}")
-
-        # update the job relationship
-        rel = dataset.job.relationship(job)
-        rel.status = dataset_status
-        if error_message:
-            rel.error_message = error_message
-        rel.save()
-
-        if dataset_status == "ERROR":
-            # send notification email
-            send_notification(
-                subject="A dataset analysis ended in an error",
-                template="dataset_error.html",
-                to_address=None,
-                data={
-                    "dataset_id": dataset.uuid,
-                    "dataset_name": dataset.name,
-                    "study_id": study.uuid,
-                    "study_name": study.name,
-                    "error_message": error_message,
-                    "output_path": output_path,
-                    "job_path": wrkdir,
-                },
-            )
+        # append the contained files in the file list
+        file_list.extend(dataset_files)
+        analized_datasets.append(d)
+    update_queue_etas()
+
+    fastq_csv_file = write_fastq_csv(wrkdir, file_list)
+
+    started = time.time()
+    run_snakemake(
+        wrkdir,
+        snakefile,
+        force,
+        cores=granted.cores,
+        resources={"mem_mb": granted.mem_mb},
+    )
+    if analized_datasets:
+        # measured as the duration of the analysis of a single dataset
+        rounds = analysis_rounds(len(analized_datasets), granted_parallel(granted))
+        add_dataset_duration((time.time() - started) / rounds)
+
+    # check the status of the analysed datasets
+    groups = set()
+    for d in analized_datasets:
+        group_uuid = check_dataset(d, job, fastq_csv_file, wrkdir)
+        if group_uuid:
+            groups.add(group_uuid)
 
     log.info(f"check for job {task_id} completed")
 
+    # the analysis results may have changed the stats of the involved groups
+    if groups:
+        recount_stats(list(groups))
+
+
+@CeleryExt.task(idempotent=True, autoretry_for=(ConnectionResetError,))
+def launch_dataset_pipeline(
+    self: Task[[str, str, bool, Optional[int], Optional[int]], None],
+    dataset_uuid: str,
+    snakefile: str = "Single_Sample.smk",
+    force: bool = False,
+    cores: Optional[int] = None,
+    mem_mb: Optional[int] = None,
+) -> None:
+    """
+    Analyse a single dataset within a budget of cores and memory, the status
+    of the dataset is set as soon as its own analysis is completed
+    """
+    task_id = self.request.id
+    log.info("Start task [{}:{}] on dataset {}", task_id, self.name, dataset_uuid)
+
+    graph = neo4j.get_instance()
+    dataset = graph.Dataset.nodes.get_or_none(uuid=dataset_uuid)
+    if not dataset:
+        log.warning("Dataset {} not found", dataset_uuid)
+        return None
+
+    demand = dataset_demand([dataset], cores or DATASET_CORES, mem_mb or DATASET_MEM_MB)
+    granted = reserve(task_id, demand, get_dataset_duration())
+    if not granted:
+        # sent back to the queue, to be taken by a worker with free resources
+        c = celery.get_instance()
+        c.celery_app.send_task(
+            "launch_dataset_pipeline",
+            args=(dataset_uuid, snakefile, force, cores, mem_mb),
+            countdown=ADMISSION_DELAY,
+        )
+        return None
+
+    with hold_reservation(task_id):
+        # create a job node related to the task
+        job = graph.Job(uuid=task_id).save()
+
+        dataset_files = get_dataset_files(dataset, job)
+        if dataset_files is None:
+            return None
+        update_queue_etas()
+
+        wrkdir = prepare_workdir(task_id)
+        fastq_csv_file = write_fastq_csv(wrkdir, dataset_files)
+
+        started = time.time()
+        run_snakemake(
+            wrkdir,
+            snakefile,
+            force,
+            cores=granted.cores,
+            resources={"mem_mb": granted.mem_mb},
+        )
+        add_dataset_duration(time.time() - started)
+
+        group_uuid = check_dataset(dataset_uuid, job, fastq_csv_file, wrkdir)
+        log.info(f"check for job {task_id} completed")
+
+    if group_uuid:
+        recount_stats([group_uuid])
+
     return None
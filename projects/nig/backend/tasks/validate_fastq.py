@@ -0,0 +1,206 @@
+import gzip
+import zlib
+from itertools import repeat
+from pathlib import Path
+from queue import Empty, Full, Queue
+from threading import Event, Thread
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+from nig.endpoints import INPUT_ROOT
+from restapi.connectors import neo4j
+from restapi.connectors.celery import CeleryExt, Task
+from restapi.utilities.logs import log
+
+# size of the decompressed blocks passed from the reader thread to the parser
+FASTQ_BLOCK_SIZE = 8 * 1024 * 1024
+# decompressed blocks buffered ahead of the parser
+FASTQ_QUEUE_SIZE = 4
+PHRED_OFFSET = 33
+# the progress is stored in the file metadata at every PROGRESS_STEP
+PROGRESS_STEP = 0.1
+
+# decompressed block and position in the compressed file, an error or the end
+Block = Union[Tuple[bytes, int], Exception, None]
+
+
+class FastqError(Exception):
+    pass
+
+
+class FastqSummary:
+    def __init__(self) -> None:
+        self.reads = 0
+        self.bases = 0
+        self.quality = 0
+
+    def add(self, lines: List[bytes]) -> None:
+        """
+        Check a list of complete records, i.e. four lines per read
+        """
+        headers = lines[0::4]
+        sequences = lines[1::4]
+        separators = lines[2::4]
+        qualities = lines[3::4]
+
+        if not all(map(bytes.startswith, headers, repeat(b"@"))):
+            read = next(i for i, h in enumerate(headers) if not h.startswith(b"@"))
+            raise FastqError(
+                f"Invalid header for read {self.reads + read + 1}: {headers[read]!r}"
+            )
+        if not all(map(bytes.startswith, separators, repeat(b"+"))):
+            read = next(i for i, s in enumerate(separators) if not s.startswith(b"+"))
+            raise FastqError(
+                f"Invalid separator for read {self.reads + read + 1}: "
+                f"{separators[read]!r}"
+            )
+        sequence_lengths = list(map(len, sequences))
+        if sequence_lengths != list(map(len, qualities)):
+            read = next(
+                i for i, s in enumerate(sequences) if len(s) != len(qualities[i])
+            )
+            raise FastqError(
+                f"Sequence and quality lengths differ for read {self.reads + read + 1}"
+            )
+
+        scores = np.frombuffer(b"".join(qualities), dtype=np.uint8)
+        if scores.size and (scores.min() < PHRED_OFFSET or scores.max() > 126):
+            raise FastqError("Invalid quality scores")
+
+        self.reads += len(headers)
+        self.bases += sum(sequence_lengths)
+        self.quality += int(scores.sum(dtype=np.uint64)) - PHRED_OFFSET * scores.size
+
+    def metadata(self) -> Dict[str, Any]:
+        return {
+            "reads": self.reads,
+            "bases": self.bases,
+            "mean_quality": round(self.quality / self.bases, 2) if self.bases else 0,
+        }
+
+
+def read_blocks(path: Path, blocks: "Queue[Block]", stop: Event) -> None:
+    """
+    Decompress the file in blocks, the gzip module checks the CRC and the
+    size in the trailer of every member and fails on a truncated stream
+    """
+
+    def put(block: Block) -> bool:
+        while not stop.is_set():
+            try:
+                blocks.put(block, timeout=1)
+                return True
+            except Full:
+                continue
+        return False
+
+    try:
+        with open(path, "rb") as raw, gzip.GzipFile(fileobj=raw) as f:
+            while block := f.read(FASTQ_BLOCK_SIZE):
+                if not put((block, raw.tell())):
+                    return
+        put(None)
+    except (OSError, EOFError, zlib.error) as e:
+        put(e)
+
+
+def scan_fastq(
+    path: Path, progress: Optional[Callable[[float], None]] = None
+) -> Dict[str, Any]:
+    """
+    Validate the whole gzipped fastq file and return its reads, bases and
+    mean quality. The decompression runs in a reader thread (zlib releases
+    the GIL) while the records are parsed, a gzip stream can only be
+    decompressed sequentially so this is the only available parallelism.
+    Raises FastqError if the file is not valid
+    """
+    total = path.stat().st_size
+    if total == 0:
+        raise FastqError("File is empty")
+
+    blocks: "Queue[Block]" = Queue(maxsize=FASTQ_QUEUE_SIZE)
+    stop = Event()
+    reader = Thread(target=read_blocks, args=(path, blocks, stop), daemon=True)
+    reader.start()
+
+    summary = FastqSummary()
+    remainder = b""
+    try:
+        while True:
+            block = blocks.get()
+            if block is None:
+                break
+            if isinstance(block, Exception):
+                raise FastqError(f"Invalid gzip file: {block}")
+
+            data, position = block
+            lines = (remainder + data).split(b"\n")
+            # the last line and the incomplete record are kept for the next block
+            complete = (len(lines) - 1) // 4 * 4
+            remainder = b"\n".join(lines[complete:])
+            summary.add(lines[:complete])
+            if progress:
+                progress(position / total)
+    finally:
+        stop.set()
+        try:
+            while True:
+                blocks.get_nowait()
+        except Empty:
+            pass
+        reader.join()
+
+    lines = remainder.rstrip(b"\n").split(b"\n") if remainder.strip() else []
+    if len(lines) % 4:
+        raise FastqError(f"Truncated record after read {summary.reads}")
+    summary.add(lines)
+
+    if summary.reads == 0:
+        raise FastqError("File does not contain any read")
+
+    return summary.metadata()
+
+
+@CeleryExt.task(idempotent=True)
+def validate_fastq(self: Task[[str], Dict[str, Any]], file_uuid: str) -> Dict[str, Any]:
+    task_id = self.request.id
+    log.info("Start task [{}:{}]", task_id, self.name)
+
+    graph = neo4j.get_instance()
+    file = graph.File.nodes.get_or_none(uuid=file_uuid)
+    if not file:
+        log.warning("File {} not found", file_uuid)
+        return {}
+
+    dataset = file.dataset.single()
+    group = dataset.ownership.single().belongs_to.single()
+    study = dataset.parent_study.single()
+    path = INPUT_ROOT.joinpath(group.uuid, study.uuid, dataset.uuid, file.name)
+
+    file.metadata = {"validation": "running", "progress": 0}
+    file.save()
+
+    last_progress = 0.0
+
+    def progress(fraction: float) -> None:
+        nonlocal last_progress
+        if fraction - last_progress < PROGRESS_STEP:
+            return
+        last_progress = fraction
+        if task_id:
+            self.update_state(state="PROGRESS", meta={"progress": fraction})
+        file.metadata = {"validation": "running", "progress": round(fraction, 2)}
+        file.save()
+
+    try:
+        metadata = {"validation": "passed", **scan_fastq(path, progress)}
+    except (FastqError, OSError) as e:
+        log.warning("File {} is not valid: {}", file_uuid, e)
+        metadata = {"validation": "failed", "error": str(e)}
+        file.status = "corrupted"
+
+    file.metadata = metadata
+    file.save()
+
+    log.info("Validation of file {} completed: {}", file_uuid, metadata)
+    return metadata
@@ -0,0 +1,119 @@
+from faker import Faker
+from nig.endpoints import READ_ACCESS_FILTER, Access, get_access_map
+from nig.tests import create_test_env, delete_test_env
+from restapi.connectors import neo4j
+from restapi.services.authentication import Role
+from restapi.tests import API_URI, BaseTests, FlaskClient
+
+
+class TestApp(BaseTests):
+    def test_access(self) -> None:
+        owner = Access(has_owner=True, owner=True, shared=True, admin=False)
+        assert owner.allows()
+        assert owner.allows(read=True)
+        assert not owner.readonly
+
+        shared = Access(has_owner=True, owner=False, shared=True, admin=False)
+        assert shared.allows()
+        assert not shared.readonly
+
+        # an admin not sharing a group with the owners can only read
+        admin = Access(has_owner=True, owner=False, shared=False, admin=True)
+        assert not admin.allows()
+        assert admin.allows(read=True)
+        assert admin.allows(update_status=True)
+        assert admin.readonly
+
+        other = Access(has_owner=True, owner=False, shared=False, admin=False)
+        assert not other.allows()
+        assert not other.allows(read=True)
+
+        # nodes without owners are never accessible, not even by an admin
+        no_owner = Access(has_owner=False, owner=False, shared=False, admin=True)
+        assert not no_owner.allows()
+        assert not no_owner.allows(read=True, update_status=True)
+
+    def test_access_map(self, client: FlaskClient, faker: Faker) -> None:
+        (
+            admin_headers,
+            uuid_group_A,
+            user_A1_uuid,
+            user_A1_headers,
+            uuid_group_B,
+            user_B1_uuid,
+            user_B1_headers,
+            user_B2_uuid,
+            user_B2_headers,
+            study1_uuid,
+            study2_uuid,
+        ) = create_test_env(client, faker, study=True)
+
+        graph = neo4j.get_instance()
+        no_owner = graph.Study(name=faker.pystr(), description=faker.pystr()).save()
+        uuids = [study1_uuid, study2_uuid, no_owner.uuid, faker.pystr()]
+
+        r = client.get(f"{API_URI}/auth/profile", headers=admin_headers)
+        assert r.status_code == 200
+        admin_profile = self.get_content(r)
+        assert isinstance(admin_profile, dict)
+
+        users = {
+            "owner": graph.User.nodes.get(uuid=user_B1_uuid),
+            "shared": graph.User.nodes.get(uuid=user_B2_uuid),
+            "other": graph.User.nodes.get(uuid=user_A1_uuid),
+            "admin": graph.User.nodes.get(uuid=admin_profile["uuid"]),
+        }
+        access = {k: get_access_map("Study", uuids, u) for k, u in users.items()}
+
+        # not existing nodes are not included
+        for access_map in access.values():
+            assert set(access_map) == {study1_uuid, study2_uuid, no_owner.uuid}
+            assert not access_map[no_owner.uuid].has_owner
+            assert not access_map[no_owner.uuid].allows(read=True)
+
+        assert access["owner"][study1_uuid].owner
+        assert access["owner"][study1_uuid].allows()
+        assert not access["owner"][study2_uuid].allows(read=True)
+
+        assert not access["shared"][study1_uuid].owner
+        assert access["shared"][study1_uuid].shared
+        assert access["shared"][study1_uuid].allows()
+
+        assert not access["other"][study1_uuid].allows(read=True)
+        assert access["other"][study2_uuid].allows()
+
+        assert access["admin"][study1_uuid].admin
+        assert access["admin"][study1_uuid].readonly
+        assert not access["admin"][study1_uuid].allows()
+        assert access["admin"][study1_uuid].allows(read=True)
+
+        # the list queries filter the nodes with the same rules
+        for key, user in users.items():
+            rows = graph.cypher(
+                "MATCH (u:User {uuid: $user_uuid}) "
+                "UNWIND $uuids AS node_uuid "
+                "MATCH (n:Study {uuid: node_uuid})"
+                + READ_ACCESS_FILTER
+                + "RETURN n.uuid, readonly",
+                user_uuid=user.uuid,
+                admin_role=Role.ADMIN.value,
+                uuids=uuids,
+            )
+            readable = {row[0]: row[1] for row in rows}
+            assert readable == {
+                u: a.readonly for u, a in access[key].items() if a.allows(read=True)
+            }
+
+        no_owner.delete()
+        delete_test_env(
+            client,
+            user_A1_headers,
+            user_B1_headers,
+            user_B1_uuid,
+            user_B2_uuid,
+            user_A1_uuid,
+            uuid_group_A,
+            uuid_group_B,
+            study1_uuid=study1_uuid,
+            study2_uuid=study2_uuid,
+        )
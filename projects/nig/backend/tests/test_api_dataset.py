@@ -1,4 +1,8 @@
+from typing import Any, List
+
+import pytest
 from faker import Faker
+from neomodel import db
 from nig.endpoints import INPUT_ROOT, OUTPUT_ROOT
 from nig.tests import create_test_env, delete_test_env
 from restapi.connectors import neo4j
@@ -86,6 +90,42 @@ def test_api_dataset(self, client: FlaskClient, faker: Faker) -> None:
         dataset2_uuid = self.get_content(r)
         assert isinstance(dataset2_uuid, str)
 
+        # the input schema of the study has been cached by the previous post,
+        # a technical created afterwards is a valid choice only if the cached
+        # schema is invalidated
+        r = client.post(
+            f"{API_URI}/study/{study1_uuid}/technicals",
+            headers=user_B1_headers,
+            json={"name": faker.pystr()},
+        )
+        assert r.status_code == 200
+        technical2_uuid = self.get_content(r)
+        assert isinstance(technical2_uuid, str)
+        r = client.post(
+            f"{API_URI}/study/{study1_uuid}/datasets",
+            headers=user_B1_headers,
+            json={**dataset2, "name": faker.pystr(), "technical": technical2_uuid},
+        )
+        assert r.status_code == 200
+        dataset3_uuid = self.get_content(r)
+        assert isinstance(dataset3_uuid, str)
+
+        # a deleted technical is no longer a choice of the cached schema
+        # (a stale schema would accept it and fail to find the node)
+        r = client.delete(
+            f"{API_URI}/technical/{technical2_uuid}", headers=user_B1_headers
+        )
+        assert r.status_code == 204
+        r = client.post(
+            f"{API_URI}/study/{study1_uuid}/datasets",
+            headers=user_B1_headers,
+            json={**dataset2, "technical": technical2_uuid},
+        )
+        assert r.status_code == 400
+
+        r = client.delete(f"{API_URI}/dataset/{dataset3_uuid}", headers=user_B1_headers)
+        assert r.status_code == 204
+
         # test dataset access
         # test dataset list response
         r = client.get(
@@ -297,3 +337,117 @@ def test_api_dataset(self, client: FlaskClient, faker: Faker) -> None:
             study1_uuid=study1_uuid,
             study2_uuid=study2_uuid,
         )
+
+    def test_api_dataset_list_queries(
+        self, client: FlaskClient, faker: Faker, monkeypatch: pytest.MonkeyPatch
+    ) -> None:
+        # setup the test env
+        (
+            admin_headers,
+            uuid_group_A,
+            user_A1_uuid,
+            user_A1_headers,
+            uuid_group_B,
+            user_B1_uuid,
+            user_B1_headers,
+            user_B2_uuid,
+            user_B2_headers,
+            study1_uuid,
+            study2_uuid,
+        ) = create_test_env(client, faker, study=True)
+
+        # count all the queries sent to neo4j
+        queries: List[str] = []
+        cypher_query = db.cypher_query
+
+        def counted_cypher_query(query: str, *args: Any, **kwargs: Any) -> Any:
+            queries.append(query)
+            return cypher_query(query, *args, **kwargs)
+
+        monkeypatch.setattr(db, "cypher_query", counted_cypher_query)
+
+        def get_dataset_list(headers: Any) -> int:
+            queries.clear()
+            r = client.get(f"{API_URI}/study/{study1_uuid}/datasets", headers=headers)
+            assert r.status_code == 200
+            response = self.get_content(r)
+            assert isinstance(response, list)
+            return len(queries)
+
+        # create a technical and a phenotype to be assigned to the datasets
+        r = client.post(
+            f"{API_URI}/study/{study1_uuid}/technicals",
+            headers=user_B1_headers,
+            json={"name": faker.pystr()},
+        )
+        assert r.status_code == 200
+        technical_uuid = self.get_content(r)
+        r = client.post(
+            f"{API_URI}/study/{study1_uuid}/phenotypes",
+            headers=user_B1_headers,
+            json={"name": faker.pystr(), "sex": "male"},
+        )
+        assert r.status_code == 200
+        phenotype_uuid = self.get_content(r)
+
+        def create_datasets(num: int) -> None:
+            for _ in range(num):
+                dataset = {
+                    "name": faker.pystr(),
+                    "description": faker.pystr(),
+                    "phenotype": phenotype_uuid,
+                    "technical": technical_uuid,
+                }
+                r = client.post(
+                    f"{API_URI}/study/{study1_uuid}/datasets",
+                    headers=user_B1_headers,
+                    json=dataset,
+                )
+                assert r.status_code == 200
+
+        create_datasets(1)
+        owner_queries = get_dataset_list(user_B1_headers)
+        group_queries = get_dataset_list(user_B2_headers)
+        admin_queries = get_dataset_list(admin_headers)
+
+        # the number of queries does not depend on the number of datasets
+        create_datasets(10)
+        assert get_dataset_list(user_B1_headers) == owner_queries
+        assert get_dataset_list(user_B2_headers) == group_queries
+        assert get_dataset_list(admin_headers) == admin_queries
+
+        r = client.get(
+            f"{API_URI}/study/{study1_uuid}/datasets", headers=user_B2_headers
+        )
+        assert r.status_code == 200
+        response = self.get_content(r)
+        assert isinstance(response, list)
+        assert len(response) == 11
+        for dataset in response:
+            assert dataset["technical"]["uuid"] == technical_uuid
+            assert dataset["phenotype"]["uuid"] == phenotype_uuid
+            assert dataset["files"] == 0
+            assert not dataset["readonly"]
+
+        r = client.get(f"{API_URI}/study/{study1_uuid}/datasets", headers=admin_headers)
+        assert r.status_code == 200
+        response = self.get_content(r)
+        assert isinstance(response, list)
+        assert len(response) == 11
+        assert all(dataset["readonly"] for dataset in response)
+
+        monkeypatch.undo()
+
+        # delete all the elements used by the test
+        delete_test_env(
+            client,
+            user_A1_headers,
+            user_B1_headers,
+            user_B1_uuid,
+            user_B2_uuid,
+            user_A1_uuid,
+            uuid_group_A,
+            uuid_group_B,
+            study1_uuid=study1_uuid,
+            study2_uuid=study2_uuid,
+        )
@@ -1,6 +1,11 @@
+import hashlib
+import io
+import tarfile
+import zipfile
 from pathlib import Path
 
 from faker import Faker
+from flask import Flask
 from nig.endpoints import INPUT_ROOT, OUTPUT_ROOT
 from nig.tests import create_test_env, delete_test_env
 from restapi.connectors import neo4j
@@ -8,7 +13,7 @@
 
 
 class TestApp(BaseTests):
-    def test_api_download(self, client: FlaskClient, faker: Faker) -> None:
+    def test_api_download(self, app: Flask, client: FlaskClient, faker: Faker) -> None:
         # setup the test env
         (
             admin_headers,
@@ -79,8 +84,8 @@ def test_api_download(self, client: FlaskClient, faker: Faker) -> None:
             headers=user_B1_headers,
         )
         assert r.status_code == 404
-        dir_not_found_message = self.get_content(r)
-        assert dir_not_found_message != uncompleted_message
+        not_registered_message = self.get_content(r)
+        assert not_registered_message != uncompleted_message
 
         # create the output dir
         bam_output_path = OUTPUT_ROOT.joinpath(
@@ -101,14 +106,24 @@ def test_api_download(self, client: FlaskClient, faker: Faker) -> None:
         with open(bam_filepath, "w") as f:
             f.write(bam_content)
 
+        # the downloads only read the registry, the results are not registered yet
+        r = client.get(
+            f"{API_URI}/dataset/{dataset1_uuid}/download?file=bam",
+            headers=user_B1_headers,
+        )
+        assert r.status_code == 404
+        assert self.get_content(r) == not_registered_message
+
+        # the results of the datasets not registered by the pipeline
+        # are registered by the consistency check
+        self.send_task(app, "check_consistency", full=True)
+
         # test a download for a file that not exists
         r = client.get(
             f"{API_URI}/dataset/{dataset1_uuid}/download?file=g.vcf",
             headers=user_B1_headers,
         )
         assert r.status_code == 404
-        file_not_found_message = self.get_content(r)
-        assert file_not_found_message != dir_not_found_message
 
         # create a second file (to test later if the downloaded file is the requested one)
         gvcf_content = "I am a .g.vcf file"
@@ -116,6 +131,9 @@ def test_api_download(self, client: FlaskClient, faker: Faker) -> None:
         with open(filepath, "w") as f:
             f.write(gvcf_content)
 
+        # the modified output dir is scanned again by the incremental check
+        self.send_task(app, "check_consistency")
+
         # an other member of the group downloads a file
         r = client.get(
             f"{API_URI}/dataset/{dataset1_uuid}/download?file=bam",
@@ -125,7 +143,184 @@ def test_api_download(self, client: FlaskClient, faker: Faker) -> None:
 
         # check the downloaded file is the correct one
         download_content = r.data
-        assert download_content.decode("utf-8") == bam_content  # test get size
+        assert download_content.decode("utf-8") == bam_content
+        etag = r.headers["ETag"]
+        assert r.headers["Accept-Ranges"] == "bytes"
+
+        # the g.vcf file is found, registered after the bam file
+        r = client.get(
+            f"{API_URI}/dataset/{dataset1_uuid}/download?file=g.vcf",
+            headers=user_B2_headers,
+        )
+        assert r.status_code == 200
+        assert r.data.decode("utf-8") == gvcf_content
+
+        # the results have been registered to be found by kind
+        results = {f.kind: f for f in dataset.results.all()}
+        assert results["bam"].mtime == bam_filepath.stat().st_mtime
+        assert results["bam"].path == str(bam_filepath)
+        # with uuids in the same format of the other nodes
+        assert len(results["bam"].uuid) == len(dataset.uuid)
+        assert results["gvcf"].size == filepath.stat().st_size
+
+        # test a range request
+        r = client.get(
+            f"{API_URI}/dataset/{dataset1_uuid}/download?file=bam",
+            headers={**user_B2_headers, "Range": "bytes=2-3"},
+        )
+        assert r.status_code == 206
+        assert r.data.decode("utf-8") == bam_content[2:4]
+        assert r.headers["Content-Range"] == f"bytes 2-3/{len(bam_content)}"
+        # resume the download from the last bytes
+        r = client.get(
+            f"{API_URI}/dataset/{dataset1_uuid}/download?file=bam",
+            headers={**user_B2_headers, "Range": "bytes=-4", "If-Range": etag},
+        )
+        assert r.status_code == 206
+        assert r.data.decode("utf-8") == bam_content[-4:]
+        # the file has changed, the whole file is sent
+        r = client.get(
+            f"{API_URI}/dataset/{dataset1_uuid}/download?file=bam",
+            headers={**user_B2_headers, "Range": "bytes=2-3", "If-Range": '"x"'},
+        )
+        assert r.status_code == 200
+        assert r.data.decode("utf-8") == bam_content
+        # a date validator has to be the exact last modification date,
+        # not only later than it
+        last_modified = r.headers["Last-Modified"]
+        r = client.get(
+            f"{API_URI}/dataset/{dataset1_uuid}/download?file=bam",
+            headers={
+                **user_B2_headers,
+                "Range": "bytes=2-3",
+                "If-Range": last_modified,
+            },
+        )
+        assert r.status_code == 206
+        r = client.get(
+            f"{API_URI}/dataset/{dataset1_uuid}/download?file=bam",
+            headers={
+                **user_B2_headers,
+                "Range": "bytes=2-3",
+                "If-Range": "Fri, 01 Jan 2100 00:00:00 GMT",
+            },
+        )
+        assert r.status_code == 200
+        assert r.data.decode("utf-8") == bam_content
+        # multiple ranges
+        r = client.get(
+            f"{API_URI}/dataset/{dataset1_uuid}/download?file=bam",
+            headers={**user_B2_headers, "Range": "bytes=0-0,2-3"},
+        )
+        assert r.status_code == 206
+        assert r.mimetype == "multipart/byteranges"
+        assert f"bytes 2-3/{len(bam_content)}" in r.data.decode("utf-8")
+        # not satisfiable ranges
+        r = client.get(
+            f"{API_URI}/dataset/{dataset1_uuid}/download?file=bam",
+            headers={**user_B2_headers, "Range": f"bytes={len(bam_content)}-"},
+        )
+        assert r.status_code == 416
+
+        # test a region download
+        region_url = f"{API_URI}/dataset/{dataset1_uuid}/results"
+        r = client.get(f"{region_url}/bam?region=chr1:a-b", headers=user_B2_headers)
+        assert r.status_code == 400
+        r = client.get(f"{region_url}/bam?region=-oevil.bam", headers=user_B2_headers)
+        assert r.status_code == 400
+        r = client.get(
+            f"{region_url}/bam?region=chr1:2,000-1,000", headers=user_B2_headers
+        )
+        assert r.status_code == 400
+        r = client.get(f"{region_url}/fastq?region=chr1", headers=user_B2_headers)
+        assert r.status_code == 404
+        r = client.get(
+            f"{region_url}/bam?region=chr1:1000-2000", headers=user_A1_headers
+        )
+        assert r.status_code == 404
+        assert self.get_content(r) == not_authorized_message
+        # the bam file is not indexed
+        r = client.get(
+            f"{region_url}/bam?region=chr1:1000-2000", headers=user_B2_headers
+        )
+        assert r.status_code == 404
+
+        # download the results of the whole study
+        study_url = f"{API_URI}/study/{study1_uuid}/download"
+        r = client.get(f"{study_url}?file=bam", headers=user_B2_headers)
+        assert r.status_code == 200
+        assert r.mimetype == "application/zip"
+        archive = zipfile.ZipFile(io.BytesIO(r.data))
+        bam_entry = f"{dataset1['name']}/{bam_filepath.name}"
+        assert archive.namelist() == [bam_entry, "MD5SUMS"]
+        assert archive.read(bam_entry).decode("utf-8") == bam_content
+        bam_md5 = hashlib.md5(bam_content.encode()).hexdigest()
+        assert archive.read("MD5SUMS").decode() == f"{bam_md5}  {bam_entry}\n"
+
+        r = client.get(
+            f"{study_url}?file=g.vcf&archive=tar&datasets={dataset1_uuid}",
+            headers=user_B2_headers,
+        )
+        assert r.status_code == 200
+        with tarfile.open(fileobj=io.BytesIO(r.data)) as tar:
+            gvcf_entry = f"{dataset1['name']}/{filepath.name}"
+            assert tar.getnames() == [gvcf_entry, "MD5SUMS"]
+            gvcf_file = tar.extractfile(gvcf_entry)
+            assert gvcf_file is not None
+            assert gvcf_file.read().decode("utf-8") == gvcf_content
+
+        # the bam file has no index
+        r = client.get(f"{study_url}?file=bam&index=true", headers=user_B2_headers)
+        assert r.status_code == 200
+        archive = zipfile.ZipFile(io.BytesIO(r.data))
+        assert archive.namelist() == [bam_entry, "MD5SUMS"]
+        # datasets not in the study
+        r = client.get(
+            f"{study_url}?file=bam&datasets={faker.pystr()}", headers=user_B2_headers
+        )
+        assert r.status_code == 404
+        # study of another group
+        r = client.get(f"{study_url}?file=bam", headers=user_A1_headers)
+        assert r.status_code == 404
+        # study without results
+        r = client.get(
+            f"{API_URI}/study/{study2_uuid}/download?file=bam", headers=user_A1_headers
+        )
+        assert r.status_code == 404
+
+        # a dataset analysed before the results registration, with an unsafe name
+        r = client.post(
+            f"{API_URI}/study/{study1_uuid}/datasets",
+            headers=user_B1_headers,
+            json={"name": "..", "description": faker.pystr()},
+        )
+        assert r.status_code == 200
+        dataset2_uuid = self.get_content(r)
+        assert isinstance(dataset2_uuid, str)
+        dataset2 = graph.Dataset.nodes.get_or_none(uuid=dataset2_uuid)
+        dataset2.status = "COMPLETED"
+        dataset2.save()
+        bam2_output_path = OUTPUT_ROOT.joinpath(
+            uuid_group_B, study1_uuid, dataset2_uuid, "bwa"
+        )
+        bam2_output_path.mkdir(parents=True)
+        bam2_filepath = Path(bam2_output_path, faker.pystr()).with_suffix(".bam")
+        with open(bam2_filepath, "w") as f:
+            f.write(bam_content)
+        # not found until registered by the consistency check
+        r = client.get(
+            f"{study_url}?file=bam&datasets={dataset2_uuid}", headers=user_B2_headers
+        )
+        assert r.status_code == 404
+        self.send_task(app, "check_consistency")
+        r = client.get(
+            f"{study_url}?file=bam&datasets={dataset2_uuid}", headers=user_B2_headers
+        )
+        assert r.status_code == 200
+        archive = zipfile.ZipFile(io.BytesIO(r.data))
+        assert archive.namelist() == [f"__/{bam2_filepath.name}", "MD5SUMS"]
+
+        # test get size
         r = client.get(
             f"{API_URI}/dataset/{dataset1_uuid}/download?file=bam&get_total_size=true",
             headers=user_B2_headers,
@@ -134,6 +329,14 @@ def test_api_download(self, client: FlaskClient, faker: Faker) -> None:
         total_file_size = self.get_content(r)
         assert bam_filepath.stat().st_size == total_file_size
 
+        # a result removed from the disk is not found
+        filepath.unlink()
+        r = client.get(
+            f"{API_URI}/dataset/{dataset1_uuid}/download?file=g.vcf",
+            headers=user_B2_headers,
+        )
+        assert r.status_code == 404
+
         # delete all the element used for the test
         delete_test_env(
             client,
@@ -1,9 +1,11 @@
+import hashlib
 import tempfile
 from pathlib import Path
 from subprocess import check_call
-from typing import Dict
+from typing import Dict, Optional
 
 from faker import Faker
+from flask import Flask
 from nig.endpoints import INPUT_ROOT
 from nig.tests import create_test_env, delete_test_env
 from restapi.tests import API_URI, BaseTests, FlaskClient
@@ -18,6 +20,7 @@ def upload_file(
         fastq: Path,
         dataset_uuid: str,
         stream: bool = True,
+        checksums: Optional[Dict[str, str]] = None,
     ) -> Response:
         # get the data for the upload request
         filename = fastq.name
@@ -31,6 +34,8 @@ def upload_file(
 
         if not stream:
             data["testing"] = True
+        if checksums:
+            data.update(checksums)
 
         r_post: Response = client.post(
             f"{API_URI}/dataset/{dataset_uuid}/files/upload", headers=headers, json=data
@@ -49,12 +54,10 @@ def upload_file(
                 # the loop is exited when the APIs respond with a code != 206
                 if not read_data:  # pragma: no cover
                     break
-                if range_start != 0:
-                    range_start += 1
-                range_max = range_start + chunksize
-                if range_max > filesize:
-                    range_max = filesize
-                headers["Content-Range"] = f"bytes {range_start}-{range_max}/{filesize}"
+                range_stop = range_start + len(read_data)
+                headers["Content-Range"] = (
+                    f"bytes {range_start}-{range_stop - 1}/{filesize}"
+                )
                 if stream:
                     r: Response = client.put(
                         f"{API_URI}/dataset/{dataset_uuid}/files/upload/{filename}",
@@ -62,7 +65,7 @@ def upload_file(
                         data=read_data,
                     )
                 else:
-                    # do not read data to test final size!=expected size
+                    # do not read data to test chunk size != content range
                     r = client.put(
                         f"{API_URI}/dataset/{dataset_uuid}/files/upload/{filename}",
                         headers=headers,
@@ -70,7 +73,7 @@ def upload_file(
                 if r.status_code != 206:
                     # the upload is completed or an error occurred
                     break
-                range_start += chunksize
+                range_start = range_stop
             return r
 
     @staticmethod
@@ -89,7 +92,7 @@ def create_fastq_gz(
 
         return path.with_suffix(".fastq.gz")
 
-    def test_api_file(self, client: FlaskClient, faker: Faker) -> None:
+    def test_api_file(self, app: Flask, client: FlaskClient, faker: Faker) -> None:
         # setup the test env
         (
             admin_headers,
@@ -195,8 +198,14 @@ def test_api_file(self, client: FlaskClient, faker: Faker) -> None:
         fastq = self.create_fastq_gz(faker, valid_fcontent, filename=sample_filename)
 
         # upload a file
+        fastq_content = fastq.read_bytes()
         response = self.upload_file(
-            client, user_B1_headers, fastq, dataset_B_uuid, stream=True
+            client,
+            user_B1_headers,
+            fastq,
+            dataset_B_uuid,
+            stream=True,
+            checksums={"sha256": hashlib.sha256(fastq_content).hexdigest()},
         )
         assert response.status_code == 200
         # check the file exists and have the expected size
@@ -230,7 +239,7 @@ def test_api_file(self, client: FlaskClient, faker: Faker) -> None:
         )
         assert response.status_code == 200
 
-        # check error if final file size is different from the expected
+        # check error if the chunk size is different from the content range
         # rename the file to upload
         fastq2 = fastq.parent.joinpath(f"{faker.pystr()}_R1.fastq.gz")
         fastq.rename(fastq2)
@@ -242,14 +251,28 @@ def test_api_file(self, client: FlaskClient, faker: Faker) -> None:
             dataset_B_uuid,
             stream=False,
         )
-        assert response.status_code == 500
+        assert response.status_code == 400
         error_message = self.get_content(response)
         assert isinstance(error_message, str)
         assert (
-            error_message
-            == "File has not been uploaded correctly: final size does not correspond to total size. Please try a new upload"
+            error_message == "The chunk size does not correspond to the Content-Range"
+        )
+        # the upload can be resumed, nothing has been received
+        r = client.get(
+            f"{API_URI}/dataset/{dataset_B_uuid}/files/upload/{fastq2.name}",
+            headers=user_B1_headers,
         )
-        # check uncomplete file has been removed
+        assert r.status_code == 200
+        upload_status = self.get_content(r)
+        assert isinstance(upload_status, dict)
+        assert upload_status["status"] == "importing"
+        assert upload_status["received"] == 0
+        assert upload_status["missing"] == [[0, filesize]]
+        # remove the uncomplete upload
+        r = client.delete(
+            f"{API_URI}/file/{upload_status['uuid']}", headers=user_B1_headers
+        )
+        assert r.status_code == 204
         check_filepath = INPUT_ROOT.joinpath(
             uuid_group_B,
             study1_uuid,
@@ -258,9 +281,105 @@ def test_api_file(self, client: FlaskClient, faker: Faker) -> None:
         )
         assert not check_filepath.is_file()
 
+        # upload the chunks out of order
+        chunked_fastq = self.create_fastq_gz(
+            faker, "\n".join([valid_fcontent] * 100), filename=f"{faker.pystr()}_R1"
+        )
+        chunked_content = chunked_fastq.read_bytes()
+        chunked_size = len(chunked_content)
+        half = chunked_size // 2
+        r = client.post(
+            f"{API_URI}/dataset/{dataset_B2_uuid}/files/upload",
+            headers=user_B2_headers,
+            json={
+                "name": chunked_fastq.name,
+                "mimeType": "application/gzip",
+                "size": chunked_size,
+                "lastModified": faker.pyint(),
+                "testing": True,
+            },
+        )
+        assert r.status_code == 201
+        upload_url = (
+            f"{API_URI}/dataset/{dataset_B2_uuid}/files/upload/{chunked_fastq.name}"
+        )
+        r = client.put(
+            upload_url,
+            headers={
+                **user_B2_headers,
+                "Content-Range": f"bytes {half}-{chunked_size - 1}/{chunked_size}",
+            },
+            data=chunked_content[half:],
+        )
+        assert r.status_code == 206
+        r = client.get(upload_url, headers=user_B2_headers)
+        assert r.status_code == 200
+        upload_status = self.get_content(r)
+        assert isinstance(upload_status, dict)
+        assert upload_status["received"] == chunked_size - half
+        assert upload_status["missing"] == [[0, half]]
+        r = client.put(
+            upload_url,
+            headers={
+                **user_B2_headers,
+                "Content-Range": f"bytes 0-{half - 1}/{chunked_size}",
+            },
+            data=chunked_content[:half],
+        )
+        assert r.status_code == 200
+        r = client.get(upload_url, headers=user_B2_headers)
+        assert r.status_code == 200
+        upload_status = self.get_content(r)
+        assert isinstance(upload_status, dict)
+        assert upload_status["status"] == "uploaded"
+        assert upload_status["missing"] == []
+        r = client.get(
+            f"{API_URI}/file/{upload_status['uuid']}", headers=user_B2_headers
+        )
+        assert r.status_code == 200
+        file_response = self.get_content(r)
+        assert isinstance(file_response, dict)
+        assert file_response["md5"] == hashlib.md5(chunked_content).hexdigest()
+        # the completing chunk sent again does not change the uploaded file
+        r = client.put(
+            upload_url,
+            headers={
+                **user_B2_headers,
+                "Content-Range": f"bytes 0-{half - 1}/{chunked_size}",
+            },
+            data=chunked_content[:half],
+        )
+        assert r.status_code == 200
+        chunked_fastq.unlink()
+
+        # check error if the checksum is different from the expected
+        R2_sample_filename = f"{sample_name}_R2"
+        R2_fastq = self.create_fastq_gz(
+            faker, valid_fcontent, filename=R2_sample_filename
+        )
+        response = self.upload_file(
+            client,
+            user_B1_headers,
+            R2_fastq,
+            dataset_B_uuid,
+            stream=True,
+            checksums={"md5": "0" * 32},
+        )
+        assert response.status_code == 500
+        error_message = self.get_content(response)
+        assert isinstance(error_message, str)
+        assert "md5 checksum does not correspond" in error_message
+        check_filepath = INPUT_ROOT.joinpath(
+            uuid_group_B,
+            study1_uuid,
+            dataset_B_uuid,
+            R2_fastq.name,
+        )
+        assert not check_filepath.is_file()
+        R2_fastq.unlink()
+
         # check file validation
         # upload an empty file
-        R2_sample_filename = f"{sample_name}_R2"
         empty_file = self.create_fastq_gz(faker, "", filename=R2_sample_filename)
         response = self.upload_file(
             client,
@@ -495,6 +614,20 @@ def test_api_file(self, client: FlaskClient, faker: Faker) -> None:
             else:
                 fileR2_uuid = f["uuid"]
 
+        # validate the whole file content
+        metadata = self.send_task(app, "validate_fastq", file_uuid)
+        assert metadata["validation"] == "passed"
+        r = client.get(f"{API_URI}/file/{file_uuid}", headers=user_B1_headers)
+        assert r.status_code == 200
+        file_response = self.get_content(r)
+        assert isinstance(file_response, dict)
+        assert file_response["status"] == "uploaded"
+        assert file_response["metadata"]["reads"] == 1
+        assert file_response["metadata"]["bases"] == 12
+        # the checksums have been computed during the upload
+        assert file_response["md5"] == hashlib.md5(fastq_content).hexdigest()
+        assert file_response["sha256"] == hashlib.sha256(fastq_content).hexdigest()
+
         # test file list response for a dataset you don't have access
         r = client.get(
             f"{API_URI}/dataset/{dataset_B_uuid}/files", headers=user_A1_headers
@@ -528,6 +661,18 @@ def test_api_file(self, client: FlaskClient, faker: Faker) -> None:
         # rename the file in the folder as it will not be found
         temporary_filepath = filepath.with_suffix(".fastq.tmp")
         filepath.rename(temporary_filepath)
+        # the status is only reconciled by the consistency check
+        r = client.get(
+            f"{API_URI}/dataset/{dataset_B_uuid}/files", headers=user_B1_headers
+        )
+        assert r.status_code == 200
+        file_list = self.get_content(r)
+        assert isinstance(file_list, list)
+        assert file_list[0]["status"] == "uploaded"
+
+        report = self.send_task(app, "check_consistency")
+        assert report["orphan_nodes"] > 0
+        assert report["orphan_files"] > 0
         r = client.get(
             f"{API_URI}/dataset/{dataset_B_uuid}/files", headers=user_B1_headers
         )
@@ -538,6 +683,7 @@ def test_api_file(self, client: FlaskClient, faker: Faker) -> None:
         # create an empty file with the original name
         # test status from unknown to importing
         filepath.touch()
+        self.send_task(app, "check_consistency")
 
         r = client.get(
             f"{API_URI}/dataset/{dataset_B_uuid}/files", headers=user_B1_headers
@@ -549,12 +695,14 @@ def test_api_file(self, client: FlaskClient, faker: Faker) -> None:
 
         # restore the original file
         filepath.unlink()
+        self.send_task(app, "check_consistency")
         r = client.get(f"{API_URI}/file/{file_uuid}", headers=user_B1_headers)
         assert r.status_code == 200
         file_response = self.get_content(r)
         assert isinstance(file_response, dict)
         assert file_response["status"] == "unknown"
         temporary_filepath.rename(filepath)
+        self.send_task(app, "check_consistency", full=True)
 
         r = client.get(
             f"{API_URI}/dataset/{dataset_B_uuid}/files", headers=user_B1_headers
@@ -583,12 +731,17 @@ def test_api_file(self, client: FlaskClient, faker: Faker) -> None:
         # check use case of file not in the folder
         # rename the file in the folder as it will not be found
         filepath.rename(temporary_filepath)
+        self.send_task(app, "check_consistency")
         r = client.get(f"{API_URI}/file/{file_uuid}", headers=user_B1_headers)
         assert r.status_code == 200
+        file_res = self.get_content(r)
+        assert isinstance(file_res, dict)
+        assert file_res["status"] == "unknown"
 
         # create an empty file with the original name
         # test status from unknown to importing
         filepath.touch()
+        self.send_task(app, "check_consistency")
         r = client.get(f"{API_URI}/file/{file_uuid}", headers=user_B1_headers)
         assert r.status_code == 200
         file_res = self.get_content(r)
@@ -597,10 +750,8 @@ def test_api_file(self, client: FlaskClient, faker: Faker) -> None:
 
         # restore the original file
         filepath.unlink()
-        r = client.get(f"{API_URI}/file/{file_uuid}", headers=user_B1_headers)
-        assert r.status_code == 200
-
         temporary_filepath.rename(filepath)
+        self.send_task(app, "check_consistency")
 
         r = client.get(f"{API_URI}/file/{file_uuid}", headers=user_B1_headers)
         assert r.status_code == 200
@@ -20,6 +20,14 @@ def test_api_hpo(self, client: FlaskClient, faker: Faker) -> None:
         assert "hpo_id" in content[0]
         assert "label" in content[0]
 
+        # prefix matches are ranked first
+        r = client.get(f"{endpoint}/abnormal", headers=headers)
+        assert r.status_code == 200
+        content = self.get_content(r)
+        assert isinstance(content, list)
+        assert len(content) > 0
+        assert content[0]["label"].lower().startswith("abnormal")
+
         r = client.get(f"{endpoint}/abcdefghilmn", headers=headers)
         assert r.status_code == 200
         content = self.get_content(r)
@@ -71,3 +79,49 @@ def test_api_hpo(self, client: FlaskClient, faker: Faker) -> None:
         # (it is interprented as anchor in the URL)
         r = client.get(f"{endpoint}/a#a", headers=headers)
         assert r.status_code == 200
+
+    def test_api_hpo_hierarchy(self, client: FlaskClient, faker: Faker) -> None:
+
+        endpoint = f"{API_URI}/hpo"
+        # HP:0000001 (All) is the root of HP:0000118 (Phenotypic abnormality)
+        root = "HP:0000001"
+        term = "HP:0000118"
+
+        r = client.get(f"{endpoint}/{term}/ancestors")
+        assert r.status_code == 401
+
+        headers, _ = self.do_login(client, None, None)
+
+        r = client.get(f"{endpoint}/{term}/ancestors", headers=headers)
+        assert r.status_code == 200
+        content = self.get_content(r)
+        assert isinstance(content, list)
+        assert {"hpo_id": root, "label": "All", "distance": 1} in content
+
+        r = client.get(
+            f"{endpoint}/{root}/descendants",
+            headers=headers,
+            query_string={"depth": 1},
+        )
+        assert r.status_code == 200
+        content = self.get_content(r)
+        assert isinstance(content, list)
+        assert term in [t["hpo_id"] for t in content]
+        assert all(t["distance"] == 1 for t in content)
+
+        r = client.get(f"{endpoint}/{term}/lca/{root}", headers=headers)
+        assert r.status_code == 200
+        content = self.get_content(r)
+        assert isinstance(content, list)
+        assert [t["hpo_id"] for t in content] == [root]
+
+        r = client.get(f"{endpoint}/{term}/phenotypes", headers=headers)
+        assert r.status_code == 200
+        content = self.get_content(r)
+        assert isinstance(content, list)
+
+        r = client.get(f"{endpoint}/{faker.pystr()}/ancestors", headers=headers)
+        assert r.status_code == 404
+
+        r = client.get(f"{endpoint}/{term}/lca/{faker.pystr()}", headers=headers)
+        assert r.status_code == 404
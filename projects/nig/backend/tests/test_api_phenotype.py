@@ -81,6 +81,14 @@ def test_api_phenotype(self, client: FlaskClient, faker: Faker) -> None:
         phenotype2["hpo"] = [hpo1_id, hpo2_id]
         phenotype2["hpo"] = json.dumps(phenotype2["hpo"])
 
+        # birth places are validated against the cached geodata choices
+        r = client.post(
+            f"{API_URI}/study/{study1_uuid}/phenotypes",
+            headers=user_B1_headers,
+            json={**phenotype2, "birth_place": faker.pystr()},
+        )
+        assert r.status_code == 400
+
         r = client.post(
             f"{API_URI}/study/{study1_uuid}/phenotypes",
             headers=user_B1_headers,
@@ -90,6 +98,38 @@ def test_api_phenotype(self, client: FlaskClient, faker: Faker) -> None:
         phenotype2_uuid = self.get_content(r)
         assert isinstance(phenotype2_uuid, str)
 
+        # test phenotype similarity search
+        similarity_query = {"hpo": f"{hpo1_id},{hpo2_id}", "size": 1000}
+        r = client.get(
+            f"{API_URI}/phenotypes/similar",
+            headers=user_B1_headers,
+            query_string=similarity_query,
+        )
+        assert r.status_code == 200
+        response = self.get_content(r)
+        assert isinstance(response, list)
+        similar = {p["uuid"]: p for p in response}
+        assert phenotype2_uuid in similar
+        assert similar[phenotype2_uuid]["study_uuid"] == study1_uuid
+        assert similar[phenotype2_uuid]["score"] > 0
+        # phenotypes of studies of other groups are not candidates
+        r = client.get(
+            f"{API_URI}/phenotypes/similar",
+            headers=user_A1_headers,
+            query_string=similarity_query,
+        )
+        assert r.status_code == 200
+        response = self.get_content(r)
+        assert isinstance(response, list)
+        assert phenotype2_uuid not in [p["uuid"] for p in response]
+
+        r = client.get(
+            f"{API_URI}/phenotypes/similar",
+            headers=user_B1_headers,
+            query_string={"hpo": faker.pystr()},
+        )
+        assert r.status_code == 400
+
         # test phenotype access
         # test phenotype list response
         r = client.get(
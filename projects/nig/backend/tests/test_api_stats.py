@@ -1,5 +1,8 @@
+from datetime import date, timedelta
+
 from faker import Faker
 from nig.endpoints import NIGEndpoint
+from nig.endpoints.stats import recount_stats, take_stats_snapshot
 from nig.tests import create_test_env, delete_test_env
 from restapi.connectors import neo4j
 from restapi.tests import API_URI, BaseTests, FlaskClient
@@ -91,6 +94,37 @@ def test_api_stats(self, client: FlaskClient, faker: Faker) -> None:
         assert private_stats["num_datasets"] > 0
         assert private_stats["num_files"] > 0
 
+        # stats history
+        today = date.today()
+        take_stats_snapshot(today - timedelta(days=1))
+        assert take_stats_snapshot() > 0
+        r = client.get(f"{API_URI}/stats/history", headers=user_B1_headers)
+        assert r.status_code == 200
+        history = self.get_content(r)
+        assert isinstance(history, list)
+        assert history[-1]["date"] == today.isoformat()
+        assert history[-1]["datasets"] == private_stats["num_datasets"]
+        # downsampled to the last snapshot
+        r = client.get(
+            f"{API_URI}/stats/history",
+            headers=user_B1_headers,
+            query_string={
+                "start": (today - timedelta(days=1)).isoformat(),
+                "points": 1,
+            },
+        )
+        assert r.status_code == 200
+        history = self.get_content(r)
+        assert isinstance(history, list)
+        assert len(history) == 1
+        assert history[0]["date"] == today.isoformat()
+        r = client.get(
+            f"{API_URI}/stats/history",
+            headers=user_B1_headers,
+            query_string={"start": today.isoformat(), "end": "2000-01-01"},
+        )
+        assert r.status_code == 400
+
         # exclude test group
         NIGEndpoint.GROUPS_TO_FILTER = ["Default group"]
         # test public stats
@@ -133,6 +167,36 @@ def test_api_stats(self, client: FlaskClient, faker: Faker) -> None:
         # check the excluded group not in responses
         assert "Default group" not in private_stats["num_datasets_per_group"]
 
+        # the recount corrects the drift of the materialized counters
+        graph.cypher(
+            "MATCH (s:Stats {group_uuid: $group_uuid}) SET s.datasets = 100",
+            group_uuid=uuid_group_A,
+        )
+        recount_stats()
+        r = client.get(
+            f"{API_URI}/stats/private",
+            headers=user_B1_headers,
+        )
+        private_stats = self.get_content(r)
+        assert isinstance(private_stats, dict)
+        assert private_stats["num_datasets"] == 2
+        assert private_stats["num_datasets_per_group"][group_A_fullname] == 1
+
+        # the counters are updated on deletion
+        r = client.delete(
+            f"{API_URI}/dataset/{dataset_B_uuid}",
+            headers=user_B1_headers,
+        )
+        assert r.status_code == 204
+        r = client.get(
+            f"{API_URI}/stats/public",
+        )
+        assert r.status_code == 200
+        public_stats = self.get_content(r)
+        assert isinstance(public_stats, dict)
+        assert public_stats["num_datasets"] == 1
+        assert public_stats["num_files"] == 1
+
         # test empty stats
         NIGEndpoint.GROUPS_TO_FILTER.append(group_A_fullname)
         NIGEndpoint.GROUPS_TO_FILTER.append(group_B_fullname)
@@ -161,6 +225,12 @@ def test_api_stats(self, client: FlaskClient, faker: Faker) -> None:
         assert group_A_fullname not in private_stats["num_datasets_per_group"]
         assert group_B_fullname not in private_stats["num_datasets_per_group"]
 
+        # delete the snapshots taken by the test
+        for snapshot in graph.StatsSnapshot.nodes.filter(
+            date__gte=today - timedelta(days=1)
+        ):
+            snapshot.delete()
+
         # delete all the elements used by the test
         delete_test_env(
             client,
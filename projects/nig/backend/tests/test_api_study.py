@@ -1,5 +1,5 @@
 from faker import Faker
-from nig.endpoints import INPUT_ROOT, OUTPUT_ROOT
+from nig.endpoints import INPUT_ROOT, MAX_PAGE_SIZE, OUTPUT_ROOT
 from nig.tests import create_test_env, delete_test_env
 from restapi.tests import API_URI, BaseTests, FlaskClient
 
@@ -48,6 +48,80 @@ def test_api_study(self, client: FlaskClient, faker: Faker) -> None:
         response = self.get_content(r)
         assert isinstance(response, list)
         assert len(response) == 1
+        # without a size the default page is returned, with the pagination headers
+        assert r.headers["X-Total-Count"] == "1"
+        assert "X-Next-Cursor" not in r.headers
+        r = client.get(
+            f"{API_URI}/study",
+            headers=user_B1_headers,
+            query_string={"size": MAX_PAGE_SIZE + 1},
+        )
+        assert r.status_code == 400
+
+        # test study list pagination
+        study3 = {"name": f"{random_name}_3", "description": faker.pystr()}
+        r = client.post(f"{API_URI}/study", headers=user_B2_headers, json=study3)
+        assert r.status_code == 200
+        study3_uuid = self.get_content(r)
+        assert isinstance(study3_uuid, str)
+
+        r = client.get(
+            f"{API_URI}/study",
+            headers=user_B1_headers,
+            query_string={"size": 1, "sort_by": "name"},
+        )
+        assert r.status_code == 200
+        response = self.get_content(r)
+        assert isinstance(response, list)
+        assert len(response) == 1
+        assert response[0]["uuid"] == study1_uuid
+        assert r.headers["X-Total-Count"] == "2"
+        next_cursor = r.headers["X-Next-Cursor"]
+
+        r = client.get(
+            f"{API_URI}/study",
+            headers=user_B1_headers,
+            query_string={"size": 1, "sort_by": "name", "cursor": next_cursor},
+        )
+        assert r.status_code == 200
+        response = self.get_content(r)
+        assert isinstance(response, list)
+        assert len(response) == 1
+        assert response[0]["uuid"] == study3_uuid
+        assert "X-Next-Cursor" not in r.headers
+
+        # test study list filter
+        r = client.get(
+            f"{API_URI}/study",
+            headers=user_B1_headers,
+            query_string={"name": f"{random_name}_"},
+        )
+        assert r.status_code == 200
+        response = self.get_content(r)
+        assert isinstance(response, list)
+        assert len(response) == 1
+        assert response[0]["uuid"] == study3_uuid
+
+        r = client.get(
+            f"{API_URI}/study",
+            headers=user_B1_headers,
+            query_string={"cursor": faker.pystr()},
+        )
+        assert r.status_code == 400
+
+        r = client.delete(f"{API_URI}/study/{study3_uuid}", headers=user_B2_headers)
+        assert r.status_code == 204
+
+        # test study list response for admin
+        r = client.get(f"{API_URI}/study", headers=admin_headers)
+        assert r.status_code == 200
+        response = self.get_content(r)
+        assert isinstance(response, list)
+        admin_studies = {s["uuid"]: s for s in response}
+        assert study1_uuid in admin_studies
+        assert study2_uuid in admin_studies
+        assert admin_studies[study1_uuid]["readonly"]
+        assert admin_studies[study1_uuid]["datasets"] == 0
 
         # test admin access
         r = client.get(f"{API_URI}/study/{study1_uuid}", headers=admin_headers)
@@ -0,0 +1,68 @@
+from nig.tasks._scheduler import (
+    Resources,
+    Slot,
+    analysis_rounds,
+    estimate_etas,
+    host_slots,
+)
+from restapi.tests import BaseTests
+
+
+class TestApp(BaseTests):
+    def test_resources(self) -> None:
+        capacity = Resources(cores=32, mem_mb=65536, scratch_mb=1000)
+        demand = Resources(cores=16, mem_mb=16384, scratch_mb=500)
+
+        assert demand.fits(capacity)
+        assert not demand.times(3).fits(capacity)
+        assert demand.times(2).fits(capacity)
+        assert capacity.minus(demand) == Resources(16, 49152, 500)
+        # a demand larger than the host is limited to the whole host
+        assert demand.times(4).limit(capacity) == capacity
+
+        # the slots are limited by the scarcest resource
+        assert capacity.slots(demand) == 2
+        assert capacity.slots(Resources(4, 32768, 0)) == 2
+        # a task larger than the host runs alone
+        assert capacity.slots(demand.times(4)) == 1
+        # demands without cores or memory do not divide by zero
+        assert capacity.slots(Resources(0, 0, 0)) >= 1
+
+        assert analysis_rounds(16, 2) == 8
+        assert analysis_rounds(3, 2) == 2
+        assert analysis_rounds(1, 4) == 1
+        assert analysis_rounds(0, 4) == 1
+
+    def test_host_slots(self) -> None:
+        now = 1000.0
+        capacity = Resources(cores=32, mem_mb=65536, scratch_mb=0)
+        dataset = Resources(cores=8, mem_mb=16384, scratch_mb=0)
+
+        # a host without reservations has all its slots free now
+        slots = host_slots(capacity, dataset, dataset, [], now)
+        assert slots == [Slot(now, 1)] * 4
+
+        # the running reservations free the slots at their expected end,
+        # the ones already late are expected to end now
+        slots = host_slots(capacity, dataset, dataset, [now + 50, now - 10], now)
+        assert slots == [Slot(now, 1), Slot(now, 1), Slot(now, 1), Slot(now + 50, 1)]
+
+        # a chunk of 16 datasets takes the whole host and analyses 4 of them
+        # at once, it starts when all the running reservations end
+        chunk = dataset.times(16)
+        ends = [now + 10, now + 30, now + 20]
+        assert host_slots(capacity, chunk, dataset, ends, now) == [Slot(now + 30, 4)]
+
+    def test_estimate_etas(self) -> None:
+        now = 1000.0
+
+        # the slots are not required to be sorted
+        etas = estimate_etas([Slot(now + 100, 1), Slot(now, 1)], [1, 1, 1, 1], 100)
+        assert etas == [now + 100, now + 200, now + 200, now + 300]
+        assert etas == sorted(etas)
+
+        # chunks are analysed in rounds of the datasets analysed at once
+        etas = estimate_etas([Slot(now, 4)], [16, 16, 3], 100)
+        assert etas == [now + 400, now + 800, now + 900]
+
+        assert estimate_etas([Slot(now, 1)], [], 100) == []